@@ -1,11 +1,11 @@
 from copy import deepcopy
 import re
-import subprocess
 
 from loguru import logger
 from sweepai.agents.agent_utils import Parameter, get_function_call, tool
 from sweepai.core.chat import ChatGPT
 from sweepai.core.snippet_utils import merge_snippet_ranges
+from sweepai.core.trigram_search import search_code
 from sweepai.utils.github_utils import ClonedRepo, MockClonedRepo
 from sweepai.utils.ticket_utils import prep_snippets
 from sweepai.core.entities import SNIPPET_FORMAT, Snippet
@@ -267,28 +267,14 @@ def ripgrep(
     """
     Search for a keyword in the codebase.
     """
-    response = subprocess.run(
-        " ".join([
-            "rg",
-            "-n",
-            # "-w",
-            "-i",
-            "-C=5",
-            "--heading",
-            "--sort-files",
-            query,
-        ]),
-        shell=True,
-        capture_output=True,
-        text=True,
-        cwd=cloned_repo.repo_dir,
-    )
-    if response.returncode != 0:
-        if not response.stderr:
-            return f"No results found for '{query}' in the codebase."
-        else:
-            return f"Error running ripgrep:\n\n{response.stderr}"
-    results = post_filter_ripgrep_results(response.stdout)
+    try:
+        # same output as `rg -n -i -C=5 --heading --sort-files query` in the repo
+        results = search_code(cloned_repo.repo_dir, query, ignore_case=True, context=5)
+    except re.error as e:
+        return f"Error running ripgrep:\n\n{e}"
+    if not results:
+        return f"No results found for '{query}' in the codebase."
+    results = post_filter_ripgrep_results(results)
     return f"Here are ALL occurrences of '{query}' in the codebase:\n\n```{results}```\n" + RIPGREP_SEARCH_RESULT_INSTRUCTIONS.format(
         request=llm_state["request"],
         visited_questions="\n".join(sorted(list(llm_state["visited_questions"])))
@@ -1,9 +1,7 @@
 from __future__ import annotations
 
-import json
 import os
 import re
-import subprocess
 import traceback
 from functools import lru_cache
 
@@ -11,11 +9,109 @@ import github
 import yaml
 from github.Repository import Repository
 from loguru import logger
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 from sweepai.core.entities import EmptyRepository
 from sweepai.utils.event_logger import posthog
 from sweepai.utils.file_utils import encode_file_with_fallback_encodings, read_file_with_fallback_encodings
+from sweepai.utils.linguist_utils import classify_files, is_generated
+
+MAX_MEMOIZED_PATHS = 100_000
+
+
+class ExclusionMatcher:
+    """
+    SweepConfig's path exclusion rules compiled once into sets and suffix tuples, with the result memoized per path.
+    Shared by filter_file, directory_to_chunks and the ripgrep post-processing, which check tens of thousands of
+    paths against the same rules. Paths are relative to the repo root.
+    """
+
+    def __init__(
+        self,
+        exclude_dirs: tuple[str, ...],
+        exclude_path_dirs: tuple[str, ...],
+        exclude_exts: tuple[str, ...],
+        exclude_substrings_aggressive: tuple[str, ...],
+    ):
+        # entries with a separator, like "packages/blobs", never equal a single path component
+        self.exclude_dirs = frozenset(exclude_dirs)
+        self.exclude_path_dirs = frozenset(exclude_path_dirs)
+        self.exclude_exts = exclude_exts
+        self.exclude_parts_aggressive = frozenset(exclude_dirs + exclude_exts)
+        self.exclude_substrings_aggressive = exclude_substrings_aggressive
+        self.is_excluded = lru_cache(maxsize=MAX_MEMOIZED_PATHS)(self._is_excluded)
+        self.is_filtered = lru_cache(maxsize=MAX_MEMOIZED_PATHS)(self._is_filtered)
+        self.is_excluded_aggressive = lru_cache(maxsize=MAX_MEMOIZED_PATHS)(self._is_excluded_aggressive)
+
+    def _is_excluded(self, file_path: str) -> bool:
+        """SweepConfig.is_file_excluded: an excluded directory or extension, or no extension at all."""
+        *dir_names, file_name = file_path.split(os.path.sep)
+        if not self.exclude_dirs.isdisjoint(dir_names) or file_name in self.exclude_dirs:
+            return True
+        return file_name.endswith(self.exclude_exts) or "." not in file_name
+
+    def _is_filtered(self, file_path: str) -> bool:
+        """The path rules of filter_file: an excluded extension, an excluded parent directory or an excluded path part."""
+        if file_path.endswith(self.exclude_exts):
+            return True
+        parts = file_path.split(os.path.sep)
+        return not self.exclude_dirs.isdisjoint(parts[:-1]) or not self.exclude_path_dirs.isdisjoint(parts)
+
+    def _is_excluded_aggressive(self, file_path: str) -> bool:
+        """The path rules of SweepConfig.is_file_excluded_aggressive, which also drop tests and json."""
+        if not self.exclude_parts_aggressive.isdisjoint(file_path.split(os.path.sep)):
+            return True
+        return any(substring in file_path for substring in self.exclude_substrings_aggressive)
+
+    def is_file_excluded_aggressive(self, dir: str, file_path: str) -> bool:
+        """SweepConfig.is_file_excluded_aggressive, for loops that fetch the matcher once."""
+        # the path rules are checked first since they don't touch the disk
+        if self.is_excluded_aggressive(file_path):
+            return True
+        # must exist
+        try:
+            stat = os.stat(os.path.join(dir, file_path))
+        except OSError:
+            return True
+        return is_file_contents_excluded(dir, file_path, stat.st_size, stat.st_mtime_ns)
+
+    def is_directory_excluded(self, dir_name: str) -> bool:
+        """Whether filter_file drops every file under a directory with this name, so walks can skip it."""
+        return dir_name in self.exclude_dirs or dir_name in self.exclude_path_dirs
+
+
+@lru_cache(maxsize=32)
+def get_exclusion_matcher(
+    exclude_dirs: tuple[str, ...],
+    exclude_path_dirs: tuple[str, ...],
+    exclude_exts: tuple[str, ...],
+    exclude_substrings_aggressive: tuple[str, ...],
+) -> ExclusionMatcher:
+    return ExclusionMatcher(exclude_dirs, exclude_path_dirs, exclude_exts, exclude_substrings_aggressive)
+
+
+@lru_cache(maxsize=MAX_MEMOIZED_PATHS)
+def is_file_contents_excluded(dir: str, file_path: str, size: int, mtime_ns: int) -> bool:
+    """The content rules of SweepConfig.is_file_excluded_aggressive, memoized until the file changes."""
+    full_path = os.path.join(dir, file_path)
+    if size > 240000 or size < 5:
+        return True
+    # exclude binary 
+    with open(full_path, "rb") as f:
+        if b"\0" in f.read():
+            return True
+    try:
+        # fetch file
+        data = read_file_with_fallback_encodings(full_path)
+    except UnicodeDecodeError:
+        logger.warning(f"UnicodeDecodeError in is_file_excluded_aggressive: {full_path}, skipping")
+        return True
+    line_count = len(data.split("\n"))
+    # if average line length is greater than 200, then it is likely not human readable
+    if len(data)/line_count > 200:
+        return True
+    # check if file is autogenerated
+    return is_generated(file_path, data)
 
 
 class SweepConfig(BaseModel):
@@ -146,6 +242,9 @@ class SweepConfig(BaseModel):
         "webp",
         "png"
     ]
+    # the rules exclusion_matcher was built from, since multi_get_top_k_snippets extends exclude_dirs in place
+    _exclusion_rules: tuple[list[str], ...] | None = PrivateAttr(default=None)
+    _exclusion_matcher: ExclusionMatcher | None = PrivateAttr(default=None)
 
     def to_yaml(self) -> str:
         return yaml.safe_dump(self.dict())
@@ -236,73 +335,26 @@ class SweepConfig(BaseModel):
             logger.warning(f"Error when getting draft: {e}, returning False")
             return False
     
+    @property
+    def exclusion_matcher(self) -> ExclusionMatcher:
+        rules = (self.exclude_dirs, self.exclude_path_dirs, self.exclude_exts, self.exclude_substrings_aggressive)
+        # read from the private dict directly since pydantic's private attribute lookup costs more than the match,
+        # and compare against a copy of the rules since it's much cheaper than rebuilding the key on every call
+        private_attributes = self.__pydantic_private__
+        if private_attributes["_exclusion_rules"] != rules:
+            private_attributes.update(
+                _exclusion_matcher=get_exclusion_matcher(*(tuple(rule) for rule in rules)),
+                _exclusion_rules=tuple(list(rule) for rule in rules),
+            )
+        return private_attributes["_exclusion_matcher"]
+
     # returns if file is excluded or not
     def is_file_excluded(self, file_path: str) -> bool:
-        parts = file_path.split(os.path.sep)
-        for i, part in enumerate(parts):
-            if part in self.exclude_dirs:
-                return True
-            # check extension of file
-            if i == len(parts) - 1:
-                for ext in self.exclude_exts:
-                    if part.endswith(ext):
-                        return True
-                # if there is not extension, then it is likely bad
-                if "." not in part:
-                    return True
-        return False
+        return self.exclusion_matcher.is_excluded(file_path)
     
     # returns if file is excluded or not, this version may drop actual relevant files
     def is_file_excluded_aggressive(self, dir: str, file_path: str) -> bool:
-        # tiktoken_client = Tiktoken()
-        # must exist
-        if not os.path.exists(os.path.join(dir, file_path)) and not os.path.exists(file_path):
-            return True
-        full_path = os.path.join(dir, file_path)
-        if os.stat(full_path).st_size > 240000 or os.stat(full_path).st_size < 5:
-            return True
-        # exclude binary 
-        with open(full_path, "rb") as f:
-            is_binary = False
-            for block in iter(lambda: f.read(1024), b""):
-                if b"\0" in block:
-                    is_binary = True
-                    break
-            if is_binary:
-                return True
-        try:
-            # fetch file
-            data = read_file_with_fallback_encodings(full_path)
-            lines = data.split("\n")
-        except UnicodeDecodeError:
-            logger.warning(f"UnicodeDecodeError in is_file_excluded_aggressive: {full_path}, skipping")
-            return True
-        line_count = len(lines)
-        # if average line length is greater than 200, then it is likely not human readable
-        if len(data)/line_count > 200:
-            return True
-    
-        # check token density, if it is greater than 2, then it is likely not human readable
-        # token_count = tiktoken_client.count(data)
-        # if token_count == 0:
-        #     return True
-        # if len(data)/token_count < 2:
-        #     return True
-        
-        # now check the file name
-        parts = file_path.split(os.path.sep)
-        for part in parts:
-            if part in self.exclude_dirs or part in self.exclude_exts:
-                return True
-        for part in self.exclude_substrings_aggressive:
-            if part in file_path:
-                return True
-            
-        # check if file is autogenerated
-        auto_generated, _ = self.is_file_auto_generated(file_path)
-        if auto_generated:
-            return True
-        return False
+        return self.exclusion_matcher.is_file_excluded_aggressive(dir, file_path)
     
     # checks the actual context of a file to see if it is suitable for sweep or not
     # for example checks for size and composition of the file_contents
@@ -328,46 +380,46 @@ class SweepConfig(BaseModel):
             return False, "This file was determined to be non human readable due to the average line length."
         return True, ""
     
-    def is_file_bad(self, file_name: str, repo_dir: str) -> tuple[bool, str]:
+    def is_file_bad(self, file_name: str, repo_dir: str, file_contents: str | None = None) -> tuple[bool, str]:
         """
-        Uses github-linguist to determine if a file is "good" or not
+        Uses github-linguist's heuristics to determine if a file is "good" or not
         """
-        generated = False
-        try:
-            query = ["github-linguist", file_name, "-j"]
-            response = subprocess.run(
-                " ".join(query),
-                shell=True,
-                capture_output=True,
-                text=True,
-                cwd=repo_dir,
-            )
-            result = json.loads(response.stdout)
-            type = result[file_name]["type"]
-            generated = result[file_name]['generated']
-            language = result[file_name]["language"]
+        return self.are_files_bad([file_name], repo_dir, {file_name: file_contents} if file_contents is not None else None)[file_name]
+
+    def are_files_bad(self, file_names: list[str], repo_dir: str, file_contents: dict[str, str] | None = None) -> dict[str, tuple[bool, str]]:
+        """
+        Batch version of is_file_bad, file_contents overrides reading the files from repo_dir
+        """
+        results = {file_name: (False, "") for file_name in file_names}
+        files = {}
+        for file_name in file_names:
+            try:
+                if file_contents and file_name in file_contents:
+                    files[file_name] = file_contents[file_name].encode("utf-8")
+                else:
+                    with open(os.path.join(repo_dir, file_name), "rb") as f:
+                        files[file_name] = f.read()
+            except Exception as e:
+                logger.error(f"Error when checking if file {file_name} is autogenerated: {e}")
+                posthog.capture(
+                    "is_file_auto_generated_or_vendored", 
+                    "is_file_auto_generated_or_vendored error", 
+                    properties={"error": str(e), "file_name": file_name}
+                )
+        for file_name, result in classify_files(files).items():
+            if result.generated:
+                results[file_name] = True, "This file is likely an autogenerated file."
+            elif result.type != "Text":
+                results[file_name] = True, "This file is likely not a code file."
+            elif result.language in self.excluded_languages:
+                results[file_name] = True, f"This language for this file: {result.language} is usually not associated with coding."
+            elif result.language is None:
+                results[file_name] = True, "A valid programming language could not be determined for this file."
             # if there is a string of numbers in the file name that is more than 4 characters long, it is likely autogenerated
-            if generated:
-                return True, "This file is likely an autogenerated file."
-            if type != "Text":
-                return True, "This file is likely not a code file."
-            if language in self.excluded_languages:
-                return True, f"This language for this file: {language} is usually not associated with coding."
-            if language is None:
-                return True, "A valid programming language could not be determined for this file."
-            pattern = r'\d{5,}'
-            match = re.search(pattern, file_name)
-            if bool(match):
-                return True, "The filename means that this file is likely auto generated."
-        except Exception as e:
-            logger.error(f"Error when checking if file {file_name} is autogenerated: {e}, run `sudo apt-get install cmake pkg-config libicu-dev zlib1g-dev libcurl4-openssl-dev libssl-dev ruby-dev && gem install github-linguist`")
-            posthog.capture(
-                "is_file_auto_generated_or_vendored", 
-                "is_file_auto_generated_or_vendored error", 
-                properties={"error": str(e), "file_name": file_name}
-            )
-        return False, ""
-        
+            elif re.search(r'\d{5,}', file_name):
+                results[file_name] = True, "The filename means that this file is likely auto generated."
+        return results
+
 
 
 @lru_cache(maxsize=None)
@@ -0,0 +1,41 @@
+import os
+
+from sweepai.config.client import SweepConfig
+
+
+def test_exclusion_matcher():
+    # Given: The default config and one with an extra excluded directory
+    sweep_config = SweepConfig()
+    blocked_config = SweepConfig()
+    blocked_config.exclude_dirs += ["legacy"]
+
+    # When: We check paths against their exclusion rules
+    # Then: Verify the rules match the config they were built from
+    assert sweep_config.is_file_excluded("node_modules/react/index.js")
+    assert sweep_config.is_file_excluded("assets/logo.png")
+    assert sweep_config.is_file_excluded("Makefile")
+    assert not sweep_config.is_file_excluded("legacy/app.py")
+    assert blocked_config.is_file_excluded("legacy/app.py")
+    assert sweep_config.exclusion_matcher.is_filtered("web/dist/main.js")
+    assert not sweep_config.exclusion_matcher.is_filtered("src/build.py")
+    assert sweep_config.exclusion_matcher.is_filtered(os.path.join("src", "build"))
+    assert sweep_config.exclusion_matcher.is_excluded_aggressive("tests/test_app.py")
+    assert sweep_config.exclusion_matcher.is_excluded_aggressive("config/settings.json")
+    assert not sweep_config.exclusion_matcher.is_excluded_aggressive("src/app.py")
+    assert sweep_config.exclusion_matcher.is_directory_excluded("venv")
+    assert sweep_config.exclusion_matcher is SweepConfig().exclusion_matcher
+
+
+def test_is_file_excluded_aggressive_rechecks_changed_files(tmp_path):
+    # Given: A hand-written file that was already checked
+    sweep_config = SweepConfig()
+    (tmp_path / "app.py").write_text("def main():\n    return 1\n")
+    assert not sweep_config.is_file_excluded_aggressive(str(tmp_path), "app.py")
+
+    # When: It's overwritten with generated code
+    (tmp_path / "app.py").write_text("# Code generated by protoc. DO NOT EDIT.\ndef main():\n    return 2\n")
+    os.utime(tmp_path / "app.py", ns=(0, 1))
+
+    # Then: Verify the memoized result isn't reused, and missing files are excluded
+    assert sweep_config.is_file_excluded_aggressive(str(tmp_path), "app.py")
+    assert sweep_config.is_file_excluded_aggressive(str(tmp_path), "missing.py")
@@ -25,6 +25,8 @@ ENV = os.environ.get("ENV", "dev")
 BOT_TOKEN_NAME = "bot-token"
 
 GITHUB_BASE_URL = os.environ.get("GITHUB_BASE_URL", "https://api.github.com") # configure for enterprise
+# GET responses kept by CustomRequester to revalidate with ETags, 304s are free against the rate limit
+GITHUB_RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("GITHUB_RESPONSE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
 
 SWEEP_HEALTH_URL = os.environ.get("SWEEP_HEALTH_URL")
 DISCORD_STATUS_WEBHOOK_URL = os.environ.get("DISCORD_STATUS_WEBHOOK_URL")
@@ -153,6 +155,20 @@ RESEND_API_KEY = os.environ.get("RESEND_API_KEY", None)
 LOKI_URL = None
 
 FILE_CACHE_DISABLED = os.environ.get("FILE_CACHE_DISABLED", "true").lower() == "true"
+# limits for the file_cache decorator, across all functions
+FILE_CACHE_MAX_BYTES = int(os.environ.get("FILE_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+FILE_CACHE_MAX_ENTRIES = int(os.environ.get("FILE_CACHE_MAX_ENTRIES", 1_000_000))
+FILE_CACHE_COMPACTION_INTERVAL = int(os.environ.get("FILE_CACHE_COMPACTION_INTERVAL", 10 * 60)) # seconds
+# file_cache(redis=True) also shares entries between pods through Redis, larger results stay on local disk
+FILE_CACHE_REDIS_MAX_BYTES = int(os.environ.get("FILE_CACHE_REDIS_MAX_BYTES", 1024 * 1024)) # compressed
+FILE_CACHE_REDIS_TTL = int(os.environ.get("FILE_CACHE_REDIS_TTL", 7 * 24 * 60 * 60)) # seconds, unless the function sets a ttl
+# how repos are cloned: "full", "blobless" (--filter=blob:none, file contents are fetched on demand),
+# "shallow" (only the last REPO_CLONE_DEPTH commits) or "sparse" (blobless and skips SweepConfig.exclude_dirs)
+REPO_CLONE_STRATEGY = os.environ.get("REPO_CLONE_STRATEGY", "full")
+REPO_CLONE_DEPTH = int(os.environ.get("REPO_CLONE_DEPTH", 50))
+# ClonedRepo skips pulling a base checkout that was fetched more recently than this, in seconds
+REPO_FRESHNESS_WINDOW = int(os.environ.get("REPO_FRESHNESS_WINDOW", 30))
+REPO_LOCK_TIMEOUT = int(os.environ.get("REPO_LOCK_TIMEOUT", 10 * 60)) # seconds to wait for another clone or pull
 ENV = "prod" if GITHUB_BOT_USERNAME != TEST_BOT_NAME else "dev"
 
 PROGRESS_BASE_URL = os.environ.get(
@@ -190,6 +206,30 @@ BATCH_SIZE = int(
     os.environ.get("BATCH_SIZE", 64 if VOYAGE_API_KEY else 256) # Voyage only allows 128 items per batch and 120000 tokens per batch
 )
 
+# repos with at least this many snippets search embeddings with an approximate nearest neighbour index
+VECTOR_SEARCH_ANN_MIN_SNIPPETS = int(os.environ.get("VECTOR_SEARCH_ANN_MIN_SNIPPETS", 50_000))
+# number of snippets per query that get a vector score on the approximate path
+VECTOR_SEARCH_ANN_TOP_N = int(os.environ.get("VECTOR_SEARCH_ANN_TOP_N", 1000))
+# the per-commit embedding stores are evicted least recently used first beyond this many bytes on disk
+EMBEDDING_STORE_MAX_BYTES = int(os.environ.get("EMBEDDING_STORE_MAX_BYTES", 20 * 1024 ** 3))
+
+# "sliding" is the sequential bottom-up sliding window, "tournament" reranks independent windows concurrently and
+# is opt-in until it's evaluated on real queries
+LISTWISE_RERANK_MODE = os.environ.get("LISTWISE_RERANK_MODE", "sliding")
+LISTWISE_RERANK_CONCURRENCY = int(os.environ.get("LISTWISE_RERANK_CONCURRENCY", 8)) # concurrent LLM calls per rerank
+# multi_prep_snippets skips the rerankers when the fused search scores already separate the top k, and only
+# reranks snippets that could still reach the top k otherwise, see get_cascade_decision. Off by default, the
+# decisions are still logged so the thresholds can be tuned against labeled queries before enabling it
+CASCADE_RANKING_ENABLED = os.environ.get("CASCADE_RANKING_ENABLED", "false").lower() == "true"
+CASCADE_SKIP_MARGIN = float(os.environ.get("CASCADE_SKIP_MARGIN", 0.1)) # gap between the kth and k+1th scores over the top score
+CASCADE_MAX_ENTROPY = float(os.environ.get("CASCADE_MAX_ENTROPY", 0.9)) # normalized entropy of the top 2k scores
+CASCADE_SHRINK_RATIO = float(os.environ.get("CASCADE_SHRINK_RATIO", 0.5)) # fraction of the kth score a snippet needs to be reranked
+
+# concurrent Cohere and Voyage rerank calls for the same query within this window are sent as one request
+RERANK_BATCH_WINDOW = float(os.environ.get("RERANK_BATCH_WINDOW", 0.05)) # seconds
+RERANK_MAX_DOCUMENTS = int(os.environ.get("RERANK_MAX_DOCUMENTS", 1000)) # per request, Cohere's limit
+RERANK_CACHE_MAX_ENTRIES = int(os.environ.get("RERANK_CACHE_MAX_ENTRIES", 1_000_000)) # (query, document) scores kept in memory
+
 DEPLOYMENT_GHA_ENABLED = os.environ.get("DEPLOYMENT_GHA_ENABLED", "true").lower() == "true"
 
 JIRA_USER_NAME = os.environ.get("JIRA_USER_NAME", None)
@@ -0,0 +1,190 @@
+"""
+Approximate nearest neighbour search over L2-normalized embeddings, implemented with numpy only.
+"""
+import os
+import uuid
+
+import numpy as np
+from loguru import logger
+
+from sweepai.utils.timer import Timer
+
+ASSIGNMENT_BLOCK_SIZE = 16_384 # rows scored against the centroids at once, bounds peak memory
+
+
+def assign_to_centroids(matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], ASSIGNMENT_BLOCK_SIZE):
+        block = np.asarray(matrix[start : start + ASSIGNMENT_BLOCK_SIZE], dtype=np.float32)
+        assignments[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(
+    matrix: np.ndarray,
+    n_lists: int,
+    n_iterations: int = 10,
+    sample_size: int = 20_000,
+    seed: int = 0,
+) -> np.ndarray:
+    """Spherical k-means on a sample of the rows."""
+    rng = np.random.default_rng(seed)
+    sample_indices = rng.choice(matrix.shape[0], size=min(sample_size, matrix.shape[0]), replace=False)
+    sample = np.asarray(matrix[np.sort(sample_indices)], dtype=np.float32)
+    n_lists = min(n_lists, len(sample))
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+    for _ in range(n_iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_lists)
+        empty = counts == 0
+        # re-seed empty lists with random rows so every list stays useful
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = np.where(norms == 0, sums, sums / np.maximum(norms, 1e-12)).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index: k-means centroids partition the rows of an embedding matrix, and a query
+    is only scored exactly against the rows of its n_probe closest partitions.
+    Vectors are stored reordered by partition, so each probed partition is a contiguous slice.
+    """
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, row_ids: np.ndarray, offsets: np.ndarray, digest: str = ""):
+        self.centroids = centroids
+        self.vectors = vectors # rows of the original matrix grouped by list
+        self.row_ids = row_ids # vectors[j] is row row_ids[j] of the original matrix
+        self.offsets = offsets # vectors[offsets[i]:offsets[i + 1]] belong to list i
+        self.digest = digest # identifies the rows this index was built for
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(
+        cls,
+        matrix: np.ndarray,
+        n_lists: int | None = None,
+        centroids: np.ndarray | None = None, # reuse trained centroids, e.g. from the previous commit
+        digest: str = "",
+        seed: int = 0,
+    ) -> "IVFIndex":
+        with Timer() as timer:
+            if centroids is None:
+                n_lists = n_lists or max(1, int(4 * np.sqrt(matrix.shape[0])))
+                centroids = train_centroids(matrix, n_lists, seed=seed)
+            assignments = assign_to_centroids(matrix, centroids)
+            row_ids = np.argsort(assignments, kind="stable").astype(np.int32)
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(assignments, minlength=len(centroids))))).astype(np.int64)
+            vectors = np.asarray(matrix, dtype=np.float32)[row_ids]
+        logger.info(f"Built IVF index with {len(centroids)} lists over {matrix.shape[0]} rows in {timer.time_elapsed:.2f} seconds")
+        return cls(centroids, vectors, row_ids, offsets, digest)
+
+    def search(
+        self,
+        queries: np.ndarray,
+        top_n: int = 1000,
+        n_probe: int | None = None,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """For each normalized query, return the row indices and cosine similarities of its top_n candidates, best first."""
+        n_probe = min(self.n_lists, n_probe or max(8, self.n_lists // 10))
+        centroid_scores = queries @ self.centroids.T
+        results = []
+        for query, query_centroid_scores in zip(queries, centroid_scores):
+            probed_lists = np.argpartition(-query_centroid_scores, n_probe - 1)[:n_probe]
+            spans = [(self.offsets[i], self.offsets[i + 1]) for i in probed_lists]
+            scores = np.concatenate([self.vectors[start:end] @ query for start, end in spans])
+            positions = np.concatenate([np.arange(start, end) for start, end in spans])
+            if len(positions) > top_n:
+                top = np.argpartition(-scores, top_n - 1)[:top_n]
+                positions, scores = positions[top], scores[top]
+            order = np.argsort(-scores)
+            results.append((self.row_ids[positions[order]], scores[order]))
+        return results
+
+    def save(self, path: str):
+        # the vectors go in their own .npy so they can be memory-mapped on load, and the .npz names the one it was
+        # saved with, so replacing the .npz swaps both at once
+        directory, name = os.path.split(path)
+        generation = uuid.uuid4().hex
+        vectors_file = f"{name}.{generation}.vectors.npy"
+        np.save(os.path.join(directory, vectors_file), self.vectors)
+        temporary_path = f"{path}.{generation}.tmp"
+        np.savez(
+            f"{temporary_path}.npz",
+            centroids=self.centroids,
+            row_ids=self.row_ids,
+            offsets=self.offsets,
+            digest=np.array(self.digest),
+            vectors_file=np.array(vectors_file),
+        )
+        os.replace(f"{temporary_path}.npz", f"{path}.npz")
+        for file_name in os.listdir(directory or "."):
+            if file_name.startswith(f"{name}.") and file_name.endswith(".vectors.npy") and file_name != vectors_file:
+                try:
+                    os.remove(os.path.join(directory, file_name))
+                except OSError:
+                    pass
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex | None":
+        try:
+            with np.load(f"{path}.npz") as data:
+                vectors = np.load(os.path.join(os.path.dirname(path), str(data["vectors_file"])), mmap_mode="r")
+                index = cls(data["centroids"], vectors, data["row_ids"], data["offsets"], str(data["digest"]))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        if len(index.row_ids) != len(vectors):
+            return None
+        return index
+
+
+def exact_search(matrix: np.ndarray, queries: np.ndarray, top_n: int = 1000) -> list[np.ndarray]:
+    similarities = queries @ np.asarray(matrix, dtype=np.float32).T
+    top_n = min(top_n, similarities.shape[1])
+    results = []
+    for query_similarities in similarities:
+        top = np.argpartition(-query_similarities, top_n - 1)[:top_n]
+        results.append(top[np.argsort(-query_similarities[top])])
+    return results
+
+
+def recall_at_k(
+    index: IVFIndex,
+    matrix: np.ndarray,
+    queries: np.ndarray,
+    k: int = 100,
+    n_probe: int | None = None,
+) -> float:
+    """Fraction of the exact top k rows that the IVF index also returns in its top k, averaged over queries."""
+    exact_results = exact_search(matrix, queries, top_n=k)
+    approximate_results = index.search(queries, top_n=k, n_probe=n_probe)
+    recalls = [
+        len(set(exact.tolist()) & set(approximate.tolist())) / len(exact)
+        for exact, (approximate, _) in zip(exact_results, approximate_results)
+    ]
+    return float(np.mean(recalls))
+
+
+if __name__ == "__main__":
+    # compare recall and latency against exact search on synthetic clustered embeddings
+    import time
+    rng = np.random.default_rng(0)
+    cluster_centers = rng.normal(size=(2_000, 512)).astype(np.float32)
+    matrix = cluster_centers[rng.integers(0, len(cluster_centers), size=200_000)] + rng.normal(scale=0.6, size=(200_000, 512)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    queries = matrix[rng.integers(0, len(matrix), size=20)] + rng.normal(scale=0.3, size=(20, 512)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    index = IVFIndex.build(matrix)
+    for n_probe in (index.n_lists // 20, index.n_lists // 10, index.n_lists // 5, index.n_lists // 3):
+        start = time.time()
+        index.search(queries, top_n=1000, n_probe=n_probe)
+        approximate_time = time.time() - start
+        print(f"n_probe={n_probe}: recall@100={recall_at_k(index, matrix, queries, n_probe=n_probe):.3f}, {approximate_time / len(queries) * 1000:.1f}ms/query")
+    start = time.time()
+    exact_search(matrix, queries)
+    print(f"exact: {(time.time() - start) / len(queries) * 1000:.1f}ms/query")
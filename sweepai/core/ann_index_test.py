@@ -0,0 +1,59 @@
+import numpy as np
+
+from sweepai.core.ann_index import IVFIndex, exact_search, recall_at_k
+
+
+def make_clustered_embeddings(n_rows: int, n_clusters: int = 50, dimension: int = 64, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    cluster_centers = rng.normal(size=(n_clusters, dimension)).astype(np.float32)
+    matrix = cluster_centers[rng.integers(0, n_clusters, size=n_rows)] + rng.normal(scale=0.3, size=(n_rows, dimension)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    queries = matrix[rng.integers(0, n_rows, size=10)] + rng.normal(scale=0.1, size=(10, dimension)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return matrix, queries
+
+
+def test_recall_against_exact_search():
+    # Given: An IVF index over clustered embeddings
+    matrix, queries = make_clustered_embeddings(5_000)
+    index = IVFIndex.build(matrix)
+
+    # When: We compare its top 50 to exact search with the default and a full probe
+    default_recall = recall_at_k(index, matrix, queries, k=50)
+    full_recall = recall_at_k(index, matrix, queries, k=50, n_probe=index.n_lists)
+
+    # Then: Verify the approximate results are close, and exact when probing every list
+    assert default_recall >= 0.9
+    assert full_recall == 1.0
+
+
+def test_search_returns_sorted_cosine_similarities():
+    # Given: An IVF index over clustered embeddings
+    matrix, queries = make_clustered_embeddings(2_000)
+    index = IVFIndex.build(matrix)
+
+    # When: We search with a full probe
+    (row_ids, scores), *_ = index.search(queries, top_n=20, n_probe=index.n_lists)
+
+    # Then: Verify the scores are the similarities of the original rows, best first
+    assert len(row_ids) == 20
+    np.testing.assert_allclose(scores, matrix[row_ids] @ queries[0], rtol=1e-5)
+    assert np.all(np.diff(scores) <= 0)
+    assert row_ids.tolist() == exact_search(matrix, queries[:1], top_n=20)[0].tolist()
+
+
+def test_save_and_load(tmp_path):
+    # Given: A saved IVF index
+    matrix, queries = make_clustered_embeddings(1_000)
+    index = IVFIndex.build(matrix, digest="abc")
+    index.save(str(tmp_path / "index"))
+
+    # When: We load it back
+    loaded_index = IVFIndex.load(str(tmp_path / "index"))
+
+    # Then: Verify it is identical and missing indices load as None
+    assert loaded_index.digest == "abc"
+    for (row_ids, scores), (loaded_row_ids, loaded_scores) in zip(index.search(queries), loaded_index.search(queries)):
+        assert row_ids.tolist() == loaded_row_ids.tolist()
+        np.testing.assert_allclose(scores, loaded_scores)
+    assert IVFIndex.load(str(tmp_path / "missing")) is None
@@ -1,6 +1,5 @@
 from copy import deepcopy
 from math import log
-import subprocess
 import urllib
 from dataclasses import dataclass, field
 
@@ -13,6 +12,7 @@ from openai.types.beta.threads.run import Run
 from sweepai.config.client import SweepConfig
 from sweepai.core.chat import ChatGPT
 from sweepai.core.entities import Message, Snippet
+from sweepai.core.trigram_search import search_code
 from sweepai.logn.cache import file_cache
 from sweepai.utils.chat_logger import ChatLogger
 from sweepai.utils.convert_openai_anthropic import AnthropicFunctionCall, mock_function_calls_to_string
@@ -172,21 +172,8 @@ def escape_ripgrep(text):
     return text
 
 def run_ripgrep_command(code_entity, repo_dir, *args):
-    # Updated for the new context
-    rg_command = [
-        "rg",
-        "-n",
-        "-w",
-        "-i",
-        "-C=3",
-        "--heading",
-        code_entity,
-        repo_dir,
-    ]
-    result = subprocess.run(
-        " ".join(rg_command), text=True, shell=True, capture_output=True
-    )
-    return result.stdout
+    # same output as `rg -n -w -i -C=3 --heading code_entity repo_dir`, from the repo's trigram index
+    return search_code(repo_dir, code_entity, ignore_case=True, word=True, context=3, absolute_paths=True)
 
 @staticmethod
 def can_add_snippet(snippet: Snippet, current_snippets: list[Snippet]):
@@ -757,8 +744,7 @@ def handle_function_call(
         list(dict.fromkeys([snippet.file_path for snippet in repo_context_manager.current_top_snippets]))
     )
     if function_name == "code_search":
-        code_entity = f'"{function_input["code_entity"]}"'  # handles cases with two words
-        code_entity = escape_ripgrep(code_entity) # escape special characters
+        code_entity = escape_ripgrep(function_input["code_entity"]) # escape special characters
         try:
             rg_output = run_ripgrep_command(code_entity, repo_context_manager.cloned_repo.repo_dir)
             if rg_output:
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import hashlib
 import os
 import re
 from difflib import unified_diff
+from functools import lru_cache
 from typing import Any, ClassVar, Literal, Type, TypeVar
 from urllib.parse import quote
 
@@ -289,9 +291,28 @@ SNIPPET_FORMAT = """<snippet>
 </source>
 </snippet>"""
 
+@lru_cache(maxsize=128)
+def split_content_lines(content: str) -> tuple[str, ...]:
+    # snippets of the same file share one content string, so this only splits each file once
+    return tuple(content.splitlines())
+
+@lru_cache(maxsize=128)
+def count_content_lines(content: str) -> int:
+    return content.count("\n") + 1
+
+@lru_cache(maxsize=128)
+def get_content_digest(content: str) -> str:
+    return hashlib.blake2b(content.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+def restore_snippet(cls: Type[Snippet], content: str, start: int, end: int, file_path: str, score: float, type_name: str) -> Snippet:
+    return cls.model_construct(content=content, start=start, end=end, file_path=file_path, score=score, type_name=type_name)
+
 class Snippet(BaseModel):
     """
     Start and end refer to line numbers
+
+    content is the whole file; snippets of the same file should share one content string
+    (see intern_snippet_contents) and only materialize their lines in get_snippet.
     """
 
     content: str = Field(repr=False)
@@ -313,8 +334,19 @@ class Snippet(BaseModel):
     def __hash__(self):
         return hash((self.file_path, self.start, self.end))
 
+    def __reduce__(self):
+        # pickle as a plain tuple, pickle's memo then stores a content string shared by many snippets once
+        return (
+            restore_snippet,
+            (self.__class__, self.content, self.start, self.end, self.file_path, self.score, self.type_name),
+        )
+
+    def __cache_key__(self):
+        # used by file_cache, the digest is computed once per shared content string
+        return (self.file_path, self.start, self.end, self.score, self.type_name, get_content_digest(self.content))
+
     def get_snippet(self, add_ellipsis: bool = True, add_lines: bool = True):
-        lines = self.content.splitlines()
+        lines = split_content_lines(self.content)
         snippet = "\n".join(
             (f"{i + self.start}: {line}" if add_lines else line)
             for i, line in enumerate(lines[max(self.start - 1, 0) : self.end])
@@ -322,7 +354,7 @@ class Snippet(BaseModel):
         if add_ellipsis:
             if self.start > 1:
                 snippet = "...\n" + snippet
-            if self.end < self.content.count("\n") + 1:
+            if self.end < count_content_lines(self.content):
                 snippet = snippet + "\n..."
         return snippet
 
@@ -427,6 +459,16 @@ class Snippet(BaseModel):
             **kwargs,
         )
 
+def intern_snippet_contents(snippets: list[Snippet]) -> list[Snippet]:
+    """
+    Make snippets with equal content share one string, so caches and pickles store each file once
+    instead of once per snippet.
+    """
+    contents: dict[str, str] = {}
+    for snippet in snippets:
+        snippet.content = contents.setdefault(snippet.content, snippet.content)
+    return snippets
+
 def fuse_snippets(snippets: list[Snippet]) -> list[Snippet]:
     new_snippets = []
     for snippet in snippets:
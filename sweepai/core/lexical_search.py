@@ -1,9 +1,12 @@
 from collections.abc import Iterable
+from functools import lru_cache
 import multiprocessing
 import os
 import re
+import shutil
 import subprocess
 import time
+import uuid
 
 import tantivy
 from diskcache import Cache
@@ -13,17 +16,31 @@ from tqdm import tqdm
 from sweepai.utils.streamable_functions import streamable
 
 from sweepai.utils.timer import Timer
-from sweepai.config.server import CACHE_DIRECTORY, FILE_CACHE_DISABLED, REDIS_URL
-from sweepai.core.entities import Snippet
-from sweepai.core.repo_parsing_utils import directory_to_chunks
-from sweepai.core.vector_db import multi_get_query_texts_similarity
+from sweepai.config.server import (
+    CACHE_DIRECTORY,
+    FILE_CACHE_DISABLED,
+    REDIS_URL,
+    VECTOR_SEARCH_ANN_MIN_SNIPPETS,
+    VECTOR_SEARCH_ANN_TOP_N,
+)
+from sweepai.core.entities import Snippet, intern_snippet_contents
+from sweepai.core.repo_parsing_utils import directory_to_chunks, files_to_chunks, may_cross_file_threshold
+from sweepai.core.vector_db import multi_get_query_texts_similarity, multi_get_query_texts_top_similarities
+from sweepai.utils.code_validators import chunk_code
 from sweepai.dataclasses.files import Document
 from sweepai.config.client import SweepConfig
 
 token_cache = Cache(f'{CACHE_DIRECTORY}/token_cache') # we instantiate a singleton, diskcache will handle concurrency
-lexical_index_cache = Cache(f'{CACHE_DIRECTORY}/lexical_index_cache')
+LEXICAL_INDEX_DIRECTORY = f'{CACHE_DIRECTORY}/lexical_index_cache' # the persisted indices sit next to the cache's own files
+lexical_index_cache = Cache(LEXICAL_INDEX_DIRECTORY)
 snippets_cache = Cache(f'{CACHE_DIRECTORY}/snippets_cache')
-CACHE_VERSION = "v1.0.16"
+CACHE_VERSION = "v1.0.17"
+MAX_INCREMENTAL_COMMITS = 50 # how far back to look for a cached commit to update from
+MAX_LEXICAL_INDICES_PER_REPO = 5 # persisted indices kept per repo, each is a full copy of the repo's index
+ORPHANED_LEXICAL_INDEX_AGE = 60 * 60 # seconds before an index without a lexical_index_cache entry is removed
+LEXICAL_INDEX_NAME = re.compile(r".+_[0-9a-f]{40}_v.*") # get_lexical_cache_key
+MAX_INCREMENTAL_FILES = 1000 # beyond this many changed files a full rebuild is cheaper
+TOKENIZATION_POOL_MIN_CHARACTERS = 20_000_000 # below this, tokenizing in a process pool is slower
 
 if FILE_CACHE_DISABLED:
     redis_client = None
@@ -33,6 +50,7 @@ schema_builder = tantivy.SchemaBuilder()
 schema_builder.add_text_field("title", stored=True)
 schema_builder.add_text_field("body", stored=True)
 schema_builder.add_integer_field("doc_id", stored=True)
+schema_builder.add_text_field("file_path", tokenizer_name="raw") # used to delete a file's documents on incremental updates
 schema = schema_builder.build()
 # pylint: enable=no-member
 
@@ -41,24 +59,93 @@ redis_client = Redis.from_url(REDIS_URL) if REDIS_URL else None
 
 class CustomIndex:
     def __init__(self, cache_path: str = None):
-        os.makedirs(cache_path, exist_ok=True)
+        # when cache_path is set, add_documents persists the segments there so they can be reopened later
+        self.cache_path = cache_path
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
         self.index = tantivy.Index(schema) # pylint: disable=no-member
-    
-    def add_documents(self, documents: Iterable):
-        writer = self.index.writer()
+
+    @classmethod
+    def open(cls, cache_path: str) -> "CustomIndex | None":
+        """Reopen a persisted index read-only. Returns None if nothing was persisted at cache_path."""
+        if not cache_path or not os.path.isdir(cache_path):
+            return None
+        try:
+            custom_index = cls.__new__(cls)
+            custom_index.cache_path = cache_path
+            custom_index.index = tantivy.Index.open(cache_path) # pylint: disable=no-member
+            return custom_index
+        except Exception as e:
+            logger.warning(f"Failed to open lexical index at {cache_path}: {e}")
+            return None
+
+    def _write_documents(self, index, documents: Iterable, removed_file_paths: Iterable[str] = ()):
+        writer = index.writer()
+        for file_path in removed_file_paths:
+            writer.delete_documents("file_path", file_path)
         for doc_id, (title, text) in enumerate(documents):
             writer.add_document(
                 tantivy.Document( # pylint: disable=no-member
                     title=title,
                     body=text,
-                    doc_id=doc_id
+                    doc_id=doc_id,
+                    file_path=title.rsplit(":", 1)[0],
                 )
             )
         writer.commit()
+
+    def _publish(self, documents: list, removed_file_paths: Iterable[str] = (), base_cache_path: str = None):
+        # build in a private staging directory and atomically rename it into place, so concurrent
+        # webhook threads never see a half-written index and never contend on tantivy's writer lock
+        staging_path = f"{self.cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            if base_cache_path:
+                shutil.copytree(base_cache_path, staging_path)
+            else:
+                os.makedirs(staging_path)
+            staging_index = tantivy.Index(schema, path=staging_path) # pylint: disable=no-member
+            self._write_documents(staging_index, documents, removed_file_paths)
+            del staging_index
+            try:
+                os.rename(staging_path, self.cache_path)
+            except OSError:
+                # another thread or process published the same index first, reuse theirs
+                logger.info(f"Lexical index at {self.cache_path} already exists, reusing it")
+            self.index = tantivy.Index.open(self.cache_path) # pylint: disable=no-member
+        finally:
+            shutil.rmtree(staging_path, ignore_errors=True)
+
+    def add_documents(self, documents: Iterable):
+        if not self.cache_path:
+            self._write_documents(self.index, documents)
+            return
+        documents = list(documents) # may need to replay these into memory if persisting fails
+        try:
+            self._publish(documents)
+        except Exception as e:
+            logger.exception(f"Failed to persist lexical index to {self.cache_path}, falling back to in-memory: {e}")
+            self.cache_path = None
+            self.index = tantivy.Index(schema) # pylint: disable=no-member
+            self._write_documents(self.index, documents)
+
+    def update_documents(self, base_cache_path: str, removed_file_paths: Iterable[str], documents: Iterable) -> bool:
+        """Persist a copy of the index at base_cache_path with every document of removed_file_paths
+        replaced by documents. Returns False if the base index could not be reused."""
+        if not self.cache_path:
+            return False
+        try:
+            self._publish(list(documents), removed_file_paths=removed_file_paths, base_cache_path=base_cache_path)
+            return True
+        except Exception as e:
+            logger.exception(f"Failed to update lexical index {base_cache_path} into {self.cache_path}: {e}")
+            self.cache_path = None
+            return False
     
     def search_index(self, query: str) -> list[tuple[str, float, dict]]:
         query = tokenize_code(query)
-        query = self.index.parse_query(query)
+        return self.search_parsed_query(self.index.parse_query(query))
+
+    def search_parsed_query(self, query) -> list[tuple[str, float, dict]]:
         searcher = self.index.searcher() # for some reason, the first searcher is empty
         for i in range(100):
             searcher = self.index.searcher()
@@ -72,28 +159,54 @@ class CustomIndex:
         return [(searcher.doc(doc_id)["title"][0], score, searcher.doc(doc_id)) for score, doc_id in results]
 
 
+class OverlayIndex:
+    """
+    Read-only view of a base CustomIndex where a few files are replaced or removed.
+    Base hits for overlaid files are excluded and a small in-memory index answers for their new contents,
+    so the base index and the working tree are never touched. BM25 statistics of the overlay come from
+    the overlay documents alone, so their scores are only approximately comparable to base scores.
+    """
+    def __init__(self, base_index: CustomIndex, overlay_file_paths: Iterable[str], documents: list[tuple[str, str]]):
+        self.base_index = base_index
+        self.overlay_file_paths = sorted(set(overlay_file_paths))
+        self.overlay_index = None
+        if documents:
+            self.overlay_index = CustomIndex()
+            self.overlay_index.add_documents(documents)
+
+    def search_index(self, query: str) -> list[tuple[str, float, dict]]:
+        query = tokenize_code(query)
+        base_query = self.base_index.index.parse_query(query)
+        if self.overlay_file_paths:
+            base_query = tantivy.Query.boolean_query([ # pylint: disable=no-member
+                (tantivy.Occur.Must, base_query), # pylint: disable=no-member
+                (tantivy.Occur.MustNot, tantivy.Query.term_set_query(schema, "file_path", self.overlay_file_paths)), # pylint: disable=no-member
+            ])
+        results = self.base_index.search_parsed_query(base_query)
+        if self.overlay_index is not None:
+            results += self.overlay_index.search_index(query)
+        return sorted(results, key=lambda result: result[1], reverse=True)[:200]
+
+
 variable_pattern = re.compile(r"([A-Z][a-z]+|[a-z]+|[A-Z]+(?=[A-Z]|$))")
+# Equivalent to matching variable_pattern against each "_"-separated section of every word
+# (\b\w{2,}\b) of the code, in a single pass over the whole code: an uppercase run ends a section
+# where the next character is "_", a non-word character or the end of the code.
+# Parts of a single letter are never kept, so they are not matched at all.
+sub_token_pattern = re.compile(r"[A-Z][a-z]+|[a-z]{2,}|[A-Z]{2,}(?=[A-Z_]|\W|\Z)")
+
+
+@lru_cache(maxsize=65_536)
+def normalize_sub_token(part: str) -> str | None:
+    # parts only contain ASCII letters, so they always have more than half alphanumeric characters;
+    # drop parts where the ratio of characters to unique characters is 4 or more (e.g. "aaaa")
+    if len(part) / len(set(part)) < 4:
+        return part.lower()
+    return None
 
 
 def tokenize_code(code: str) -> str:
-    matches = re.finditer(r"\b\w{2,}\b", code)
-    tokens = []
-    for m in matches:
-        text = m.group()
-
-        for section in text.split("_"):
-            for part in variable_pattern.findall(section):
-                if len(part) < 2:
-                    continue
-                # if len(part) < 5:
-                #     tokens.append(part.lower())
-                # if more than half of the characters are letters 
-                # and the ratio of unique characters to the number of characters is less than 5
-                if sum(1 for c in part if 'a' <= c <= 'z' or 'A' <= c <= 'Z' or '0' <= c <= '9') > len(part) // 2 \
-                    and len(part) / len(set(part)) < 4:
-                    tokens.append(part.lower())
-    
-    return " ".join(tokens)
+    return " ".join(filter(None, map(normalize_sub_token, sub_token_pattern.findall(code))))
 
 def snippets_to_docs(snippets: list[Snippet], len_repo_cache_dir):
     docs = []
@@ -107,6 +220,36 @@ def snippets_to_docs(snippets: list[Snippet], len_repo_cache_dir):
     return docs
 
 
+def tokenize_documents(all_docs: list[Document]) -> list[str]:
+    all_tokens = []
+    for doc in all_docs:
+        all_tokens.append(token_cache.get(doc.content + CACHE_VERSION))
+    # identical snippets, e.g. from vendored copies of a file, are only tokenized once
+    missed_contents = list(dict.fromkeys(doc.content for doc, token in zip(all_docs, all_tokens) if token is None))
+    workers = multiprocessing.cpu_count() // 2
+    if workers > 1 and sum(len(content) for content in missed_contents) >= TOKENIZATION_POOL_MIN_CHARACTERS:
+        with multiprocessing.Pool(processes=multiprocessing.cpu_count() // 2) as p:
+            missed_tokens = p.map(
+                tokenize_code,
+                tqdm(
+                    missed_contents,
+                    total=len(missed_contents),
+                    desc="Tokenizing documents"
+                )
+            )
+    else:
+        missed_tokens = [
+            tokenize_code(content) for content in missed_contents
+        ]
+    content_to_tokens = dict(zip(missed_contents, missed_tokens))
+    for content, token in content_to_tokens.items():
+        token_cache[content + CACHE_VERSION] = token
+    for i, doc in enumerate(all_docs):
+        if all_tokens[i] is None:
+            all_tokens[i] = content_to_tokens[doc.content]
+    return all_tokens
+
+
 @streamable
 def prepare_index_from_snippets(
     snippets: list[Snippet],
@@ -121,30 +264,9 @@ def prepare_index_from_snippets(
         cache_path=cache_path
     )
     yield "Tokenizing documents...", index
-    all_tokens = []
     try:
         with Timer() as timer:
-            for doc in all_docs:
-                all_tokens.append(token_cache.get(doc.content + CACHE_VERSION))
-            misses = [i for i, token in enumerate(all_tokens) if token is None]
-            workers = multiprocessing.cpu_count() // 2
-            if workers > 1:
-                with multiprocessing.Pool(processes=multiprocessing.cpu_count() // 2) as p:
-                    missed_tokens = p.map(
-                        tokenize_code,
-                        tqdm(
-                            [all_docs[i].content for i in misses],
-                            total=len(misses),
-                            desc="Tokenizing documents"
-                        )
-                    )
-            else:
-                missed_tokens = [
-                    tokenize_code(all_docs[i].content) for i in misses
-                ]
-            for i, token in enumerate(missed_tokens):
-                all_tokens[misses[i]] = token
-                token_cache[all_docs[misses[i]].content + CACHE_VERSION] = token
+            all_tokens = tokenize_documents(all_docs)
         logger.debug(f"Tokenizing documents took {timer.time_elapsed} seconds")
         yield "Building lexical index...", index
         all_titles = [doc.title for doc in all_docs]
@@ -160,7 +282,7 @@ def prepare_index_from_snippets(
     return index
 
 
-def search_index(query: str, index: CustomIndex):
+def search_index(query: str, index: CustomIndex | OverlayIndex):
     """Search the index based on a query.
 
     This function takes a query and an index as input and returns a dictionary of document IDs
@@ -188,7 +310,12 @@ SNIPPET_FORMAT = """File path: {file_path}
 {contents}"""
 
 # @file_cache(ignore_params=["snippets"])
-def compute_vector_search_scores(queries: list[str], snippets: list[Snippet]):
+def compute_vector_search_scores(
+    queries: list[str],
+    snippets: list[Snippet],
+    repo_directory: str | None = None, # if set, embeddings are kept in a per-commit store for this repo
+    seed: str = "",
+):
     # get get dict of snippet to score
     with Timer() as timer:
         snippet_str_to_contents = {
@@ -200,10 +327,26 @@ def compute_vector_search_scores(queries: list[str], snippets: list[Snippet]):
         }
     logger.info(f"Snippet to contents took {timer.time_elapsed:.2f} seconds")
     snippet_contents_array = list(snippet_str_to_contents.values())
+    store_key, base_store_keys = None, []
+    if repo_directory:
+        store_key = get_lexical_cache_key(repo_directory, seed=seed)
+        base_store_keys = [
+            get_lexical_cache_key(repo_directory, commit_hash=commit_hash, seed=seed)
+            for commit_hash in get_ancestor_commits(repo_directory)
+        ]
+    snippet_denotations = list(snippet_str_to_contents.keys())
+    if store_key and len(snippet_contents_array) >= VECTOR_SEARCH_ANN_MIN_SNIPPETS:
+        # large repos only score the approximate top snippets per query, the rest are missing from the dicts
+        multi_query_top_similarities = multi_get_query_texts_top_similarities(
+            queries, snippet_contents_array, store_key, base_store_keys=base_store_keys, top_n=VECTOR_SEARCH_ANN_TOP_N
+        )
+        return [{
+            snippet_denotations[i]: score
+            for i, score in query_top_similarities.items()
+        } for query_top_similarities in multi_query_top_similarities]
     multi_query_snippet_similarities = multi_get_query_texts_similarity(
-        queries, snippet_contents_array
+        queries, snippet_contents_array, store_key=store_key, base_store_keys=base_store_keys
     )
-    snippet_denotations = [snippet.denotation for snippet in snippets]
     snippet_denotation_to_scores = [{
         snippet_denotations[i]: score
         for i, score in enumerate(query_snippet_similarities)
@@ -219,6 +362,183 @@ def get_lexical_cache_key(
     repo_directory = os.path.basename(repo_directory)
     return f"{repo_directory}_{commit_hash}_{CACHE_VERSION}_{seed}"
 
+def overlay_lexical_search_index(
+    repo_directory: str,
+    snippets: list[Snippet],
+    index: CustomIndex,
+    overlay_files: dict[str, str | None],
+) -> tuple[list[Snippet], OverlayIndex]:
+    """
+    Answer queries as if the files in overlay_files (paths relative to repo_directory) had the given
+    contents, None meaning the file was removed. Only the overlaid files are chunked and tokenized.
+    """
+    len_repo_cache_dir = len(repo_directory) + 1
+    overlay_snippets = []
+    for file_path, file_contents in overlay_files.items():
+        if file_contents:
+            overlay_snippets.extend(chunk_code(file_contents, path=os.path.join(repo_directory, file_path)))
+    union_snippets = [
+        snippet for snippet in snippets
+        if snippet.file_path[len_repo_cache_dir:] not in overlay_files
+    ] + overlay_snippets
+    overlay_docs = snippets_to_docs(overlay_snippets, len_repo_cache_dir)
+    overlay_index = OverlayIndex(
+        index,
+        overlay_files.keys(),
+        [(doc.title, tokenize_code(doc.content)) for doc in overlay_docs],
+    )
+    return union_snippets, overlay_index
+
+def get_lexical_cache_path(lexical_cache_key: str) -> str:
+    return f"{LEXICAL_INDEX_DIRECTORY}/{lexical_cache_key}"
+
+def remove_lexical_index(lexical_cache_key: str):
+    # the entry goes first so nobody opens the index while it's being removed
+    lexical_index_cache.delete(lexical_cache_key)
+    shutil.rmtree(get_lexical_cache_path(lexical_cache_key), ignore_errors=True)
+    logger.info(f"Removed persisted lexical index {lexical_cache_key}")
+
+def prune_lexical_indices(repo_directory: str, lexical_cache_key: str):
+    """
+    Remove the persisted indices of this repo beyond the MAX_LEXICAL_INDICES_PER_REPO most recently used, and the
+    indices of any repo whose lexical_index_cache entry was evicted. lexical_cache_key's index is always kept.
+    """
+    repo_index_name = re.compile(rf"{re.escape(os.path.basename(repo_directory))}_[0-9a-f]{{40}}_.*")
+    repo_indices = []
+    now = time.time()
+    try:
+        entries = list(os.scandir(LEXICAL_INDEX_DIRECTORY))
+    except OSError:
+        return
+    for entry in entries:
+        # staging directories end with .tmp and clean up after themselves
+        if (
+            entry.name == lexical_cache_key
+            or entry.name.endswith(".tmp")
+            or not LEXICAL_INDEX_NAME.fullmatch(entry.name)
+            or not entry.is_dir(follow_symlinks=False)
+        ):
+            continue
+        try:
+            last_used = entry.stat().st_mtime
+        except OSError:
+            continue
+        if entry.name not in lexical_index_cache:
+            # the entry is written right after the index is published, so only old ones are orphans
+            if now - last_used > ORPHANED_LEXICAL_INDEX_AGE:
+                remove_lexical_index(entry.name)
+        elif repo_index_name.fullmatch(entry.name):
+            repo_indices.append((last_used, entry.name))
+    repo_indices.sort(reverse=True)
+    for _, old_cache_key in repo_indices[MAX_LEXICAL_INDICES_PER_REPO - 1:]:
+        remove_lexical_index(old_cache_key)
+
+def load_cached_snippets(lexical_cache_key: str, repo_directory: str) -> tuple[list[Snippet], list[str]] | None:
+    """
+    Cache keys only use the repo directory's basename, so the snippets may come from another checkout of the
+    same commit (e.g. the shared cached_dir instead of a per-request repo_dir). Rebase their paths onto repo_directory.
+    """
+    snippets_results = snippets_cache.get(lexical_cache_key)
+    if snippets_results is None or len(snippets_results) != 3:
+        return None
+    snippets, file_list, cached_repo_directory = snippets_results
+    if cached_repo_directory != repo_directory:
+        len_cached_repo_directory = len(cached_repo_directory) + 1
+        for snippet in snippets:
+            snippet.file_path = os.path.join(repo_directory, snippet.file_path[len_cached_repo_directory:])
+        file_list = [os.path.join(repo_directory, file_path[len_cached_repo_directory:]) for file_path in file_list]
+    return snippets, file_list
+
+def get_ancestor_commits(repo_directory: str) -> list[str]:
+    """The ancestors of HEAD within MAX_INCREMENTAL_COMMITS, newest first."""
+    rev_list = subprocess.run(
+        ["git", "rev-list", f"--max-count={MAX_INCREMENTAL_COMMITS}", "HEAD"],
+        cwd=repo_directory, capture_output=True, text=True
+    )
+    if rev_list.returncode != 0:
+        return []
+    return rev_list.stdout.split()[1:]
+
+def get_cached_ancestor_commit(repo_directory: str, seed: str = "") -> str | None:
+    """Find the newest ancestor of HEAD that already has cached snippets and a persisted lexical index."""
+    for commit_hash in get_ancestor_commits(repo_directory):
+        cached_key = get_lexical_cache_key(repo_directory, commit_hash=commit_hash, seed=seed)
+        if cached_key in snippets_cache and lexical_index_cache.get(cached_key):
+            return commit_hash
+    return None
+
+def get_changed_files(repo_directory: str, base_commit: str) -> list[str] | None:
+    """List the files that differ between base_commit and HEAD, relative to the repo root.
+    Renames are reported as a deletion plus an addition. Returns None if git can't diff the two."""
+    diff = subprocess.run(
+        ["git", "diff", "--name-status", "--no-renames", base_commit, "HEAD"],
+        cwd=repo_directory, capture_output=True, text=True
+    )
+    if diff.returncode != 0:
+        return None
+    changed_files = []
+    for line in diff.stdout.splitlines():
+        _status, _, file_path = line.partition("\t")
+        if file_path:
+            changed_files.append(file_path)
+    return changed_files
+
+def update_lexical_search_index(
+    repo_directory: str,
+    sweep_config: SweepConfig,
+    lexical_cache_key: str,
+    seed: str = "",
+) -> tuple[list[Snippet], list[str], CustomIndex] | None:
+    """Build the snippets and index for HEAD from the newest cached ancestor commit by re-chunking
+    and re-indexing only the files changed since then. Returns None if a full rebuild is needed."""
+    base_commit = get_cached_ancestor_commit(repo_directory, seed=seed)
+    if base_commit is None:
+        return None
+    changed_files = get_changed_files(repo_directory, base_commit)
+    if changed_files is None or len(changed_files) > MAX_INCREMENTAL_FILES:
+        return None
+    base_key = get_lexical_cache_key(repo_directory, commit_hash=base_commit, seed=seed)
+    snippets_results = load_cached_snippets(base_key, repo_directory)
+    if snippets_results is None:
+        return None
+    base_snippets, base_file_list = snippets_results
+    if may_cross_file_threshold(repo_directory, [os.path.join(repo_directory, file_path) for file_path in changed_files]):
+        # a directory going over or under the threshold adds or drops files that didn't change
+        logger.info("Changed files may have moved a directory across the file threshold, rebuilding from scratch")
+        return None
+    logger.info(f"Updating lexical index from {base_key}, {len(changed_files)} files changed")
+
+    len_repo_cache_dir = len(repo_directory) + 1
+    changed_files_set = set(changed_files)
+    kept_snippets = [snippet for snippet in base_snippets if snippet.file_path[len_repo_cache_dir:] not in changed_files_set]
+    kept_file_list = [file_path for file_path in base_file_list if file_path[len_repo_cache_dir:] not in changed_files_set]
+    new_snippets, new_file_list = files_to_chunks(
+        repo_directory,
+        [
+            os.path.join(repo_directory, file_path)
+            for file_path in changed_files
+            if os.path.isfile(os.path.join(repo_directory, file_path))
+        ],
+        sweep_config,
+    )
+    new_docs = snippets_to_docs(new_snippets, len_repo_cache_dir)
+    new_tokens = tokenize_documents(new_docs)
+
+    cache_path = get_lexical_cache_path(lexical_cache_key)
+    index = CustomIndex(cache_path=cache_path)
+    if not index.update_documents(
+        get_lexical_cache_path(base_key),
+        changed_files,
+        zip([doc.title for doc in new_docs], new_tokens),
+    ):
+        return None
+    snippets = intern_snippet_contents(kept_snippets + new_snippets)
+    file_list = kept_file_list + new_file_list
+    snippets_cache[lexical_cache_key] = snippets, file_list, repo_directory
+    lexical_index_cache[lexical_cache_key] = cache_path
+    prune_lexical_indices(repo_directory, lexical_cache_key)
+    return snippets, file_list, index
+
 @streamable
 def prepare_lexical_search_index(
     repo_directory: str,
@@ -229,30 +549,48 @@ def prepare_lexical_search_index(
     lexical_cache_key = get_lexical_cache_key(repo_directory, seed=seed)
 
     yield "Collecting snippets...", [], None
-    snippets_results = snippets_cache.get(lexical_cache_key)
+    snippets_results = load_cached_snippets(lexical_cache_key, repo_directory)
+    index = None
+    if snippets_results is None and not do_not_use_file_cache:
+        with Timer() as timer:
+            incremental_results = update_lexical_search_index(
+                repo_directory, sweep_config, lexical_cache_key, seed=seed
+            )
+        if incremental_results is not None:
+            snippets, file_list, index = incremental_results
+            snippets_results = snippets, file_list
+            logger.info(f"Incremental lexical index update took {timer.time_elapsed:.2f} seconds")
     if snippets_results is None:
         snippets, file_list = directory_to_chunks(
             repo_directory, sweep_config, do_not_use_file_cache=do_not_use_file_cache
         )
-        snippets_cache[lexical_cache_key] = snippets, file_list
+        intern_snippet_contents(snippets)
+        snippets_cache[lexical_cache_key] = snippets, file_list, repo_directory
     else:
         snippets, file_list = snippets_results
 
     yield "Building index...", snippets, None
-    # for message, index in prepare_index_from_snippets.stream(
-    #     snippets,
-    #     len_repo_cache_dir=len(repo_directory) + 1,
-    #     do_not_use_file_cache=do_not_use_file_cache,
-    #     cache_path=f"{CACHE_DIRECTORY}/lexical_index_cache/{lexical_cache_key}"
-    # ):
-    #     yield message, index
-    index = prepare_index_from_snippets(
-        snippets,
-        len_repo_cache_dir=len(repo_directory) + 1,
-        do_not_use_file_cache=do_not_use_file_cache,
-        cache_path=f"{CACHE_DIRECTORY}/lexical_index_cache/{lexical_cache_key}"
-    )
-        # yield message, index
+    # persisted indices are only written for cacheable requests, one-off indices (e.g. seeded reviews) stay in memory
+    cache_path = None if do_not_use_file_cache else get_lexical_cache_path(lexical_cache_key)
+    if index is None and cache_path and lexical_index_cache.get(lexical_cache_key):
+        index = CustomIndex.open(cache_path)
+        if index is not None:
+            logger.info(f"Reusing persisted lexical index for {lexical_cache_key}")
+            try:
+                # the mtime is the last use for prune_lexical_indices
+                os.utime(cache_path)
+            except OSError:
+                pass
+    if index is None:
+        index = prepare_index_from_snippets(
+            snippets,
+            len_repo_cache_dir=len(repo_directory) + 1,
+            do_not_use_file_cache=do_not_use_file_cache,
+            cache_path=cache_path
+        )
+        if index is not None and index.cache_path:
+            lexical_index_cache[lexical_cache_key] = index.cache_path
+            prune_lexical_indices(repo_directory, lexical_cache_key)
     
     yield "Lexical index built.", snippets, index
 
@@ -0,0 +1,30 @@
+import os
+import time
+
+from diskcache import Cache
+
+from sweepai.core import lexical_search
+from sweepai.core.lexical_search import get_lexical_cache_key, prune_lexical_indices
+
+
+def test_prune_lexical_indices(tmp_path, monkeypatch):
+    # Given: Persisted indices for seven commits of a repo, one of another repo, and one whose cache entry was evicted
+    monkeypatch.setattr(lexical_search, "LEXICAL_INDEX_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(lexical_search, "lexical_index_cache", Cache(str(tmp_path)))
+    repo_directory = "/tmp/cache/repos/sweep"
+    cache_keys = [get_lexical_cache_key(repo_directory, commit_hash=f"{i:040x}") for i in range(7)]
+    other_repo_key = get_lexical_cache_key("/tmp/cache/repos/sweep_docs", commit_hash="a" * 40)
+    evicted_key = get_lexical_cache_key("/tmp/cache/repos/docs", commit_hash="b" * 40)
+    for age, cache_key in enumerate(reversed([*cache_keys, other_repo_key, evicted_key])):
+        os.makedirs(tmp_path / cache_key)
+        os.utime(tmp_path / cache_key, (time.time() - 7200 - age, time.time() - 7200 - age))
+        if cache_key != evicted_key:
+            lexical_search.lexical_index_cache[cache_key] = str(tmp_path / cache_key)
+
+    # When: We prune after publishing the oldest commit's index again
+    prune_lexical_indices(repo_directory, cache_keys[0])
+
+    # Then: Verify it and the newest others of the repo are kept, and the evicted index is removed
+    kept_keys = {cache_keys[0], *cache_keys[-4:], other_repo_key}
+    assert {path.name for path in tmp_path.iterdir() if path.name in (*cache_keys, other_repo_key, evicted_key)} == kept_keys
+    assert all((cache_key in lexical_search.lexical_index_cache) == (cache_key in kept_keys) for cache_key in cache_keys)
@@ -1,17 +1,18 @@
-from hashlib import md5
+import io
 import multiprocessing
+from collections import Counter
 
 import os
 
 from loguru import logger
 from tqdm import tqdm
 
-from sweepai.config.client import SweepConfig
+from sweepai.config.client import ExclusionMatcher, SweepConfig
 from sweepai.config.server import CACHE_DIRECTORY
 from sweepai.core.entities import Snippet
-from sweepai.utils.file_utils import read_file_with_fallback_encodings
+from sweepai.utils.file_utils import get_blob_sha, read_file_with_fallback_encodings
 from sweepai.utils.tiktoken_utils import Tiktoken
-from sweepai.utils.code_validators import chunk_code
+from sweepai.utils.code_validators import chunk_code, extension_to_language
 from sweepai.utils.timer import Timer
 from diskcache import Cache
 
@@ -20,7 +21,13 @@ file_name_cache = Cache(f'{CACHE_DIRECTORY}/file_name_cache')
 
 tiktoken_client = Tiktoken()
 
-def filter_file(directory: str, file: str, sweep_config: SweepConfig) -> bool:
+def filter_file(
+    directory: str, file: str, sweep_config: SweepConfig, exclusion_matcher: ExclusionMatcher | None = None,
+) -> bool:
+    # the path rules go first, they're memoized in memory and the disk cache below doesn't know about config changes
+    exclusion_matcher = exclusion_matcher or sweep_config.exclusion_matcher
+    if exclusion_matcher.is_filtered(file[len(directory) + 1:]):
+        return False
     cache_key = directory + file
     if cache_key in file_name_cache:
         return file_name_cache[cache_key]
@@ -30,7 +37,8 @@ def filter_file(directory: str, file: str, sweep_config: SweepConfig) -> bool:
 
 def _filter_file(directory: str, file: str, sweep_config: SweepConfig) -> bool:
     """
-    Check if a file should be filtered based on its size and other criteria.
+    Check if a file should be filtered based on its size and other criteria. The path rules are in
+    ExclusionMatcher.is_filtered.
 
     Args:
         file (str): The path to the file.
@@ -39,18 +47,6 @@ def _filter_file(directory: str, file: str, sweep_config: SweepConfig) -> bool:
     Returns:
         bool: True if the file should be included, False otherwise.
     """
-    for ext in sweep_config.exclude_exts:
-        if file.endswith(ext):
-            return False
-    only_file_name = file[len(directory) + 1 :]
-    only_file_name_parts = only_file_name.split(os.path.sep)
-    for dir_name in sweep_config.exclude_dirs:
-        for file_part in only_file_name_parts[:-1]:
-            if file_part == dir_name:
-                return False
-    for dir_name in sweep_config.exclude_path_dirs:
-        if dir_name in only_file_name_parts:
-            return False
     try:
         size = os.stat(file).st_size
         if size > 240000 or size < 10:
@@ -88,20 +84,30 @@ def read_file(file_name: str) -> str:
 
 
 FILE_THRESHOLD = 240
+SKIPPED_DIRECTORY_NAMES = ("node_modules", ".venv", "build", "venv", "patch")
 
-def conditional_hash(contents: str):
-    if len(contents) > 255:
-        return md5(contents.encode()).hexdigest()
-    return contents
-
-def file_path_to_chunks(file_path: str) -> list[str]:
-    file_contents = read_file(file_path)
-    content_hash = conditional_hash(file_path + file_contents)
-    if content_hash in chunk_cache:
-        return chunk_cache[content_hash]
-    chunks = chunk_code(file_contents, path=file_path)
-    chunk_cache[content_hash] = chunks
-    return chunks
+def file_path_to_chunks(file_path: str) -> list[Snippet]:
+    """
+    Chunk a file, caching the chunk spans by the git blob sha of its contents and the language it is parsed as,
+    so identical files under other paths or in other branch checkouts only rewrite the snippets' file_path.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            data = f.read()
+        # decode like read_file does
+        file_contents = io.TextIOWrapper(io.BytesIO(data)).read()
+    except Exception:
+        data, file_contents = b"", ""
+    language = extension_to_language.get(file_path.split(".")[-1], "")
+    cache_key = (get_blob_sha(data), language)
+    spans = chunk_cache.get(cache_key)
+    if spans is None:
+        spans = [(chunk.start, chunk.end) for chunk in chunk_code(file_contents, path=file_path)]
+        chunk_cache[cache_key] = spans
+    return [
+        Snippet(content=file_contents, start=start, end=end, file_path=file_path)
+        for start, end in spans
+    ]
 
 
 # @file_cache()
@@ -111,11 +117,12 @@ def directory_to_chunks(
     # dir_file_count = {}
 
     logger.info(f"Reading files from {directory}")
+    exclusion_matcher = sweep_config.exclusion_matcher
     vis = set()
     # 81.5s -> 42.68
     def dfs(file_path: str = directory):
         only_file_name = os.path.basename(file_path)
-        if only_file_name in ("node_modules", ".venv", "build", "venv", "patch"):
+        if only_file_name in SKIPPED_DIRECTORY_NAMES:
             return
         if file_path in vis:
             return
@@ -127,7 +134,9 @@ def directory_to_chunks(
                     return
                 for entry in children:
                     if entry.is_dir(follow_symlinks=False):
-                        yield from dfs(entry.path)
+                        # filter_file would drop every file under it anyway
+                        if not exclusion_matcher.is_directory_excluded(entry.name):
+                            yield from dfs(entry.path)
                     else:
                         yield entry.path
         except NotADirectoryError:
@@ -137,7 +146,7 @@ def directory_to_chunks(
         file_list = [
             file_name
             for file_name in tqdm(file_list)
-            if filter_file(directory, file_name, sweep_config)
+            if filter_file(directory, file_name, sweep_config, exclusion_matcher)
             # and os.path.isfile(file_name) # should be unneeded
         ]
     logger.info("Done reading files")
@@ -147,6 +156,61 @@ def directory_to_chunks(
             all_chunks.extend(chunks)
     return all_chunks, file_list
 
+def is_file_walked(directory: str, file_path: str) -> bool:
+    """Whether directory_to_chunks' walk would reach file_path, used to keep partial re-chunking consistent."""
+    parent = os.path.dirname(file_path)
+    while len(parent) > len(directory):
+        if os.path.basename(parent) in SKIPPED_DIRECTORY_NAMES:
+            return False
+        try:
+            if len(os.listdir(parent)) > FILE_THRESHOLD:
+                return False
+        except OSError:
+            return False
+        parent = os.path.dirname(parent)
+    try:
+        return len(os.listdir(directory)) <= FILE_THRESHOLD
+    except OSError:
+        return False
+
+def may_cross_file_threshold(directory: str, file_paths: list[str]) -> bool:
+    """
+    Whether adding or removing file_paths could have moved a directory across FILE_THRESHOLD since the last walk, which
+    changes whether directory_to_chunks reads any file under it. Each path adds or removes at most one entry per
+    ancestor directory, so only directories within that many entries of the threshold are at risk.
+    """
+    changes_per_directory = Counter()
+    for file_path in file_paths:
+        parent = os.path.dirname(file_path)
+        while len(parent) > len(directory):
+            changes_per_directory[parent] += 1
+            parent = os.path.dirname(parent)
+        changes_per_directory[directory] += 1
+    for parent, num_changes in changes_per_directory.items():
+        try:
+            num_entries = len(os.listdir(parent))
+        except OSError:
+            continue # the directory was removed with every file in it
+        if FILE_THRESHOLD - num_changes < num_entries <= FILE_THRESHOLD + num_changes:
+            return True
+    return False
+
+def files_to_chunks(
+    directory: str, file_paths: list[str], sweep_config: SweepConfig,
+) -> tuple[list[Snippet], list[str]]:
+    """Chunk only the given files, applying the same filters as directory_to_chunks."""
+    exclusion_matcher = sweep_config.exclusion_matcher
+    file_list = [
+        file_path
+        for file_path in file_paths
+        if is_file_walked(directory, file_path)
+        and filter_file(directory, file_path, sweep_config, exclusion_matcher)
+    ]
+    all_chunks = []
+    for file_path in file_list:
+        all_chunks.extend(file_path_to_chunks(file_path))
+    return all_chunks, file_list
+
 if __name__ == "__main__":
     try:
         from sweepai.utils.github_utils import ClonedRepo, get_installation_id
@@ -0,0 +1,22 @@
+import os
+
+from sweepai.core.repo_parsing_utils import FILE_THRESHOLD, may_cross_file_threshold
+
+
+def test_may_cross_file_threshold(tmp_path):
+    # Given: A directory that just went over the file threshold and a small one next to it
+    directory = str(tmp_path)
+    os.makedirs(os.path.join(directory, "src", "generated"))
+    for i in range(FILE_THRESHOLD + 1):
+        open(os.path.join(directory, "src", "generated", f"model_{i}.py"), "w").close()
+    open(os.path.join(directory, "src", "main.py"), "w").close()
+
+    # When: We check files changed in each of them
+    crossing_change = [os.path.join(directory, "src", "generated", "model_0.py")]
+    small_change = [os.path.join(directory, "src", "main.py")]
+    removed_directory_change = [os.path.join(directory, "old", "util.py")]
+
+    # Then: Verify only the directory close enough to the threshold forces a rebuild
+    assert may_cross_file_threshold(directory, crossing_change)
+    assert not may_cross_file_threshold(directory, small_change)
+    assert not may_cross_file_threshold(directory, removed_directory_change)
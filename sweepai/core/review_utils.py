@@ -46,16 +46,15 @@ from sweepai.core.review_prompts import (
     comment_thread_format,
     comment_format,
 )
-from sweepai.dataclasses.codereview import CodeReview, CodeReviewByGroup, CodeReviewIssue, FunctionDef, GroupedFilesForReview, PRChange, PRReviewComment, PRReviewCommentThread, Patch
+from sweepai.dataclasses.codereview import CodeReview, CodeReviewByGroup, CodeReviewIssue, FunctionDef, GroupedFilesForReview, PRChange, PRFileDiff, PRReviewComment, PRReviewCommentThread, Patch
 from sweepai.logn.cache import file_cache
 from sweepai.utils.event_logger import logger, posthog
 from sweepai.utils.chat_logger import ChatLogger
 from github.Repository import Repository
 from github.PullRequest import PullRequest
 
-from sweepai.utils.file_utils import read_file_with_fallback_encodings, safe_decode
-from sweepai.utils.github_utils import ClonedRepo, MockClonedRepo, get_review_threads, update_file
-from sweepai.utils.hash import hash_sha256
+from sweepai.utils.file_utils import read_file_with_fallback_encodings, safe_decode, safe_decode_local
+from sweepai.utils.github_utils import ClonedRepo, MockClonedRepo, get_review_threads
 from sweepai.utils.str_utils import add_line_numbers, extract_object_fields_from_string, extract_objects_from_string, object_to_xml, objects_to_xml, remove_lines_from_text
 from sweepai.utils.ticket_rendering_utils import parse_issues_from_code_review
 from sweepai.utils.ticket_utils import get_top_k_snippets
@@ -99,18 +98,102 @@ def validate_diff(file_name: str, diff: str):
         return f"diff is over {MAX_DIFF_LENGTH}", False
     return "", True
 
-@file_cache()
+GIT_DIFF_STATUSES = {"A": "added", "M": "modified", "D": "removed", "R": "renamed", "C": "copied", "T": "changed"}
+
+def fetch_pr_commits(git_repo: git.Repo, pr: PullRequest) -> bool:
+    """Make sure the base and head commits of the PR are in the clone, returns whether they are."""
+    def has_commits():
+        try:
+            for sha in (pr.base.sha, pr.head.sha):
+                git_repo.git.cat_file("-e", f"{sha}^{{commit}}")
+            return True
+        except git.GitCommandError:
+            return False
+
+    if has_commits():
+        return True
+    # the head of a PR from a fork is only reachable from the PR ref
+    for refs in ((pr.base.sha, pr.head.sha), (pr.base.sha, f"pull/{pr.number}/head")):
+        try:
+            git_repo.git.fetch("origin", *refs)
+            if has_commits():
+                return True
+        except git.GitCommandError as e:
+            logger.warning(f"Could not fetch {refs} for PR {pr.number}: {e}")
+    return False
+
+def get_local_pr_file_diffs(git_repo: git.Repo, base_sha: str, head_sha: str) -> list[PRFileDiff]:
+    """The files of repo.compare(base_sha, head_sha), with one git diff for the statuses and one for the patches."""
+    diff_range = f"{base_sha}...{head_sha}"
+    diff_options = ["-M", "--no-color", "--no-ext-diff", "--no-textconv"]
+    fields = git_repo.git.diff("--name-status", "-z", *diff_options, diff_range).split("\0")
+    file_diffs = []
+    i = 0
+    while i < len(fields) and fields[i]:
+        status = fields[i]
+        if status[0] in "RC":
+            previous_filename, filename = fields[i + 1], fields[i + 2]
+            i += 3
+        else:
+            previous_filename, filename = None, fields[i + 1]
+            i += 2
+        file_diffs.append(PRFileDiff(
+            filename=filename,
+            status=GIT_DIFF_STATUSES.get(status[0], "modified"),
+            patch="",
+            previous_filename=previous_filename,
+        ))
+    # same file order as --name-status, every file pair starts with a diff --git header
+    patch_output = git_repo.git.diff(*diff_options, diff_range)
+    file_patches = re.split(r"^diff --git .*\n?", patch_output, flags=re.MULTILINE)[1:]
+    if len(file_patches) != len(file_diffs):
+        raise ValueError(f"Got {len(file_patches)} patches for {len(file_diffs)} files")
+    for file_diff, file_patch in zip(file_diffs, file_patches):
+        # like GitHub's patches, drop the extended header lines before the first hunk
+        hunks_start = re.search(r"^@@ ", file_patch, flags=re.MULTILINE)
+        file_diff.patch = file_patch[hunks_start.start():].rstrip("\n") if hunks_start else ""
+    return file_diffs
+
 def get_pr_changes(
     repo: Repository, 
     pr: PullRequest,
     cloned_repo: ClonedRepo
+) -> tuple[dict[str, PRChange], list[str], list[str]]:
+    # hashing the PyGithub objects reads their lazily fetched state, the PR's identity and commits are a stable key
+    return _get_pr_changes(repo, pr, cloned_repo, repo.full_name, pr.number, pr.base.sha, pr.head.sha)
+
+@file_cache(redis=True, ignore_params=["repo", "pr", "cloned_repo"])
+def _get_pr_changes(
+    repo: Repository,
+    pr: PullRequest,
+    cloned_repo: ClonedRepo,
+    repo_full_name: str,
+    pr_number: int,
+    base_sha: str,
+    head_sha: str,
 ) -> tuple[dict[str, PRChange], list[str], list[str]]:
     sweep_config: SweepConfig = SweepConfig()
-    base_sha = pr.base.sha
-    head_sha = pr.head.sha
 
-    comparison = repo.compare(base_sha, head_sha)
-    file_diffs = comparison.files
+    # diff and read files from the clone, one API call per file adds up to minutes on large PRs
+    git_repo = None
+    try:
+        if fetch_pr_commits(cloned_repo.git_repo, pr):
+            git_repo = cloned_repo.git_repo
+            file_diffs = get_local_pr_file_diffs(git_repo, base_sha, head_sha)
+    except Exception as e:
+        logger.warning(f"Could not diff PR {pr.number} locally, using the GitHub API: {e}")
+        git_repo = None
+    if git_repo is None:
+        comparison = repo.compare(base_sha, head_sha)
+        file_diffs = comparison.files
+
+    def get_file_contents(path: str, ref: str):
+        # files that can't be resolved locally fall back to the API
+        if git_repo is not None:
+            contents = safe_decode_local(git_repo, path, ref)
+            if contents is not None:
+                return contents
+        return safe_decode(repo=repo, path=path, ref=ref)
 
     pr_diffs = {}
     dropped_files = [] # files that were dropped due them being commonly ignored
@@ -142,7 +225,7 @@ def get_pr_changes(
             old_code = ""
         else:
             try:
-                old_code = safe_decode(repo=repo, path=previous_filename, ref=base_sha)
+                old_code = get_file_contents(previous_filename, base_sha)
                 if old_code is None:
                     raise UnsuitableFileException("Could not decode file")
             except Exception as e_:
@@ -153,7 +236,7 @@ def get_pr_changes(
             new_code = ""
         else:
             try:
-                new_code = safe_decode(repo=repo, path=file.filename, ref=head_sha)
+                new_code = get_file_contents(file.filename, head_sha)
                 if new_code is None:
                     raise UnsuitableFileException("Could not decode file")
             except Exception as e_:
@@ -169,9 +252,9 @@ def get_pr_changes(
                 e = UnsuitableFileException(reason)
                 unsuitable_files.append((file_name, e))
             else:
-                # final pass using github linguist to check if the file is bad or not
+                # final pass using github linguist's heuristics to check if the file is bad or not
                 auto_generated, reason = sweep_config.is_file_bad(
-                    file_name, cloned_repo.repo_dir
+                    file_name, cloned_repo.repo_dir, file_contents=new_code
                 )
                 if auto_generated:
                     errored = True
@@ -799,36 +882,21 @@ class PRReviewBot(ChatGPT):
             if "SWEEP.md" in file_name: # jank but temporary
                 continue
             comment_threads_string = formatted_comment_threads.get(file_name, "")
-            # keep copy of edited files to revert later
-            modified_files_dict: dict[str, dict[str, str]] = {}
-            modified_files_dict[file_name] = {"original": cloned_repo.get_file_contents(file_name)}
+            original_file_contents = cloned_repo.get_file_contents(file_name)
             repeated_functions_code_issues[file_name] = []
             # do a similarity search over the chunked code base to see if the function name matches anything
             for function in newly_created_functions:
                 # remove the function definition from the file to prevent biased results
-                modified_files_dict[file_name]["modified"] = remove_lines_from_text(
-                    modified_files_dict[file_name]["original"], start=int(function.start_line),end=int(function.end_line)
+                modified_file_contents = remove_lines_from_text(
+                    original_file_contents, start=int(function.start_line),end=int(function.end_line)
                 )
-                # now update the cloned repo file in both repo_dir
-                try:
-                    update_file(cloned_repo.repo_dir, file_name, modified_files_dict[file_name]["modified"])
-                except Exception as e:
-                    logger.error(f"Failure updating file {cloned_repo.repo_dir}{function.file_name}: {e}")
-                    posthog.capture(
-                        "identify_repeated_functions", 
-                        "identify_repeated_functions error updating", 
-                        properties={"error": str(e), "cloned_repo.repo_dir": cloned_repo.repo_dir, "file_name": function.file_name}
-                    )
-                    raise e
-                file_hash = hash_sha256(modified_files_dict[file_name]["modified"])
                 # get the top five snippets and then pass those into sweep to ask if there are any repeated function definitions
+                # the modified file is overlaid on the cached index, so nothing is written to disk or re-indexed
                 _, ranked_snippets, _, _ = get_top_k_snippets(
                     cloned_repo, 
                     function.function_code, 
                     k=3, 
-                    do_not_use_file_cache=True,
-                    use_repo_dir=True,
-                    seed=file_hash
+                    overlay_files={file_name: modified_file_contents},
                 )
                 formatted_code_snippets = "\n\n".join(
                     [f"<code_snippet file_name='{snippet.file_path}' snippet_index='{idx}'>\n{snippet.get_snippet()}\n</code_snippet>" for idx, snippet in enumerate(ranked_snippets)]
@@ -876,18 +944,6 @@ class PRReviewBot(ChatGPT):
                             line_number=function.start_line,
                         )
                         repeated_functions_code_issues[function.file_name].append(new_code_issue)
-
-                # now revert the cloned repo file - if this fails this can cause big issues
-                try:
-                    update_file(cloned_repo.repo_dir, file_name, modified_files_dict[file_name]["original"])
-                except Exception as e:
-                    logger.error(f"Failure updating file {cloned_repo.repo_dir}{function.file_name}: {e}")
-                    posthog.capture(
-                        "identify_repeated_functions", 
-                        "identify_repeated_functions error reverting", 
-                        properties={"error": str(e), "cloned_repo.repo_dir": cloned_repo.repo_dir, "file_name": function.file_name}
-                    )
-                    raise e
         return repeated_functions_code_issues
 
     # sorts issues by severity, potential issues are not sorted
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import git
+
+from sweepai.core import review_utils
+from sweepai.core.review_utils import get_local_pr_file_diffs, get_pr_changes, split_diff_into_patches
+from sweepai.utils.file_utils import safe_decode_local
+
+
+def commit_files(git_repo: git.Repo, files: dict[str, str | None], message: str) -> str:
+    for file_path, contents in files.items():
+        full_path = f"{git_repo.working_dir}/{file_path}"
+        if contents is None:
+            git_repo.index.remove([file_path], working_tree=True)
+            continue
+        with open(full_path, "w") as f:
+            f.write(contents)
+        git_repo.index.add([file_path])
+    return git_repo.index.commit(message).hexsha
+
+
+def test_get_local_pr_file_diffs(tmp_path):
+    # Given: A base commit and a head commit that adds, modifies, removes and renames files
+    git_repo = git.Repo.init(tmp_path)
+    long_file = "".join(f"line {i}\n" for i in range(40))
+    base_sha = commit_files(git_repo, {
+        "modified.py": "a = 1\nb = 2\n",
+        "removed.py": "c = 3\n",
+        "old_name.py": long_file,
+    }, "base")
+    git_repo.git.mv("old_name.py", "new_name.py")
+    head_sha = commit_files(git_repo, {
+        "modified.py": "a = 1\nb = 3\n",
+        "removed.py": None,
+        "added.py": "d = 4\n",
+        "new_name.py": long_file.replace("line 20\n", "line twenty\n"),
+    }, "head")
+
+    # When: We diff them locally
+    file_diffs = {file_diff.filename: file_diff for file_diff in get_local_pr_file_diffs(git_repo, base_sha, head_sha)}
+
+    # Then: Verify the statuses and patches match what GitHub's compare returns
+    assert {filename: file_diff.status for filename, file_diff in file_diffs.items()} == {
+        "added.py": "added",
+        "modified.py": "modified",
+        "removed.py": "removed",
+        "new_name.py": "renamed",
+    }
+    assert file_diffs["new_name.py"].previous_filename == "old_name.py"
+    assert file_diffs["modified.py"].patch == "@@ -1,2 +1,2 @@\n a = 1\n-b = 2\n+b = 3"
+    assert file_diffs["added.py"].patch == "@@ -0,0 +1 @@\n+d = 4"
+    assert len(split_diff_into_patches(file_diffs["new_name.py"].patch, "new_name.py")) == 1
+    assert safe_decode_local(git_repo, "old_name.py", base_sha) == long_file
+    assert safe_decode_local(git_repo, "added.py", head_sha) == "d = 4\n"
+    assert safe_decode_local(git_repo, "added.py", base_sha) is None
+
+
+def test_get_pr_changes_is_keyed_on_the_pr_commits(monkeypatch):
+    # Given: A PR whose PyGithub objects carry lazily fetched state that changes between requests
+    calls = []
+    monkeypatch.setattr(review_utils, "_get_pr_changes", lambda *args: calls.append(args[3:]))
+    repo = SimpleNamespace(full_name="sweepai/sweep", _rawData={"updated_at": "1"})
+    pr = SimpleNamespace(number=42, base=SimpleNamespace(sha="a" * 40), head=SimpleNamespace(sha="b" * 40), _rawData={})
+
+    # When: We get its changes
+    get_pr_changes(repo, pr, cloned_repo=None)
+
+    # Then: Verify the cached function gets the repo name, PR number and base and head commits as its key
+    assert calls == [("sweepai/sweep", 42, "a" * 40, "b" * 40)]
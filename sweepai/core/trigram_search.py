@@ -0,0 +1,548 @@
+"""
+In-process replacement for shelling out to ripgrep from the agents' code search tools. A trigram index of the files
+ripgrep would search is built once per commit from its git objects, or updated from an ancestor commit's index, and
+cached next to the lexical index. Queries use it to narrow down the candidate files, add the files edited in the
+working tree since the commit, and verify the matches with re against the files on disk. The first search of
+a commit starts the build in the background and runs rg until it's done, and repos too large to index always use rg.
+"""
+from array import array
+from collections import OrderedDict
+import os
+import re
+import subprocess
+import threading
+from typing import Iterable, Iterator, NamedTuple
+
+try:
+    from re import _parser as sre_parse
+except ImportError: # python < 3.11
+    import sre_parse
+
+from diskcache import Cache
+from loguru import logger
+
+from sweepai.config.server import CACHE_DIRECTORY
+from sweepai.core.lexical_search import get_ancestor_commits, get_changed_files, get_lexical_cache_key
+from sweepai.utils.timer import Timer
+
+trigram_index_cache = Cache(f"{CACHE_DIRECTORY}/trigram_index_cache")
+CACHE_VERSION = "v1.0.1"
+MAX_FILE_BYTES = 10_000_000 # larger files are almost always data dumps, ripgrep has no limit
+BINARY_CHECK_BYTES = 8000 # like git, a null byte in the first 8000 bytes means binary
+MAX_INCREMENTAL_FILES = 1000 # beyond this many changed files a full rebuild is cheaper
+MAX_REPLACED_FRACTION = 0.5 # rebuild once this fraction of the indexed files are stale copies of updated files
+MAX_LOADED_INDICES = 8 # indices kept in memory, each repo usually has one per open ticket
+MAX_CACHED_CHARACTERS = 200_000_000 # decoded file contents kept in memory for verifying matches
+MAX_INDEXED_CHARACTERS = 200_000_000 # larger repos are searched with rg, their index takes too long and too much memory
+
+
+def get_trigrams(text: str) -> set[str]:
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def get_sequence_literals(parsed_pattern) -> list[str]:
+    literals, current_literal = [], ""
+    for op, av in parsed_pattern:
+        if op is sre_parse.LITERAL:
+            current_literal += chr(av)
+            continue
+        literals.append(current_literal)
+        current_literal = ""
+        if op is sre_parse.SUBPATTERN:
+            literals.extend(get_sequence_literals(av[-1]))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            literals.extend(get_sequence_literals(av[2]))
+    literals.append(current_literal)
+    return literals
+
+
+def get_required_literals(pattern: str) -> list[str]:
+    """
+    Strings of at least three characters that every match of the regex contains. Alternations, optional parts
+    and character classes contribute nothing, so the result may be empty.
+    """
+    return [literal for literal in get_sequence_literals(sre_parse.parse(pattern)) if len(literal) >= 3]
+
+
+def is_searchable_path(file_path: str) -> bool:
+    # ripgrep skips hidden files and directories by default
+    return not any(part.startswith(".") for part in file_path.split("/"))
+
+
+def list_searchable_files(repo_dir: str) -> list[str]:
+    """The files ripgrep searches by default, relative to repo_dir: tracked or untracked but not ignored, and not hidden."""
+    ls_files = subprocess.run(
+        ["git", "ls-files", "--cached", "--others", "--exclude-standard", "-z"],
+        cwd=repo_dir, capture_output=True, text=True
+    )
+    if ls_files.returncode == 0:
+        file_paths = ls_files.stdout.split("\0")
+    else:
+        file_paths = []
+        for root, dirs, files in os.walk(repo_dir):
+            dirs[:] = [directory for directory in dirs if not directory.startswith(".")]
+            file_paths.extend(os.path.relpath(os.path.join(root, file), repo_dir) for file in files)
+    return sorted({file_path for file_path in file_paths if file_path and is_searchable_path(file_path)})
+
+
+def decode_searchable_data(data: bytes) -> str | None:
+    if b"\0" in data[:BINARY_CHECK_BYTES]:
+        return None
+    return data.decode("utf-8", errors="replace")
+
+
+def read_searchable_file(repo_dir: str, file_path: str) -> str | None:
+    full_path = os.path.join(repo_dir, file_path)
+    if not is_searchable_path(file_path) or os.path.islink(full_path):
+        return None
+    try:
+        if not os.path.isfile(full_path) or os.path.getsize(full_path) > MAX_FILE_BYTES:
+            return None
+        with open(full_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    return decode_searchable_data(data)
+
+
+def read_committed_files(repo_dir: str, commit_hash: str, file_paths: list[str] | None = None) -> Iterator[tuple[str, str]]:
+    """
+    The searchable files at commit_hash with their contents, read from git's objects since Sweep edits the working
+    tree in place. Limited to file_paths if given, the ones missing at commit_hash are skipped.
+    """
+    ls_tree = subprocess.run(
+        ["git", "ls-tree", "-r", "-z", "-l", "--full-tree", commit_hash, "--", *(file_paths or [])],
+        cwd=repo_dir, capture_output=True, text=True
+    )
+    if ls_tree.returncode != 0:
+        return
+    blobs = []
+    for entry in ls_tree.stdout.split("\0"):
+        if not entry:
+            continue
+        metadata, _, file_path = entry.partition("\t")
+        mode, object_type, object_name, size = metadata.split()
+        # symlinks and submodules are skipped like ripgrep does
+        if object_type == "blob" and mode != "120000" and int(size) <= MAX_FILE_BYTES and is_searchable_path(file_path):
+            blobs.append((file_path, object_name))
+    if not blobs:
+        return
+    cat_file = subprocess.Popen(["git", "cat-file", "--batch"], cwd=repo_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # written from another thread, cat-file blocks on a full stdout pipe before it reads all the names
+    def write_object_names():
+        try:
+            cat_file.stdin.write("".join(f"{object_name}\n" for _, object_name in blobs).encode())
+            cat_file.stdin.close()
+        except OSError:
+            pass
+
+    threading.Thread(target=write_object_names, daemon=True).start()
+    try:
+        for file_path, _ in blobs:
+            header = cat_file.stdout.readline().split()
+            if len(header) != 3:
+                continue # missing object
+            data = cat_file.stdout.read(int(header[2]))
+            cat_file.stdout.read(1) # trailing newline
+            contents = decode_searchable_data(data)
+            if contents is not None:
+                yield file_path, contents
+    finally:
+        cat_file.kill()
+        cat_file.wait()
+
+
+def get_dirty_files(repo_dir: str) -> list[str]:
+    """Files that differ from HEAD in the working tree, including untracked ones that aren't ignored."""
+    status = subprocess.run(
+        ["git", "status", "--porcelain", "-z", "--untracked-files=all", "--no-renames"],
+        cwd=repo_dir, capture_output=True, text=True
+    )
+    if status.returncode != 0:
+        return []
+    # each entry is "XY path"
+    return [entry[3:] for entry in status.stdout.split("\0") if entry]
+
+
+def split_lines(contents: str) -> list[str]:
+    # only \n ends a line for ripgrep, unlike str.splitlines
+    lines = contents.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+class SearchableFile(NamedTuple):
+    contents: str
+    lowered_contents: str | None # None when lowercasing changes the length, since offsets would shift
+    lines: list[str]
+
+    @classmethod
+    def from_contents(cls, contents: str) -> "SearchableFile":
+        lowered_contents = contents.lower()
+        return cls(contents, lowered_contents if len(lowered_contents) == len(contents) else None, split_lines(contents))
+
+    def find_literal(self, literal: str) -> list[int]:
+        """Offsets of a lowercase literal ignoring case, str.find is much faster than re with IGNORECASE."""
+        if self.lowered_contents is None:
+            return [match.start() for match in re.finditer(re.escape(literal), self.contents, re.IGNORECASE)]
+        starts = []
+        start = self.lowered_contents.find(literal)
+        while start != -1:
+            starts.append(start)
+            start = self.lowered_contents.find(literal, start + 1)
+        return starts
+
+    def get_line_numbers(self, offsets: list[int]) -> list[int]:
+        """The indices of the lines containing the sorted offsets."""
+        line_numbers = []
+        line_number, previous_offset = 0, 0
+        for offset in offsets:
+            line_number += self.contents.count("\n", previous_offset, offset)
+            previous_offset = offset
+            if not line_numbers or line_numbers[-1] != line_number:
+                line_numbers.append(line_number)
+        return line_numbers
+
+
+class SearchableFileCache:
+    """
+    LRU of decoded files by path, size and modification time. Agents search the same checkout dozens of times
+    per ticket, so this skips reading, decoding, lowercasing and splitting the candidate files on every search.
+    """
+
+    def __init__(self, max_characters: int = MAX_CACHED_CHARACTERS):
+        self.max_characters = max_characters
+        self.entries: OrderedDict[tuple[str, int, int], SearchableFile] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, repo_dir: str, file_path: str) -> SearchableFile | None:
+        try:
+            stat = os.stat(os.path.join(repo_dir, file_path))
+        except OSError:
+            return None
+        key = (os.path.join(repo_dir, file_path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            searchable_file = self.entries.get(key)
+            if searchable_file:
+                self.entries.move_to_end(key)
+                return searchable_file
+        contents = read_searchable_file(repo_dir, file_path)
+        if contents is None:
+            return None
+        searchable_file = SearchableFile.from_contents(contents)
+        # the contents are stored twice, once whole and once split into lines
+        if 2 * len(contents) <= self.max_characters:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = searchable_file
+                    self.size += 2 * len(contents)
+                while self.size > self.max_characters:
+                    _, evicted_file = self.entries.popitem(last=False)
+                    self.size -= 2 * len(evicted_file.contents)
+        return searchable_file
+
+
+searchable_file_cache = SearchableFileCache()
+
+
+class TrigramIndex:
+    """
+    Posting lists of file ids per lowercased trigram. Updated files get a new id and their old id is only marked
+    as replaced, since removing an id from every posting list costs as much as a rebuild.
+    """
+
+    def __init__(self):
+        self.file_paths: list[str | None] = [] # by file id, None once the file was updated or removed
+        self.file_ids: dict[str, int] = {}
+        self.postings: dict[str, array] = {}
+
+    @classmethod
+    def build(
+        cls, repo_dir: str, commit_hash: str | None = None, max_characters: int = MAX_INDEXED_CHARACTERS
+    ) -> "TrigramIndex | None":
+        """
+        Index the files ripgrep would search at commit_hash, or in the working tree without one. Returns None once
+        they add up to more than max_characters.
+        """
+        if commit_hash:
+            files = read_committed_files(repo_dir, commit_hash)
+        else:
+            files = (
+                (file_path, read_searchable_file(repo_dir, file_path)) for file_path in list_searchable_files(repo_dir)
+            )
+        index = cls()
+        total_characters = 0
+        for file_path, contents in files:
+            if contents is not None:
+                total_characters += len(contents)
+                if total_characters > max_characters:
+                    return None
+                index.add_file(file_path, contents)
+        return index
+
+    @property
+    def replaced_fraction(self) -> float:
+        return 1 - len(self.file_ids) / len(self.file_paths) if self.file_paths else 0.0
+
+    def add_file(self, file_path: str, contents: str):
+        self.remove_file(file_path)
+        file_id = len(self.file_paths)
+        self.file_paths.append(file_path)
+        self.file_ids[file_path] = file_id
+        for trigram in get_trigrams(contents):
+            posting = self.postings.get(trigram)
+            if posting is None:
+                posting = self.postings[trigram] = array("I")
+            posting.append(file_id)
+
+    def remove_file(self, file_path: str):
+        file_id = self.file_ids.pop(file_path, None)
+        if file_id is not None:
+            self.file_paths[file_id] = None
+
+    def update_files(self, repo_dir: str, commit_hash: str, file_paths: list[str]):
+        """Re-read file_paths (relative to repo_dir) at commit_hash, dropping the ones that were removed."""
+        committed_files = dict(read_committed_files(repo_dir, commit_hash, file_paths))
+        for file_path in file_paths:
+            if file_path in committed_files:
+                self.add_file(file_path, committed_files[file_path])
+            else:
+                self.remove_file(file_path)
+
+    def get_candidate_files(self, literals: list[str]) -> list[str]:
+        """The files containing every trigram of the literals, a superset of the files containing the literals."""
+        trigrams = set().union(*(get_trigrams(literal) for literal in literals))
+        if not trigrams:
+            return sorted(self.file_ids)
+        postings = sorted((self.postings.get(trigram, array("I")) for trigram in trigrams), key=len)
+        file_ids = set(postings[0])
+        for posting in postings[1:]:
+            if not file_ids:
+                break
+            file_ids.intersection_update(posting)
+        return sorted(self.file_paths[file_id] for file_id in file_ids if self.file_paths[file_id] is not None)
+
+    def search(
+        self,
+        repo_dir: str,
+        pattern: str,
+        ignore_case: bool = True,
+        word: bool = False,
+        fixed_strings: bool = False,
+        dirty_file_paths: Iterable[str] = (),
+    ) -> dict[str, tuple[list[str], list[int]]]:
+        """
+        Match pattern line by line like ripgrep, against the files on disk. dirty_file_paths were edited since the
+        index was built and are always checked. Returns each matching file's lines and the indices of the
+        matching lines. Raises re.error for invalid patterns.
+        """
+        if fixed_strings:
+            pattern = re.escape(pattern)
+        literals = get_required_literals(pattern)
+        if word:
+            pattern = rf"(?<!\w)(?:{pattern})(?!\w)"
+        regex = re.compile(pattern, re.MULTILINE | (re.IGNORECASE if ignore_case else 0))
+        # only lines containing the longest literal can match, finding those first skips running regex on every line
+        longest_literal = max(literals, key=len).lower() if literals else ""
+        results = {}
+        for file_path in sorted(set(self.get_candidate_files(literals)).union(dirty_file_paths)):
+            searchable_file = searchable_file_cache.get(repo_dir, file_path)
+            if searchable_file is None:
+                continue
+            if longest_literal:
+                candidate_lines = searchable_file.get_line_numbers(searchable_file.find_literal(longest_literal))
+            # any line matching means the whole file matches, so this skips most false positives in one call
+            elif regex.search(searchable_file.contents):
+                candidate_lines = range(len(searchable_file.lines))
+            else:
+                continue
+            lines = searchable_file.lines
+            match_lines = [i for i in candidate_lines if regex.search(lines[i])]
+            if match_lines:
+                results[file_path] = (lines, match_lines)
+        return results
+
+
+def format_search_results(
+    results: dict[str, tuple[list[str], list[int]]],
+    context: int = 0,
+    path_prefix: str = "",
+) -> str:
+    """Format TrigramIndex.search results like `rg -n --heading --sort-files -C={context}`."""
+    file_blocks = []
+    # ripgrep sorts by path components, so a/b.py comes before a.json/
+    for file_path, (lines, match_lines) in sorted(results.items(), key=lambda item: item[0].split("/")):
+        output_lines = [os.path.join(path_prefix, file_path) if path_prefix else file_path]
+        match_lines_set = set(match_lines)
+        last_printed_line = None
+        for match_line in match_lines:
+            start = max(match_line - context, 0)
+            if last_printed_line is not None:
+                if context and start > last_printed_line + 1:
+                    output_lines.append("--")
+                start = max(start, last_printed_line + 1)
+            end = min(match_line + context + 1, len(lines))
+            for i in range(start, end):
+                separator = ":" if i in match_lines_set else "-"
+                output_lines.append(f"{i + 1}{separator}{lines[i]}")
+            last_printed_line = max(end - 1, last_printed_line or 0)
+        file_blocks.append("\n".join(output_lines))
+    return "\n\n".join(file_blocks) + "\n" if file_blocks else ""
+
+
+def get_head_commit(repo_dir: str) -> str:
+    rev_parse = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True)
+    return rev_parse.stdout.strip() if rev_parse.returncode == 0 else ""
+
+
+def get_trigram_cache_key(repo_dir: str, commit_hash: str) -> str:
+    return f"{get_lexical_cache_key(repo_dir, commit_hash=commit_hash)}_trigram_{CACHE_VERSION}"
+
+
+def update_trigram_index(repo_dir: str, head_commit_hash: str) -> TrigramIndex | None:
+    """Update the newest cached ancestor commit's index with the files changed since. Returns None if a full rebuild is needed."""
+    for commit_hash in get_ancestor_commits(repo_dir):
+        base_key = get_trigram_cache_key(repo_dir, commit_hash)
+        if base_key in trigram_index_cache:
+            break
+    else:
+        return None
+    changed_files = get_changed_files(repo_dir, commit_hash)
+    if changed_files is None or len(changed_files) > MAX_INCREMENTAL_FILES:
+        return None
+    index = trigram_index_cache.get(base_key)
+    if index is None:
+        return None
+    index.update_files(repo_dir, head_commit_hash, changed_files)
+    if index.replaced_fraction > MAX_REPLACED_FRACTION:
+        return None
+    logger.info(f"Updated trigram index from {base_key}, {len(changed_files)} files changed")
+    return index
+
+
+# None for repos too large to index
+loaded_trigram_indices: OrderedDict[str, TrigramIndex | None] = OrderedDict()
+loaded_trigram_indices_lock = threading.Lock()
+trigram_index_locks: dict[str, threading.Lock] = {} # only while an index is loaded, guarded by loaded_trigram_indices_lock
+building_trigram_indices: set[str] = set()
+
+
+def load_trigram_index(repo_dir: str, commit_hash: str, cache_key: str) -> TrigramIndex | None:
+    # one build per commit even when several agent tool calls need it at once
+    with loaded_trigram_indices_lock:
+        trigram_index_lock = trigram_index_locks.setdefault(cache_key, threading.Lock())
+    try:
+        return load_trigram_index_locked(repo_dir, commit_hash, cache_key, trigram_index_lock)
+    finally:
+        with loaded_trigram_indices_lock:
+            # later calls find the index in memory or on disk, so they don't need the same lock
+            trigram_index_locks.pop(cache_key, None)
+
+
+def load_trigram_index_locked(
+    repo_dir: str, commit_hash: str, cache_key: str, trigram_index_lock: threading.Lock
+) -> TrigramIndex | None:
+    with trigram_index_lock:
+        with loaded_trigram_indices_lock:
+            if cache_key in loaded_trigram_indices:
+                loaded_trigram_indices.move_to_end(cache_key)
+                return loaded_trigram_indices[cache_key]
+        if cache_key in trigram_index_cache:
+            index = trigram_index_cache[cache_key]
+        else:
+            with Timer() as timer:
+                index = update_trigram_index(repo_dir, commit_hash) or TrigramIndex.build(
+                    repo_dir, commit_hash=commit_hash, max_characters=MAX_INDEXED_CHARACTERS
+                )
+            if index is None:
+                logger.info(f"Trigram index for {cache_key} has over {MAX_INDEXED_CHARACTERS} characters, using rg instead")
+            else:
+                logger.info(f"Trigram index for {cache_key} with {len(index.file_ids)} files took {timer.time_elapsed:.2f} seconds")
+            trigram_index_cache[cache_key] = index
+        with loaded_trigram_indices_lock:
+            loaded_trigram_indices[cache_key] = index
+            while len(loaded_trigram_indices) > MAX_LOADED_INDICES:
+                loaded_trigram_indices.popitem(last=False)
+            building_trigram_indices.discard(cache_key)
+    return index
+
+
+def get_trigram_index(repo_dir: str, wait: bool = True) -> TrigramIndex | None:
+    """
+    The trigram index for repo_dir's HEAD, from memory, the disk cache, an ancestor's index or a full build. Returns
+    None if the repo is too large to index, or without wait while the index is being built in the background.
+    """
+    commit_hash = get_head_commit(repo_dir)
+    if not commit_hash:
+        return TrigramIndex.build(repo_dir) if wait else None
+    cache_key = get_trigram_cache_key(repo_dir, commit_hash)
+    with loaded_trigram_indices_lock:
+        if cache_key in loaded_trigram_indices:
+            loaded_trigram_indices.move_to_end(cache_key)
+            return loaded_trigram_indices[cache_key]
+    if not wait and cache_key not in trigram_index_cache:
+        with loaded_trigram_indices_lock:
+            if cache_key not in building_trigram_indices:
+                building_trigram_indices.add(cache_key)
+                threading.Thread(target=load_trigram_index, args=(repo_dir, commit_hash, cache_key), daemon=True).start()
+        return None
+    return load_trigram_index(repo_dir, commit_hash, cache_key)
+
+
+def run_ripgrep(
+    repo_dir: str,
+    pattern: str,
+    ignore_case: bool = True,
+    word: bool = False,
+    fixed_strings: bool = False,
+    context: int = 0,
+    absolute_paths: bool = False,
+) -> str:
+    """search_code with an rg subprocess, for commits whose index isn't ready and repos too large to index."""
+    # invalid patterns raise re.error either way
+    re.compile(re.escape(pattern) if fixed_strings else pattern)
+    rg_command = ["rg", "-n", "--heading", "--sort-files"]
+    if ignore_case:
+        rg_command.append("-i")
+    if word:
+        rg_command.append("-w")
+    if fixed_strings:
+        rg_command.append("-F")
+    if context:
+        rg_command.append(f"-C={context}")
+    rg_command += ["-e", pattern]
+    if absolute_paths:
+        rg_command.append(repo_dir)
+    # decoded by hand since text=True would turn \r\n into \n
+    result = subprocess.run(rg_command, cwd=repo_dir, capture_output=True, stdin=subprocess.DEVNULL)
+    if result.returncode > 1:
+        logger.warning(f"rg failed: {result.stderr.decode(errors='replace')}")
+    return result.stdout.decode("utf-8", errors="replace")
+
+
+def search_code(
+    repo_dir: str,
+    pattern: str,
+    ignore_case: bool = True,
+    word: bool = False,
+    fixed_strings: bool = False,
+    context: int = 0,
+    absolute_paths: bool = False,
+) -> str:
+    """
+    Search repo_dir like `rg -n --heading --sort-files -C={context}`, with -i, -w and -F as ignore_case, word and
+    fixed_strings, and return the output ripgrep would print. Paths are relative to repo_dir unless absolute_paths,
+    like passing repo_dir to ripgrep. Returns an empty string if nothing matches and raises re.error for invalid patterns.
+    """
+    index = get_trigram_index(repo_dir, wait=False)
+    if index is None:
+        return run_ripgrep(repo_dir, pattern, ignore_case, word, fixed_strings, context, absolute_paths)
+    results = index.search(
+        repo_dir, pattern, ignore_case=ignore_case, word=word, fixed_strings=fixed_strings,
+        dirty_file_paths=get_dirty_files(repo_dir),
+    )
+    return format_search_results(results, context=context, path_prefix=repo_dir if absolute_paths else "")
@@ -1,7 +1,9 @@
 import json
 import multiprocessing
 import os
-from typing import Generator
+import shutil
+import uuid
+from typing import Generator, Iterable
 
 import backoff
 from diskcache import Cache
@@ -17,8 +19,16 @@ import boto3
 from botocore.exceptions import ClientError
 from voyageai import error as voyageai_error
 
+from sweepai.core.ann_index import IVFIndex
 from sweepai.utils.timer import Timer
-from sweepai.config.server import BATCH_SIZE, CACHE_DIRECTORY, VOYAGE_API_AWS_ENDPOINT_NAME, VOYAGE_API_KEY, VOYAGE_API_USE_AWS
+from sweepai.config.server import (
+    BATCH_SIZE,
+    CACHE_DIRECTORY,
+    EMBEDDING_STORE_MAX_BYTES,
+    VOYAGE_API_AWS_ENDPOINT_NAME,
+    VOYAGE_API_KEY,
+    VOYAGE_API_USE_AWS,
+)
 from sweepai.utils.hash import hash_sha256
 from sweepai.utils.openai_proxy import get_embeddings_client
 from sweepai.utils.tiktoken_utils import Tiktoken
@@ -31,6 +41,183 @@ tiktoken_client = Tiktoken()
 vector_cache = Cache(f'{CACHE_DIRECTORY}/vector_cache') # we instantiate a singleton, diskcache will handle concurrency
 
 
+class EmbeddingCache:
+    """
+    Batched view over the embedding cache. Each batch is read or written in a single SQLite transaction
+    and vectors are stored as raw float32 bytes instead of pickled numpy arrays.
+    """
+    def __init__(self, cache: Cache):
+        self.cache = cache
+
+    @staticmethod
+    def encode(embedding: np.ndarray) -> bytes:
+        return np.asarray(embedding, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def decode(value: bytes | np.ndarray | None) -> np.ndarray | None:
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            return np.frombuffer(value, dtype=np.float32)
+        return np.asarray(value, dtype=np.float32) # legacy pickled entries
+
+    def get_many(self, keys: list[str]) -> list[np.ndarray | None]:
+        with self.cache.transact():
+            values = [self.cache.get(key) for key in keys]
+        return [self.decode(value) for value in values]
+
+    def set_many(self, items: list[tuple[str, np.ndarray]]):
+        with self.cache.transact():
+            for key, embedding in items:
+                self.cache.set(key, self.encode(embedding))
+
+
+embedding_cache = EmbeddingCache(vector_cache)
+
+EMBEDDING_STORE_DIRECTORY = f"{CACHE_DIRECTORY}/embedding_store"
+MAX_OPEN_EMBEDDING_STORES = 16
+open_embedding_stores: dict[str, tuple[np.ndarray, list[str]]] = {}
+
+
+def get_embedding_store_path(store_key: str) -> str:
+    """The directory of the embedding store for store_key, everything in it is evicted together."""
+    return os.path.join(EMBEDDING_STORE_DIRECTORY, f"{store_key}_{CACHE_VERSION}")
+
+
+def load_embedding_store(store_key: str) -> tuple[np.ndarray, list[str]] | None:
+    """
+    Open a per-commit embedding store: a contiguous, L2-normalized float32 .npy matrix that is memory-mapped
+    so every worker process shares the same pages, plus the sha256 of the text embedded in each row.
+    """
+    if store_key in open_embedding_stores:
+        return open_embedding_stores[store_key]
+    store_path = get_embedding_store_path(store_key)
+    store_file = os.path.join(store_path, "store.json")
+    try:
+        with open(store_file) as f:
+            store = json.load(f)
+        text_hashes = store["text_hashes"]
+        matrix = np.load(os.path.join(store_path, store["matrix"]), mmap_mode="r")
+        # the mtime is the last use for evict_embedding_stores
+        os.utime(store_file)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if matrix.shape[0] != len(text_hashes):
+        return None
+    if len(open_embedding_stores) >= MAX_OPEN_EMBEDDING_STORES:
+        open_embedding_stores.clear()
+    open_embedding_stores[store_key] = matrix, text_hashes
+    return matrix, text_hashes
+
+
+def save_embedding_store(store_key: str, matrix: np.ndarray, text_hashes: list[str]):
+    # store.json names the matrix file it belongs to, so replacing it swaps both at once and concurrent
+    # readers never pair new hashes with an old matrix
+    store_path = get_embedding_store_path(store_key)
+    os.makedirs(store_path, exist_ok=True)
+    generation = uuid.uuid4().hex
+    matrix_file = f"matrix.{generation}.npy"
+    with open(os.path.join(store_path, matrix_file), "wb") as f:
+        np.save(f, matrix)
+    temporary_file = os.path.join(store_path, f"store.{generation}.tmp")
+    with open(temporary_file, "w") as f:
+        json.dump({"matrix": matrix_file, "text_hashes": text_hashes}, f)
+    os.replace(temporary_file, os.path.join(store_path, "store.json"))
+    for file_name in os.listdir(store_path):
+        # readers that already mapped an old matrix keep their pages after it's unlinked
+        if file_name.startswith("matrix.") and file_name != matrix_file:
+            remove_file(os.path.join(store_path, file_name))
+    open_embedding_stores.pop(store_key, None)
+    evict_embedding_stores(keep=store_path)
+
+
+def remove_file(file_path: str):
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+
+
+def evict_embedding_stores(keep: str = ""):
+    """Remove the least recently used embedding stores until they fit in EMBEDDING_STORE_MAX_BYTES, except keep."""
+    stores = []
+    for entry in os.scandir(EMBEDDING_STORE_DIRECTORY):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                size = sum(file.stat().st_size for file in os.scandir(entry.path) if file.is_file(follow_symlinks=False))
+                try:
+                    last_used = os.stat(os.path.join(entry.path, "store.json")).st_mtime
+                except FileNotFoundError:
+                    last_used = entry.stat().st_mtime # still being written
+            else:
+                # stores from before they had their own directories are removed first
+                size, last_used = entry.stat().st_size, 0.0
+        except OSError:
+            continue
+        stores.append((last_used, size, entry.path))
+    total_size = sum(size for _, size, _ in stores)
+    for _, size, store_path in sorted(stores):
+        if total_size <= EMBEDDING_STORE_MAX_BYTES:
+            break
+        if store_path == keep:
+            continue
+        if os.path.isdir(store_path):
+            shutil.rmtree(store_path, ignore_errors=True)
+        else:
+            remove_file(store_path)
+        total_size -= size
+        logger.info(f"Evicted embedding store {store_path}")
+
+
+def get_embedding_matrix(
+    texts: list[str],
+    store_key: str,
+    base_store_keys: Iterable[str] = (),
+    text_hashes: list[str] | None = None,
+) -> np.ndarray:
+    """
+    Get normalized float32 embeddings for texts from the memory-mapped store for store_key.
+    If the store is missing or stale, it is rebuilt by copying the rows of unchanged texts from
+    the store itself or the first existing base store, and only embedding the remaining texts.
+    """
+    text_hashes = text_hashes or [hash_sha256(text) for text in texts]
+    store = load_embedding_store(store_key)
+    if store is not None and store[1] == text_hashes:
+        return store[0]
+    source_stores = [store] if store is not None else []
+    for base_store_key in base_store_keys:
+        base_store = load_embedding_store(base_store_key)
+        if base_store is not None:
+            source_stores.append(base_store)
+            break
+    # for each source store, the rows to copy from it and where they go in the new matrix
+    copies: list[tuple[np.ndarray, list[int], list[int]]] = []
+    missing_indices = list(range(len(texts)))
+    for source_matrix, source_hashes in source_stores:
+        source_rows = {text_hash: row for row, text_hash in enumerate(source_hashes)}
+        target_indices = [i for i in missing_indices if text_hashes[i] in source_rows]
+        if target_indices:
+            copies.append((source_matrix, target_indices, [source_rows[text_hashes[i]] for i in target_indices]))
+            missing_indices = [i for i in missing_indices if text_hashes[i] not in source_rows]
+    logger.info(f"Embedding store {store_key}: reusing {len(texts) - len(missing_indices)} rows, embedding {len(missing_indices)}")
+    new_embeddings = None
+    if missing_indices:
+        new_embeddings = normalize_l2(np.concatenate(embed_text_array([texts[i] for i in missing_indices])))
+        dimension = new_embeddings.shape[1]
+    else:
+        dimension = copies[0][0].shape[1]
+    matrix = np.empty((len(texts), dimension), dtype=np.float32)
+    for source_matrix, target_indices, source_rows in copies:
+        matrix[target_indices] = source_matrix[source_rows]
+    if missing_indices:
+        matrix[missing_indices] = new_embeddings
+    try:
+        save_embedding_store(store_key, matrix, text_hashes)
+    except OSError as e:
+        logger.warning(f"Failed to save embedding store {store_key}: {e}")
+    return matrix
+
+
 def cosine_similarity(a, B):
     # use scipy
     return 1 - cdist(a, B, metric='cosine')
@@ -46,22 +233,93 @@ def chunk(texts: list[str], batch_size: int) -> Generator[list[str], None, None]
         yield texts[i : i + batch_size] if i + batch_size < len(texts) else texts[i:]
 
 
+def get_ivf_index(
+    store_key: str,
+    matrix: np.ndarray,
+    text_hashes: list[str],
+    base_store_keys: Iterable[str] = (),
+) -> IVFIndex:
+    """
+    Load the IVF index persisted in the embedding store for store_key, or build it if it is missing or stale.
+    Centroids are reused from the first base store with an index, so only the row assignment is recomputed.
+    """
+    digest = hash_sha256("".join(text_hashes))
+    store_path = get_embedding_store_path(store_key)
+    index_path = os.path.join(store_path, "ivf")
+    index = IVFIndex.load(index_path)
+    if index is not None and index.digest == digest:
+        return index
+    centroids = None
+    for base_store_key in base_store_keys:
+        base_index = IVFIndex.load(os.path.join(get_embedding_store_path(base_store_key), "ivf"))
+        if base_index is not None:
+            # centroids trained on a much smaller corpus would leave the lists unbalanced
+            if len(base_index.row_ids) * 2 >= matrix.shape[0]:
+                centroids = base_index.centroids
+            break
+    index = IVFIndex.build(matrix, centroids=centroids, digest=digest)
+    try:
+        # in the store's directory so it's evicted with the store
+        os.makedirs(store_path, exist_ok=True)
+        index.save(index_path)
+        evict_embedding_stores(keep=store_path)
+    except OSError as e:
+        logger.warning(f"Failed to save IVF index {store_key}: {e}")
+    return index
+
+
+def embed_queries(queries: list[str]) -> np.ndarray:
+    with Timer() as timer:
+        query_embedding = normalize_l2(np.array(openai_call_embedding(queries, input_type="query"))).astype(np.float32)
+    logger.info(f"Embedding query took {timer.time_elapsed:.2f} seconds")
+    return query_embedding
+
+
 # @file_cache(ignore_params=["texts"])
-def multi_get_query_texts_similarity(queries: list[str], documents: list[str]) -> list[float]:
+def multi_get_query_texts_similarity(
+    queries: list[str],
+    documents: list[str],
+    store_key: str | None = None, # persist the document embeddings in a memory-mapped per-commit store
+    base_store_keys: Iterable[str] = (), # stores of older commits to reuse rows from
+) -> list[float]:
     if not documents:
         return []
-    embeddings = embed_text_array(documents)
-    embeddings = np.concatenate(embeddings)
-    with Timer() as timer:
-        query_embedding = np.array(openai_call_embedding(queries, input_type="query"))
-    logger.info(f"Embedding query took {timer.time_elapsed:.2f} seconds")
+    if store_key:
+        embeddings = get_embedding_matrix(documents, store_key, base_store_keys)
+    else:
+        embeddings = normalize_l2(np.concatenate(embed_text_array(documents))).astype(np.float32)
+    query_embedding = embed_queries(queries)
     with Timer() as timer:
-        similarity = cosine_similarity(query_embedding, embeddings)
+        # all vectors are normalized, so cosine similarity is a single matrix product
+        similarity = query_embedding @ embeddings.T
     logger.info(f"Similarity took {timer.time_elapsed:.2f} seconds")
     similarity = similarity.tolist()
     return similarity
 
 
+def multi_get_query_texts_top_similarities(
+    queries: list[str],
+    documents: list[str],
+    store_key: str,
+    base_store_keys: Iterable[str] = (),
+    top_n: int = 1000,
+) -> list[dict[int, float]]:
+    """
+    Approximate version of multi_get_query_texts_similarity for large repos: for each query, map the
+    indices of its top_n most similar documents, as found by an IVF index over the embedding store, to their similarity.
+    """
+    if not documents:
+        return [{} for _ in queries]
+    text_hashes = [hash_sha256(document) for document in documents]
+    embeddings = get_embedding_matrix(documents, store_key, base_store_keys, text_hashes=text_hashes)
+    index = get_ivf_index(store_key, embeddings, text_hashes, base_store_keys)
+    query_embedding = embed_queries(queries)
+    with Timer() as timer:
+        results = index.search(query_embedding, top_n=top_n)
+    logger.info(f"Approximate similarity took {timer.time_elapsed:.2f} seconds")
+    return [dict(zip(row_ids.tolist(), scores.tolist())) for row_ids, scores in results]
+
+
 def normalize_l2(x):
     x = np.array(x)
     if x.ndim == 1:
@@ -205,10 +463,7 @@ def openai_with_expo_backoff(batch: tuple[str]):
     cache_keys = [hash_sha256(text) + CACHE_VERSION for text in batch]
 
     try:
-        for i, cache_key in enumerate(cache_keys):
-            cache_value = vector_cache.get(cache_key)
-            if cache_value is not None:
-                embeddings[i] = cache_value
+        embeddings = embedding_cache.get_many(cache_keys)
     except Exception as e:
         logger.warning(f"Error reading embeddings from cache: {e}")
 
@@ -240,14 +495,12 @@ def openai_with_expo_backoff(batch: tuple[str]):
     assert len(indices) == len(new_embeddings)
     for i, index in enumerate(indices):
         embeddings[index] = new_embeddings[i]
-    # store in cache
+    # store in cache, only the newly computed embeddings need to be written
     try:
-        for cache_key, embedding in zip(cache_keys, embeddings):
-            vector_cache.set(cache_key, embedding)
-        embeddings = np.array(embeddings)
+        embedding_cache.set_many([(cache_keys[index], embeddings[index]) for index in indices])
     except Exception as e:
         logger.warning(f"Error storing embeddings in cache: {e}")
-    return embeddings
+    return np.array(embeddings)
 
 
 if __name__ == "__main__":
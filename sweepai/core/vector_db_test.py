@@ -0,0 +1,62 @@
+import os
+import time
+
+import numpy as np
+
+from sweepai.core import vector_db
+from sweepai.core.vector_db import get_embedding_store_path, get_ivf_index, load_embedding_store, save_embedding_store
+
+
+def test_save_embedding_store_replaces_the_matrix_with_its_hashes(tmp_path, monkeypatch):
+    # Given: A saved store
+    monkeypatch.setattr(vector_db, "EMBEDDING_STORE_DIRECTORY", str(tmp_path))
+    save_embedding_store("repo_a", np.ones((2, 4), dtype=np.float32), ["a", "b"])
+
+    # When: It's saved again with different rows
+    save_embedding_store("repo_a", np.zeros((3, 4), dtype=np.float32), ["a", "b", "c"])
+    matrix, text_hashes = load_embedding_store("repo_a")
+
+    # Then: Verify the new matrix and hashes load together and the old matrix is gone
+    assert text_hashes == ["a", "b", "c"]
+    assert matrix.shape == (3, 4) and not matrix.any()
+    assert len([file_name for file_name in os.listdir(get_embedding_store_path("repo_a")) if file_name.endswith(".npy")]) == 1
+
+
+def test_least_recently_used_embedding_stores_are_evicted(tmp_path, monkeypatch):
+    # Given: Room for two stores, and two saved stores where the older one was used since
+    monkeypatch.setattr(vector_db, "EMBEDDING_STORE_DIRECTORY", str(tmp_path))
+    matrix = np.ones((1000, 64), dtype=np.float32)
+    monkeypatch.setattr(vector_db, "EMBEDDING_STORE_MAX_BYTES", 2 * matrix.nbytes + 100_000)
+    save_embedding_store("repo_a", matrix, [str(i) for i in range(1000)])
+    save_embedding_store("repo_b", matrix, [str(i) for i in range(1000)])
+    store_file = os.path.join(get_embedding_store_path("repo_b"), "store.json")
+    os.utime(store_file, (time.time() - 60, time.time() - 60))
+    vector_db.open_embedding_stores.clear()
+    assert load_embedding_store("repo_a") is not None
+
+    # When: A third store is saved
+    save_embedding_store("repo_c", matrix, [str(i) for i in range(1000)])
+
+    # Then: Verify the least recently used store was evicted
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(get_embedding_store_path(store_key)) for store_key in ("repo_a", "repo_c")
+    )
+
+
+def test_ivf_index_is_evicted_with_its_store(tmp_path, monkeypatch):
+    # Given: A store with an IVF index built from it
+    monkeypatch.setattr(vector_db, "EMBEDDING_STORE_DIRECTORY", str(tmp_path))
+    matrix = np.eye(300, 16, dtype=np.float32)
+    text_hashes = [str(i) for i in range(300)]
+    save_embedding_store("repo_a", matrix, text_hashes)
+    get_ivf_index("repo_a", matrix, text_hashes)
+    get_ivf_index("repo_a", np.flip(matrix, axis=0).copy(), text_hashes[::-1])
+    store_files = os.listdir(get_embedding_store_path("repo_a"))
+
+    # When: Another store is saved without room for both
+    monkeypatch.setattr(vector_db, "EMBEDDING_STORE_MAX_BYTES", 1)
+    save_embedding_store("repo_b", matrix, text_hashes)
+
+    # Then: Verify the rebuilt index replaced the old vectors, and the index went with its store
+    assert len([file_name for file_name in store_files if file_name.endswith(".vectors.npy")]) == 1
+    assert os.listdir(tmp_path) == [os.path.basename(get_embedding_store_path("repo_b"))]
@@ -60,6 +60,13 @@ class Patch:
     new_count: int
     changes: str
 
+@dataclass
+class PRFileDiff: # the fields of github.File.File used by get_pr_changes, for diffs computed from the local clone
+    filename: str
+    status: str
+    patch: str
+    previous_filename: str | None = None
+
 @dataclass
 class PRChange:
     file_name: str
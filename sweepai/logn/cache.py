@@ -1,13 +1,28 @@
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, NamedTuple
 import hashlib
 import inspect
 import os
 import pickle
+import threading
 import time
+import uuid
+import zlib
 
 from loguru import logger
 from redis import Redis
 
-from sweepai.config.server import CACHE_DIRECTORY, FILE_CACHE_DISABLED, REDIS_URL
+from sweepai.config.server import (
+    CACHE_DIRECTORY,
+    FILE_CACHE_COMPACTION_INTERVAL,
+    FILE_CACHE_DISABLED,
+    FILE_CACHE_MAX_BYTES,
+    FILE_CACHE_MAX_ENTRIES,
+    FILE_CACHE_REDIS_MAX_BYTES,
+    FILE_CACHE_REDIS_TTL,
+    REDIS_URL,
+)
 
 TEST_BOT_NAME = "sweep-nightly[bot]"
 MAX_DEPTH = 6
@@ -15,56 +30,323 @@ MAX_DEPTH = 6
 #     logger.debug("File cache is disabled.")
 redis_client = Redis.from_url(REDIS_URL) if REDIS_URL else None
 
-def recursive_hash(value, depth=0, ignore_params=[]):
-    """Hash primitives recursively with maximum depth."""
+def update_hash(hasher, value, depth=0, ignore_params=[]):
+    """Feed a type-tagged, length-prefixed serialization of value into hasher, recursing up to MAX_DEPTH."""
     if depth > MAX_DEPTH:
-        return hashlib.md5("max_depth_reached".encode()).hexdigest()
-
-    if isinstance(value, (int, float, str, bool, bytes)):
-        return hashlib.md5(str(value).encode()).hexdigest()
+        hasher.update(b"max_depth_reached")
+        return
+    if isinstance(value, str):
+        encoded = value.encode("utf-8", "surrogatepass")
+        hasher.update(b"s%d:" % len(encoded))
+        hasher.update(encoded)
+    elif isinstance(value, bytes):
+        hasher.update(b"b%d:" % len(value))
+        hasher.update(value)
+    elif isinstance(value, (int, float, bool)) or value is None:
+        hasher.update(b"n%s;" % str(value).encode())
     elif isinstance(value, (list, tuple)):
-        return hashlib.md5(
-            "".join(
-                [recursive_hash(item, depth + 1, ignore_params) for item in value]
-            ).encode()
-        ).hexdigest()
+        hasher.update(b"l%d:" % len(value))
+        for item in value:
+            update_hash(hasher, item, depth + 1, ignore_params)
     elif isinstance(value, dict):
-        return hashlib.md5(
-            "".join(
-                [
-                    recursive_hash(key, depth + 1, ignore_params)
-                    + recursive_hash(val, depth + 1, ignore_params)
-                    for key, val in value.items()
-                    if key not in ignore_params
-                ]
-            ).encode()
-        ).hexdigest()
+        hasher.update(b"d:")
+        for key, val in value.items():
+            if key not in ignore_params:
+                update_hash(hasher, key, depth + 1, ignore_params)
+                update_hash(hasher, val, depth + 1, ignore_params)
+        hasher.update(b";")
+    elif callable(getattr(type(value), "__cache_key__", None)):
+        # objects can provide a small stable key instead of having their whole state hashed
+        hasher.update(b"k%s:" % type(value).__name__.encode())
+        update_hash(hasher, value.__cache_key__(), depth + 1, ignore_params)
     elif hasattr(value, "__dict__") and value.__class__.__name__ not in ignore_params:
-        return recursive_hash(value.__dict__, depth + 1, ignore_params)
+        update_hash(hasher, value.__dict__, depth + 1, ignore_params)
     else:
-        return hashlib.md5("unknown".encode()).hexdigest()
+        hasher.update(b"unknown")
+
+
+def recursive_hash(value, depth=0, ignore_params=[]):
+    """Hash primitives recursively with maximum depth."""
+    hasher = hashlib.blake2b(digest_size=16)
+    update_hash(hasher, value, depth, ignore_params)
+    return hasher.hexdigest()
 
 
 def hash_code(code):
     return hashlib.md5(code.encode()).hexdigest()
 
 
-def file_cache(ignore_params=[], ignore_contents=False, verbose=False, redis=False):
+FILE_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "file_cache")
+COMPACTION_MARKER = ".last_compaction" # its mtime is when any process last compacted the cache
+STALE_TEMPORARY_FILE_AGE = 60 * 60 # seconds
+COMPRESSED_REDIS_VALUE_PREFIX = b"zlib:"
+
+
+@dataclass
+class FileCachePolicy:
+    ttl: float | None = None # seconds since the entry was written
+    max_entries: int | None = None
+    max_bytes: int | None = None
+
+
+# per decorated function, keyed by the name of its directory in FILE_CACHE_DIRECTORY
+file_cache_policies: dict[str, FileCachePolicy] = {}
+file_cache_stats: dict[str, Counter] = {}
+file_cache_stats_lock = threading.Lock()
+compaction_lock = threading.Lock()
+last_compaction_check = 0.0
+
+
+def record_file_cache_event(function_key: str, event: str, count: int = 1):
+    with file_cache_stats_lock:
+        file_cache_stats.setdefault(function_key, Counter())[event] += count
+
+
+def get_file_cache_stats() -> dict[str, dict[str, int]]:
+    """Hits (local disk), redis_hits, misses, expirations, evictions and errors per decorated function since this process started."""
+    with file_cache_stats_lock:
+        return {function_key: dict(counter) for function_key, counter in file_cache_stats.items()}
+
+
+def get_cache_file(function_key: str, cache_key: str, arg_hash: str) -> str:
+    # shard by hash prefix so no directory holds more than a fraction of the entries
+    return os.path.join(FILE_CACHE_DIRECTORY, function_key, arg_hash[:2], f"{cache_key}.pickle")
+
+
+def read_cache_file(cache_file: str, function_key: str, policy: FileCachePolicy) -> tuple[bool, Any]:
+    """Return (hit, result), dropping the entry if it outlived its ttl. A hit marks the entry as recently used."""
+    try:
+        stat = os.stat(cache_file)
+    except FileNotFoundError:
+        return False, None
+    now = time.time()
+    if policy.ttl is not None and now - stat.st_mtime > policy.ttl:
+        remove_cache_file(cache_file)
+        record_file_cache_event(function_key, "expirations")
+        return False, None
+    with open(cache_file, "rb") as f:
+        result = pickle.load(f)
+    # atime tracks the last access for eviction, mtime keeps the write time for the ttl
+    try:
+        os.utime(cache_file, (now, stat.st_mtime))
+    except OSError:
+        pass
+    return True, result
+
+
+def write_cache_file(cache_file: str, data: bytes):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # write to a temporary file and rename so concurrent readers never see a partial pickle
+    temporary_file = f"{cache_file}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temporary_file, "wb") as f:
+            f.write(data)
+        os.replace(temporary_file, cache_file)
+    finally:
+        remove_cache_file(temporary_file)
+
+
+def encode_redis_value(data: bytes) -> bytes:
+    return COMPRESSED_REDIS_VALUE_PREFIX + zlib.compress(data)
+
+
+def decode_redis_value(value: bytes):
+    if value.startswith(COMPRESSED_REDIS_VALUE_PREFIX):
+        return pickle.loads(zlib.decompress(value[len(COMPRESSED_REDIS_VALUE_PREFIX):]))
+    return pickle.loads(value) # written before values were compressed
+
+
+def read_redis_entry(cache_key: str, function_key: str) -> tuple[bool, Any]:
+    try:
+        value = redis_client.get(cache_key)
+        if value:
+            return True, decode_redis_value(value)
+    except Exception as e:
+        logger.info(f"Redis cache read failed: {e}")
+        record_file_cache_event(function_key, "redis_errors")
+    return False, None
+
+
+def write_redis_entry(cache_key: str, function_key: str, data: bytes, ttl: float, max_bytes: int):
+    value = encode_redis_value(data)
+    if len(value) > max_bytes:
+        record_file_cache_event(function_key, "redis_skipped_large")
+        return
+    try:
+        redis_client.set(cache_key, value, ex=max(1, int(ttl)))
+    except Exception as e:
+        logger.info(f"Redis cache write failed: {e}")
+        record_file_cache_event(function_key, "redis_errors")
+
+
+def remove_cache_file(cache_file: str) -> bool:
+    try:
+        os.remove(cache_file)
+        return True
+    except OSError:
+        return False
+
+
+class CacheEntry(NamedTuple):
+    access_time: float
+    write_time: float
+    size: int
+    path: str
+
+
+def scan_cache_entries(directory: str) -> list[CacheEntry]:
+    """Every entry under directory, cleaning up stale temporary files on the way."""
+    entries = []
+    stack = [directory]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".pickle"):
+                        try:
+                            stat = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        entries.append(CacheEntry(stat.st_atime, stat.st_mtime, stat.st_size, entry.path))
+                    elif entry.name.endswith(".tmp"):
+                        # left behind by a writer that died before renaming
+                        try:
+                            if time.time() - entry.stat(follow_symlinks=False).st_mtime > STALE_TEMPORARY_FILE_AGE:
+                                remove_cache_file(entry.path)
+                        except OSError:
+                            continue
+        except OSError:
+            continue
+    return entries
+
+
+def evict_least_recently_used(
+    entries: list[CacheEntry],
+    max_entries: int | None,
+    max_bytes: int | None,
+) -> tuple[list[CacheEntry], list[CacheEntry]]:
+    """Split entries into the ones to keep and the least recently used ones to evict to fit the limits."""
+    entries = sorted(entries, key=lambda entry: entry.access_time, reverse=True)
+    total_bytes = 0
+    for i, entry in enumerate(entries):
+        total_bytes += entry.size
+        if (max_entries is not None and i >= max_entries) or (max_bytes is not None and total_bytes > max_bytes):
+            return entries[:i], entries[i:]
+    return entries, []
+
+
+def compact_file_cache(
+    max_entries: int | None = FILE_CACHE_MAX_ENTRIES,
+    max_bytes: int | None = FILE_CACHE_MAX_BYTES,
+) -> int:
+    """
+    Remove expired entries, then evict the least recently used entries of each function over its own limits,
+    then of the whole cache over the global limits. Returns the number of removed entries.
+    """
+    removed = 0
+    kept_entries: list[tuple[CacheEntry, str]] = []
+    try:
+        directory_entries = list(os.scandir(FILE_CACHE_DIRECTORY))
+    except FileNotFoundError:
+        return 0
+    now = time.time()
+    for directory_entry in directory_entries:
+        if directory_entry.is_file(follow_symlinks=False) and directory_entry.name.endswith(".pickle"):
+            # entries of the old unsharded layout are never read again
+            removed += remove_cache_file(directory_entry.path)
+            continue
+        if not directory_entry.is_dir(follow_symlinks=False):
+            continue
+        function_key = directory_entry.name
+        policy = file_cache_policies.get(function_key, FileCachePolicy())
+        entries = scan_cache_entries(directory_entry.path)
+        if policy.ttl is not None:
+            expired = [entry for entry in entries if now - entry.write_time > policy.ttl]
+            expired_count = sum(remove_cache_file(entry.path) for entry in expired)
+            record_file_cache_event(function_key, "expirations", expired_count)
+            removed += expired_count
+            entries = [entry for entry in entries if now - entry.write_time <= policy.ttl]
+        entries, evicted = evict_least_recently_used(entries, policy.max_entries, policy.max_bytes)
+        evicted_count = sum(remove_cache_file(entry.path) for entry in evicted)
+        record_file_cache_event(function_key, "evictions", evicted_count)
+        removed += evicted_count
+        kept_entries.extend((entry, function_key) for entry in entries)
+    _, evicted = evict_least_recently_used([entry for entry, _ in kept_entries], max_entries, max_bytes)
+    evicted_paths = set(entry.path for entry in evicted)
+    for entry, function_key in kept_entries:
+        if entry.path in evicted_paths and remove_cache_file(entry.path):
+            record_file_cache_event(function_key, "evictions")
+            removed += 1
+    return removed
+
+
+def run_compaction():
+    try:
+        removed = compact_file_cache()
+        logger.info(f"File cache compaction removed {removed} entries")
+    except Exception as e:
+        logger.warning(f"File cache compaction failed: {e}")
+    finally:
+        compaction_lock.release()
+
+
+def maybe_compact_file_cache():
+    """Start a background compaction if no process has compacted within FILE_CACHE_COMPACTION_INTERVAL."""
+    global last_compaction_check
+    now = time.time()
+    if now - last_compaction_check < FILE_CACHE_COMPACTION_INTERVAL:
+        return
+    last_compaction_check = now
+    marker = os.path.join(FILE_CACHE_DIRECTORY, COMPACTION_MARKER)
+    try:
+        if now - os.path.getmtime(marker) < FILE_CACHE_COMPACTION_INTERVAL:
+            return
+    except OSError:
+        pass
+    if not compaction_lock.acquire(blocking=False):
+        return
+    try:
+        os.makedirs(FILE_CACHE_DIRECTORY, exist_ok=True)
+        with open(marker, "w"):
+            pass
+    except OSError:
+        compaction_lock.release()
+        return
+    threading.Thread(target=run_compaction, daemon=True).start()
+
+
+def file_cache(
+    ignore_params=[],
+    ignore_contents=False,
+    verbose=False,
+    redis=False,
+    ttl: float | None = None,
+    max_entries: int | None = None,
+    max_bytes: int | None = None,
+    redis_max_bytes: int = FILE_CACHE_REDIS_MAX_BYTES,
+):
     """Decorator to cache function output based on its inputs, ignoring specified parameters.
     Ignore parameters are used to avoid caching on non-deterministic inputs, such as timestamps.
     We can also ignore parameters that are slow to serialize/constant across runs, such as large objects.
+    ttl (seconds since written), max_entries and max_bytes limit this function's entries, on top of the
+    global FILE_CACHE_MAX_ENTRIES and FILE_CACHE_MAX_BYTES; least recently used entries are evicted first.
+    With redis=True, entries are also shared between pods through Redis, compressed, as a second tier behind
+    the local disk. Results that compress to more than redis_max_bytes stay local.
     """
 
     def decorator(func):
         if FILE_CACHE_DISABLED:
             return func
         func_source_code_hash = hash_code(inspect.getsource(func)) if not ignore_contents else ""
+        function_key = f"{func.__module__}.{func.__qualname__}".replace("<", "").replace(">", "")
+        policy = FileCachePolicy(ttl=ttl, max_entries=max_entries, max_bytes=max_bytes)
+        file_cache_policies[function_key] = policy
 
         def wrapper(*args, **kwargs):
             if kwargs.get('do_not_use_file_cache', False):
                 return func(*args, **kwargs)
-            cache_dir = CACHE_DIRECTORY + "/file_cache"
-            os.makedirs(cache_dir, exist_ok=True)
             result = None
 
             # Convert args to a dictionary based on the function's signature
@@ -78,55 +360,55 @@ def file_cache(ignore_params=[], ignore_contents=False, verbose=False, redis=Fal
                 kwargs_clone.pop(param, None)
 
             # Create hash based on function name, input arguments, and function source code
-            arg_hash = (
-                recursive_hash(args_dict, ignore_params=ignore_params)
-                + recursive_hash(kwargs_clone, ignore_params=ignore_params)
-                + func_source_code_hash
-            )
+            hasher = hashlib.blake2b(digest_size=16)
+            update_hash(hasher, args_dict, ignore_params=ignore_params)
+            update_hash(hasher, kwargs_clone, ignore_params=ignore_params)
+            arg_hash = hasher.hexdigest() + func_source_code_hash
             cache_key = f"{func.__module__}_{func.__name__}_{arg_hash}"
-            cache_file = os.path.join(
-                cache_dir, f"{cache_key}.pickle"
-            )
+            cache_file = get_cache_file(function_key, cache_key, arg_hash)
             redis_cache_hit = False
-            if redis and redis_client: # only use this for LLM calls
-                try:
-                    cached_result = redis_client.get(cache_key)
-                    if cached_result:
-                        if verbose:
-                            print("Used redis cache for function: " + func.__name__)
-                        result = pickle.loads(cached_result)
-                        redis_cache_hit = True
-                except Exception:
-                    pass
-            if result is None:
-                try:
-                    # If cache exists, load and return it
-                    if os.path.exists(cache_file):
-                        if verbose:
-                            print("Used cache for function: " + func.__name__)
-                        with open(cache_file, "rb") as f:
-                            result = pickle.load(f)
-                except Exception:
-                    logger.info("Unpickling failed")
+            file_cache_hit = False
+            try:
+                # the local disk is checked first
+                file_cache_hit, result = read_cache_file(cache_file, function_key, policy)
+                if file_cache_hit and verbose:
+                    print("Used cache for function: " + func.__name__)
+            except Exception:
+                logger.info("Unpickling failed")
+                record_file_cache_event(function_key, "errors")
+            # None results are never treated as cached
+            file_cache_hit = file_cache_hit and result is not None
+            if not file_cache_hit and redis and redis_client:
+                # then the cache shared by all pods
+                redis_cache_hit, result = read_redis_entry(cache_key, function_key)
+                redis_cache_hit = redis_cache_hit and result is not None
+                if redis_cache_hit and verbose:
+                    print("Used redis cache for function: " + func.__name__)
+            record_file_cache_event(
+                function_key, "hits" if file_cache_hit else "redis_hits" if redis_cache_hit else "misses"
+            )
             # Otherwise, call the function and save its result to the cache
-            if result is None:
+            if not (file_cache_hit or redis_cache_hit):
                 result = func(*args, **kwargs)
-            # hydrate both caches in all cases
-            if redis and redis_client and not redis_cache_hit: # cache this to redis as well
-                try:
-                    # Cache the result using the unique cache key only if it wasn't a redis cache hit
-                    redis_client.set(cache_key, pickle.dumps(result))
-                except Exception as e:
-                    if verbose:
-                        print(f"Redis caching failed for function: {func.__name__}, Error: {e}")
             if isinstance(result, Exception):
                 logger.info(f"Function {func.__name__} returned an exception")
-            elif not os.path.exists(cache_file):
+            elif result is not None and not file_cache_hit:
                 try:
-                    with open(cache_file, "wb") as f:
-                        pickle.dump(result, f)
+                    data = pickle.dumps(result)
                 except Exception as e:
                     logger.info(f"Pickling failed: {e}")
+                    record_file_cache_event(function_key, "errors")
+                    return result
+                # redis hits are promoted to the local disk
+                if not os.path.exists(cache_file):
+                    try:
+                        write_cache_file(cache_file, data)
+                    except Exception as e:
+                        logger.info(f"Writing cache file failed: {e}")
+                        record_file_cache_event(function_key, "errors")
+                    maybe_compact_file_cache()
+                if redis and redis_client and not redis_cache_hit:
+                    write_redis_entry(cache_key, function_key, data, policy.ttl or FILE_CACHE_REDIS_TTL, redis_max_bytes)
             return result
 
         return wrapper
@@ -166,13 +448,13 @@ def redis_cache(ignore_params=[], verbose=False):
             if cached_result:
                 if verbose:
                     print("Used cache for function: " + func.__name__)
-                return pickle.loads(cached_result)
+                return decode_redis_value(cached_result)
 
             # Execute the function and cache the result if no cache is found
             result = func(*args, **kwargs)
             try:
                 # Cache the result using the unique cache key
-                redis_client.set(cache_key, pickle.dumps(result))
+                redis_client.set(cache_key, encode_redis_value(pickle.dumps(result)))
             except Exception as e:
                 if verbose:
                     print(f"Caching failed for function: {func.__name__}, Error: {e}")
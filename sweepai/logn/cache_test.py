@@ -0,0 +1,149 @@
+import os
+import time
+
+import pytest
+
+from sweepai.logn import cache
+
+
+@pytest.fixture
+def file_cache_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "FILE_CACHE_DISABLED", False)
+    monkeypatch.setattr(cache, "FILE_CACHE_DIRECTORY", str(tmp_path))
+    monkeypatch.setattr(cache, "maybe_compact_file_cache", lambda: None)
+    monkeypatch.setattr(cache, "file_cache_stats", {})
+    return tmp_path
+
+
+def test_entries_are_sharded_and_counted(file_cache_directory):
+    # Given: A function cached with file_cache
+    calls = []
+
+    @cache.file_cache()
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    # When: We call it twice with the same argument and once with another
+    results = [square(3), square(3), square(4)]
+
+    # Then: Verify it only ran on misses, stored entries in shard directories and counted hits and misses
+    assert results == [9, 9, 16]
+    assert calls == [3, 4]
+    function_directory = file_cache_directory / "sweepai.logn.cache_test.test_entries_are_sharded_and_counted.locals.square"
+    shards = os.listdir(function_directory)
+    assert all(len(shard) == 2 for shard in shards)
+    assert sum(len(os.listdir(function_directory / shard)) for shard in shards) == 2
+    stats = cache.get_file_cache_stats()[function_directory.name]
+    assert stats["hits"] == 1 and stats["misses"] == 2
+
+
+def test_ttl_expires_entries(file_cache_directory):
+    # Given: A function cached with a ttl whose entry was written long ago
+    calls = []
+
+    @cache.file_cache(ttl=60)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    double(1)
+    [entry] = cache.scan_cache_entries(str(file_cache_directory))
+    os.utime(entry.path, (time.time(), time.time() - 120))
+
+    # When: We call it again
+    double(1)
+
+    # Then: Verify the expired entry was recomputed
+    assert calls == [1, 1]
+    assert cache.get_file_cache_stats()[os.listdir(file_cache_directory)[0]]["expirations"] == 1
+
+
+def test_compaction_evicts_least_recently_used(file_cache_directory):
+    # Given: Cached entries with distinct last access times, one of them recently read
+    @cache.file_cache()
+    def identity(x):
+        return x
+
+    for x in range(5):
+        identity(x)
+    now = time.time()
+    for i, entry in enumerate(sorted(cache.scan_cache_entries(str(file_cache_directory)), key=lambda entry: entry.path)):
+        os.utime(entry.path, (now - 100 + i, now - 100))
+    most_recently_used = max(cache.scan_cache_entries(str(file_cache_directory)), key=lambda entry: entry.access_time).path
+    (file_cache_directory / "legacy.pickle").write_bytes(b"")
+
+    # When: We compact to two entries
+    removed = cache.compact_file_cache(max_entries=2, max_bytes=None)
+
+    # Then: Verify the legacy flat entry and the three least recently used entries were removed
+    remaining = cache.scan_cache_entries(str(file_cache_directory))
+    assert removed == 4
+    assert len(remaining) == 2
+    assert most_recently_used in [entry.path for entry in remaining]
+    assert not (file_cache_directory / "legacy.pickle").exists()
+
+
+class InMemoryRedis:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+
+def test_redis_tier_is_shared_and_promoted_to_disk(file_cache_directory, monkeypatch):
+    # Given: A redis-backed cached function whose result was computed on another pod
+    monkeypatch.setattr(cache, "redis_client", InMemoryRedis())
+    calls = []
+
+    @cache.file_cache(redis=True, redis_max_bytes=1024)
+    def greet(name):
+        calls.append(name)
+        return "hello " * 10 + name
+
+    greet("a")
+    [redis_value] = cache.redis_client.values.values()
+    for entry in cache.scan_cache_entries(str(file_cache_directory)):
+        os.remove(entry.path)
+
+    # When: We call it again, then once more, and with a result too large for redis
+    results = [greet("a"), greet("a")]
+
+    @cache.file_cache(redis=True, redis_max_bytes=16)
+    def large(name):
+        return "x" * 10_000
+
+    large("a")
+
+    # Then: Verify redis served the first call compressed, the disk the second, and large results stay local
+    assert calls == ["a"]
+    assert results == ["hello " * 10 + "a"] * 2
+    assert redis_value.startswith(cache.COMPRESSED_REDIS_VALUE_PREFIX)
+    stats = cache.get_file_cache_stats()
+    greet_stats = next(counter for key, counter in stats.items() if key.endswith("greet"))
+    assert greet_stats["misses"] == 1 and greet_stats["redis_hits"] == 1 and greet_stats["hits"] == 1
+    assert len(cache.redis_client.values) == 1
+    assert next(counter for key, counter in stats.items() if key.endswith("large"))["redis_skipped_large"] == 1
+
+
+def test_recursive_hash_uses_cache_key_and_separates_values():
+    # Given: An object with a __cache_key__ and values whose naive concatenations collide
+    class Repo:
+        def __init__(self, name, client):
+            self.name = name
+            self.client = client
+
+        def __cache_key__(self):
+            return self.name
+
+    # When: We hash them
+    # Then: Verify only the cache key matters for the object and the values hash apart
+    assert cache.recursive_hash(Repo("a", object())) == cache.recursive_hash(Repo("a", object()))
+    assert cache.recursive_hash(Repo("a", None)) != cache.recursive_hash(Repo("b", None))
+    assert cache.recursive_hash(["ab", "c"]) != cache.recursive_hash(["a", "bc"])
+    assert cache.recursive_hash({"x": 1}, ignore_params=["x"]) == cache.recursive_hash({})
+    assert cache.recursive_hash(1) != cache.recursive_hash("1")
@@ -465,7 +465,7 @@ pylint_args_last_fcr = [
     "--disable=no-member",
 ]
 
-@file_cache()
+@file_cache(redis=True)
 def get_pylint_check_results(file_path: str, code: str, last_fcr_for_file=False) -> CheckResults:
     logger.debug(f"Running pylint on {file_path}...")
     file_hash = uuid.uuid4().hex
@@ -1,50 +1,256 @@
+"""
+Rerank clients for Cohere and Voyage. Scores are cached per (query, document) pair instead of per call, since the
+same snippets come back for every query and snippet type, and concurrent calls for the same query are coalesced
+into one request over their deduplicated documents.
+"""
+import threading
+from abc import ABC, abstractmethod
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import NamedTuple
+
 import backoff
 from loguru import logger
 import voyageai
 import cohere
-from sweepai.config.server import COHERE_API_KEY, VOYAGE_API_KEY
-from sweepai.logn.cache import file_cache
-
-@backoff.on_exception(
-    backoff.expo,
-    Exception,
-    max_tries=3,
-    jitter=backoff.random_jitter,
+from sweepai.config.server import (
+    COHERE_API_KEY,
+    FILE_CACHE_REDIS_TTL,
+    RERANK_BATCH_WINDOW,
+    RERANK_CACHE_MAX_ENTRIES,
+    RERANK_MAX_DOCUMENTS,
+    VOYAGE_API_KEY,
 )
-@file_cache()
+from sweepai.logn.cache import redis_client
+from sweepai.utils.hash import hash_sha256
+
+
+class RerankResult(NamedTuple):
+    index: int
+    relevance_score: float
+    document: str
+
+
+class RerankResponse(NamedTuple):
+    results: list[RerankResult] # most relevant first, like the Cohere and Voyage SDKs
+
+
+class RerankScoreCache:
+    """LRU of relevance scores per (query, document) pair, with Redis as a second tier shared between pods."""
+
+    def __init__(self, max_entries: int = RERANK_CACHE_MAX_ENTRIES, ttl: int = FILE_CACHE_REDIS_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, float] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_many(self, keys: list[str]) -> dict[str, float]:
+        scores = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    scores[key] = self.entries[key]
+        missing_keys = [key for key in keys if key not in scores]
+        if missing_keys and redis_client:
+            try:
+                for key, value in zip(missing_keys, redis_client.mget(missing_keys)):
+                    if value is not None:
+                        scores[key] = float(value)
+            except Exception as e:
+                logger.info(f"Redis rerank cache read failed: {e}")
+        with self.lock:
+            self.hits += len(scores)
+            self.misses += len(keys) - len(scores)
+            # redis hits are promoted to memory
+            self.update_entries({key: score for key, score in scores.items() if key in missing_keys})
+        return scores
+
+    def set_many(self, scores: dict[str, float]):
+        with self.lock:
+            self.update_entries(scores)
+        if scores and redis_client:
+            try:
+                pipeline = redis_client.pipeline(transaction=False)
+                for key, score in scores.items():
+                    pipeline.set(key, score, ex=self.ttl)
+                pipeline.execute()
+            except Exception as e:
+                logger.info(f"Redis rerank cache write failed: {e}")
+
+    def update_entries(self, scores: dict[str, float]):
+        for key, score in scores.items():
+            self.entries[key] = score
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+rerank_score_cache = RerankScoreCache()
+
+
+class RerankBatch:
+    def __init__(self):
+        self.documents: dict[str, str] = {} # cache key -> document
+        self.scores: Future[dict[str, float]] = Future()
+
+
+class RerankClient(ABC):
+    """
+    Base class for the rerank APIs, which score a list of documents against one query. When other calls for the
+    same (model, query, options) group are already in flight, the next call waits batch_window seconds for more
+    calls to join it, then sends their uncached documents in one request. Calls without company are sent right away. Scores don't depend on the other documents in a request, so they're
+    cached per (query, document) pair and top_n is applied locally.
+    """
+
+    provider = ""
+
+    def __init__(
+        self,
+        api_key: str | None,
+        base_url: str | None = None,
+        batch_window: float = RERANK_BATCH_WINDOW,
+        max_documents: int = RERANK_MAX_DOCUMENTS,
+        cache: RerankScoreCache = rerank_score_cache,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.batch_window = batch_window
+        self.max_documents = max_documents
+        self.cache = cache
+        self.pending_batches: dict[tuple, RerankBatch] = {}
+        self.in_flight: dict[tuple, int] = {} # calls per batch key that haven't returned yet
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @abstractmethod
+    def request_scores(self, query: str, documents: list[str], model: str, **kwargs) -> list[float]:
+        """Scores of the documents for the query, in the order of the documents."""
+
+    def get_cache_key(self, model: str, query_hash: str, document: str) -> str:
+        return f"rerank_{self.provider}_{model}_{query_hash}_{hash_sha256(document)}"
+
+    @backoff.on_exception(
+        backoff.expo,
+        Exception,
+        max_tries=3,
+        jitter=backoff.random_jitter,
+    )
+    def send_request(self, query: str, documents: list[str], model: str, **kwargs) -> list[float]:
+        with self.lock:
+            self.requests += 1
+        try:
+            return self.request_scores(query, documents, model, **kwargs)
+        except Exception as e:
+            logger.error(f"{self.provider} rerank failed: {e}")
+            raise e
+
+    def send_batch(self, query: str, batch: RerankBatch, model: str, **kwargs) -> dict[str, float]:
+        cache_keys = list(batch.documents)
+        scores = {}
+        for i in range(0, len(cache_keys), self.max_documents):
+            chunk_keys = cache_keys[i:i + self.max_documents]
+            chunk_scores = self.send_request(query, [batch.documents[key] for key in chunk_keys], model, **kwargs)
+            scores.update(zip(chunk_keys, chunk_scores))
+        self.cache.set_many(scores)
+        return scores
+
+    def rerank(self, query: str, documents: list[str], model: str, top_n: int | None = None, **kwargs) -> RerankResponse:
+        # options like max_chunks_per_doc change the scores so they're part of the key
+        options = tuple(sorted(kwargs.items()))
+        query_hash = hash_sha256(query + repr(options))
+        cache_keys = [self.get_cache_key(model, query_hash, document) for document in documents]
+        scores = self.cache.get_many(list(dict.fromkeys(cache_keys)))
+        missing_documents = {key: document for key, document in zip(cache_keys, documents) if key not in scores}
+        if missing_documents:
+            batch_key = (model, query_hash)
+            with self.lock:
+                batch = self.pending_batches.get(batch_key)
+                is_leader = batch is None
+                if is_leader:
+                    batch = self.pending_batches[batch_key] = RerankBatch()
+                    # a lone call has nothing to wait for
+                    should_wait = self.in_flight.get(batch_key, 0) > 0
+                batch.documents.update(missing_documents)
+                self.in_flight[batch_key] = self.in_flight.get(batch_key, 0) + 1
+            try:
+                if is_leader:
+                    if should_wait:
+                        time.sleep(self.batch_window)
+                    with self.lock:
+                        # calls after this start a new batch
+                        del self.pending_batches[batch_key]
+                    try:
+                        batch.scores.set_result(self.send_batch(query, batch, model, **kwargs))
+                    except Exception as e:
+                        batch.scores.set_exception(e)
+                scores.update(batch.scores.result())
+            finally:
+                with self.lock:
+                    self.in_flight[batch_key] -= 1
+                    if not self.in_flight[batch_key]:
+                        del self.in_flight[batch_key]
+        results = sorted(
+            (RerankResult(index, scores[key], document) for index, (key, document) in enumerate(zip(cache_keys, documents))),
+            key=lambda result: result.relevance_score,
+            reverse=True,
+        )
+        return RerankResponse(results=results[:top_n] if top_n is not None else results)
+
+
+class CohereRerankClient(RerankClient):
+    provider = "cohere"
+
+    def request_scores(self, query: str, documents: list[str], model: str, **kwargs) -> list[float]:
+        co = cohere.Client(self.api_key, base_url=self.base_url)
+        response = co.rerank(model=model, query=query, documents=documents, **kwargs)
+        scores = [0.0] * len(documents)
+        for result in response.results:
+            scores[result.index] = result.relevance_score
+        return scores
+
+
+class VoyageRerankClient(RerankClient):
+    provider = "voyage"
+
+    def request_scores(self, query: str, documents: list[str], model: str, **kwargs) -> list[float]:
+        response = voyageai.Reranking.create(
+            query=query,
+            documents=documents,
+            model=model,
+            api_key=self.api_key,
+            api_base=self.base_url,
+            **kwargs,
+        )
+        scores = [0.0] * len(documents)
+        for result in response.data:
+            scores[result.index] = result.relevance_score
+        return scores
+
+
+cohere_rerank_client = CohereRerankClient(COHERE_API_KEY)
+voyage_rerank_client = VoyageRerankClient(VOYAGE_API_KEY)
+
+
 def cohere_rerank_call(
     query: str,
     documents: list[str],
     model='rerank-english-v3.0',
     **kwargs,
 ):
-    # Cohere API call with caching
-    co = cohere.Client(COHERE_API_KEY)
-    try:
-        return co.rerank(
-            model=model,
-            query=query,
-            documents=documents,
-            **kwargs
-        )
-    except Exception as e:
-        logger.error(f"Cohere rerank failed: {e}")
-        raise e 
+    return cohere_rerank_client.rerank(query, documents, model=model, **kwargs)
 
-@file_cache()
 def voyage_rerank_call(
     query: str,
     documents: list[str],
     model="rerank-1",
+    top_k: int | None = None,
     **kwargs
 ):
-    vo = voyageai.Client(api_key=VOYAGE_API_KEY)
-    return vo.rerank(
-        query, 
-        documents, 
-        model=model,
-        **kwargs
-    )
+    return voyage_rerank_client.rerank(query, documents, model=model, top_n=top_k, **kwargs)
 
 if __name__ == "__main__":
     query = "When is Apple's conference call scheduled?"
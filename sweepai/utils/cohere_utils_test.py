@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from sweepai.utils import cohere_utils
+from sweepai.utils.cohere_utils import CohereRerankClient, RerankScoreCache
+
+
+@pytest.fixture
+def fake_cohere(monkeypatch):
+    # serves POST /v1/rerank after a short delay, scoring each document by the fraction of query words it contains
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            requests.append(payload)
+            time.sleep(0.2)
+            query_words = set(payload["query"].split())
+            results = sorted(
+                (
+                    {"index": i, "relevance_score": len(query_words & set(document.split())) / len(query_words)}
+                    for i, document in enumerate(payload["documents"])
+                ),
+                key=lambda result: result["relevance_score"],
+                reverse=True,
+            )
+            body = json.dumps({"id": str(len(requests)), "results": results, "meta": {}}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(cohere_utils, "redis_client", None)
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1", requests
+    server.shutdown()
+
+
+def test_concurrent_rerank_calls_share_one_request(fake_cohere):
+    # Given: A call in flight and more calls for the same query with overlapping documents
+    base_url, requests = fake_cohere
+    client = CohereRerankClient("key", base_url=base_url, batch_window=0.3, cache=RerankScoreCache())
+    query = "parse config file"
+    document_lists = [
+        ["def parse(config)", "def load file", "README"],
+        ["def load file", "parse config file here"],
+        ["README", "def parse(config)"],
+    ]
+
+    # When: We rerank them concurrently, the first one slightly ahead
+    def rerank(documents: list[str]):
+        return client.rerank(query, documents, model="rerank-english-v3.0")
+
+    with ThreadPoolExecutor(len(document_lists)) as executor:
+        first_response = executor.submit(rerank, document_lists[0])
+        time.sleep(0.05)
+        later_responses = list(executor.map(rerank, document_lists[1:]))
+        responses = [first_response.result(), *later_responses]
+
+    # Then: Verify the first call went alone, the others shared one request with each document once,
+    # and each call gets its own indices back
+    assert len(requests) == 2
+    assert requests[0]["documents"] == document_lists[0]
+    assert sorted(requests[1]["documents"]) == sorted({document for documents in document_lists[1:] for document in documents})
+    assert [(result.index, result.relevance_score) for result in responses[1].results] == [(1, 1.0), (0, 1 / 3)]
+    assert responses[2].results[0].document == "README"
+    assert responses[2].results[0].relevance_score == 0.0
+
+
+def test_lone_rerank_call_does_not_wait(fake_cohere):
+    # Given: A client with a long batching window
+    base_url, requests = fake_cohere
+    client = CohereRerankClient("key", base_url=base_url, batch_window=5, cache=RerankScoreCache())
+
+    # When: We rerank with no other call in flight
+    start = time.time()
+    response = client.rerank("parse config", ["def parse", "def load"], model="rerank-english-v3.0")
+
+    # Then: Verify it's sent right away
+    assert time.time() - start < 2
+    assert len(requests) == 1
+    assert response.results[0].document == "def parse"
+
+
+def test_rerank_scores_are_cached_per_query_and_document(fake_cohere):
+    # Given: A client that already reranked some documents for a query
+    base_url, requests = fake_cohere
+    client = CohereRerankClient("key", base_url=base_url, batch_window=0, cache=RerankScoreCache())
+    client.rerank("parse config", ["def parse", "def load"], model="rerank-english-v3.0")
+
+    # When: We rerank a different list that shares documents, then the same documents for another query
+    response = client.rerank("parse config", ["def load", "parse config", "def parse"], model="rerank-english-v3.0", top_n=2)
+    client.rerank("load config", ["def load"], model="rerank-english-v3.0")
+
+    # Then: Verify only the new pairs were sent and top_n was applied locally
+    assert [request["documents"] for request in requests] == [["def parse", "def load"], ["parse config"], ["def load"]]
+    assert "top_n" not in requests[1]
+    assert [result.document for result in response.results] == ["parse config", "def parse"]
@@ -1,7 +1,14 @@
 import base64
+from hashlib import sha1
+
 import chardet
+import git
 from github.Repository import Repository
 
+def get_blob_sha(data: bytes) -> str:
+    """The object id git assigns to a blob with these bytes."""
+    return sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
 # attempts to decode a file with the following encodings
 def read_file_with_fallback_encodings(
     file_path: str, encodings=["utf-8", "windows-1252", "iso-8859-1"]
@@ -64,4 +71,31 @@ def safe_decode(
                     raise e
         return contents.decoded_content.decode("utf-8")
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
+
+def safe_decode_local(
+    git_repo: git.Repo,
+    path: str,
+    ref: str,
+) -> str | None:
+    """
+    Local counterpart of safe_decode, reads the file at ref from the clone's object database.
+    Returns None if the file can't be resolved or decoded, so the caller can fall back to the API.
+    """
+    try:
+        # persistent git cat-file --batch process, so reading many files costs no extra subprocesses
+        _, object_type, _, data = git_repo.git.get_object_data(f"{ref}:{path}")
+    except (ValueError, git.GitCommandError):
+        return None
+    if object_type != b"blob":
+        return None
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        detected_encoding = chardet.detect(data)['encoding']
+        if detected_encoding is None:
+            return None
+        try:
+            return data.decode(detected_encoding)
+        except UnicodeDecodeError:
+            return None
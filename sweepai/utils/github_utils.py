@@ -10,14 +10,18 @@ import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
 import traceback
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from dataclasses import dataclass
 from functools import cached_property
-from typing import Any
+from typing import Any, NamedTuple
 
 import git
 import requests
+from filelock import FileLock
 from github import Github
 from github.Auth import Token
 
@@ -37,9 +41,15 @@ from sweepai.config.server import (
     GITHUB_APP_PEM,
     GITHUB_BASE_URL,
     GITHUB_BOT_USERNAME,
+    GITHUB_RESPONSE_CACHE_MAX_BYTES,
+    REPO_CLONE_DEPTH,
+    REPO_CLONE_STRATEGY,
+    REPO_FRESHNESS_WINDOW,
+    REPO_LOCK_TIMEOUT,
 )
 from sweepai.core.entities import FileChangeRequest
 from sweepai.utils.str_utils import get_hash
+from sweepai.utils.timer import Timer
 from sweepai.utils.tree_utils import DirectoryTree, remove_all_not_included
 
 MAX_FILE_COUNT = 50
@@ -59,12 +69,75 @@ def get_jwt(signing_key: str = "", app_id: str = ""):
     return encode(payload, signing_key, algorithm="RS256")
 
 
-def get_token(installation_id: int, signing_key: str = "", app_id: str = ""):
+TOKEN_REFRESH_MARGIN = 10 * 60 # seconds before expiry that a cached token is refreshed in the background
+TOKEN_MIN_LIFETIME = 60 # seconds, tokens closer than this to expiry are never handed out
+
+
+class InstallationToken(NamedTuple):
+    token: str
+    expires_at: float # unix time
+
+
+# installation tokens are valid for an hour, so they are shared by every client of the installation
+installation_tokens: dict[tuple[int, str], InstallationToken] = {}
+installation_token_locks: defaultdict[tuple[int, str], threading.Lock] = defaultdict(threading.Lock)
+refreshing_installation_tokens: set[tuple[int, str]] = set()
+installation_tokens_lock = threading.Lock()
+
+
+def get_token(installation_id: int, signing_key: str = "", app_id: str = "", stale_token: str | None = None):
+    """
+    Get an access token for the installation, from the cache while it has more than TOKEN_REFRESH_MARGIN left.
+    Pass the token GitHub rejected as stale_token to replace it, unless another thread already did.
+    """
     if int(installation_id) < 0:
         logger.warning(
             f"installation_id is {installation_id}, using GITHUB_PAT instead."
         )
         return os.environ["GITHUB_PAT"]
+    key = (int(installation_id), str(app_id or GITHUB_APP_ID))
+    cached_token = installation_tokens.get(key)
+    if cached_token and cached_token.token != stale_token and cached_token.expires_at - time.time() > TOKEN_MIN_LIFETIME:
+        if cached_token.expires_at - time.time() < TOKEN_REFRESH_MARGIN:
+            refresh_token_in_background(installation_id, signing_key=signing_key, app_id=app_id)
+        return cached_token.token
+    with installation_tokens_lock:
+        token_lock = installation_token_locks[key]
+    # single flight, concurrent callers wait for one request and then read its token from the cache
+    with token_lock:
+        cached_token = installation_tokens.get(key)
+        if cached_token and cached_token.token != stale_token and cached_token.expires_at - time.time() > TOKEN_MIN_LIFETIME:
+            return cached_token.token
+        installation_token = fetch_token(installation_id, signing_key=signing_key, app_id=app_id)
+        installation_tokens[key] = installation_token
+        return installation_token.token
+
+
+def refresh_token_in_background(installation_id: int, signing_key: str = "", app_id: str = ""):
+    key = (int(installation_id), str(app_id or GITHUB_APP_ID))
+    with installation_tokens_lock:
+        if key in refreshing_installation_tokens:
+            return
+        refreshing_installation_tokens.add(key)
+        token_lock = installation_token_locks[key]
+
+    def refresh():
+        try:
+            with token_lock:
+                cached_token = installation_tokens.get(key)
+                if cached_token and cached_token.expires_at - time.time() >= TOKEN_REFRESH_MARGIN:
+                    return
+                installation_tokens[key] = fetch_token(installation_id, signing_key=signing_key, app_id=app_id)
+        except Exception as e:
+            logger.warning(f"Could not refresh token for installation {installation_id}: {e}")
+        finally:
+            with installation_tokens_lock:
+                refreshing_installation_tokens.discard(key)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def fetch_token(installation_id: int, signing_key: str = "", app_id: str = "") -> InstallationToken:
     for timeout in [5.5, 5.5, 10.5]:
         try:
             jwt = get_jwt(signing_key=signing_key, app_id=app_id)
@@ -81,7 +154,11 @@ def get_token(installation_id: int, signing_key: str = "", app_id: str = ""):
             if "token" not in obj:
                 logger.error(obj)
                 raise Exception("Could not get token")
-            return obj["token"]
+            if "expires_at" in obj:
+                expires_at = datetime.datetime.fromisoformat(obj["expires_at"].replace("Z", "+00:00")).timestamp()
+            else:
+                expires_at = time.time() + 60 * 60
+            return InstallationToken(obj["token"], expires_at)
         except SystemExit:
             raise SystemExit
         except Exception:
@@ -110,6 +187,57 @@ def get_app(signing_key: str = "", app_id: str = ""):
     return response.json()
 
 
+class CachedResponse(NamedTuple):
+    etag: str | None
+    last_modified: str | None
+    headers: dict[str, Any]
+    output: str
+
+
+class GithubResponseCache:
+    """
+    LRU cache of GET responses and their validators, shared by every CustomRequester in the process.
+    Entries are only served after GitHub answers 304 Not Modified to a conditional request, so they are never stale.
+    """
+
+    def __init__(self, max_bytes: int = GITHUB_RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> CachedResponse | None:
+        with self.lock:
+            cached_response = self.entries.get(key)
+            if cached_response:
+                self.entries.move_to_end(key)
+            return cached_response
+
+    def set(self, key: tuple, cached_response: CachedResponse):
+        if len(cached_response.output) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key).output)
+            self.entries[key] = cached_response
+            self.size += len(cached_response.output)
+            while self.size > self.max_bytes:
+                _, evicted_response = self.entries.popitem(last=False)
+                self.size -= len(evicted_response.output)
+
+    def record(self, hit: bool):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+github_response_cache = GithubResponseCache()
+
+
 class CustomRequester(Requester):
     def __init__(
         self,
@@ -123,12 +251,12 @@ class CustomRequester(Requester):
         installation_id: int = None,
         signing_key: str = "",
         app_id: str = "",
+        base_url: str = GITHUB_BASE_URL,
     ) -> "CustomRequester":
         self.token = token
         self.installation_id = installation_id
         self.signing_key = signing_key
         self.app_id = app_id
-        base_url = GITHUB_BASE_URL
         auth = Token(token)
         retry = Retry(
             total=3,
@@ -144,15 +272,51 @@ class CustomRequester(Requester):
             pool_size=pool_size,
         )
 
+    def _set_token(self, token: str):
+        self.token = token
+        # PyGithub builds the Authorization header from its auth object on every request
+        self._Requester__auth = Token(token)
+
     def _refresh_token(self, signing_key: str = "", app_id: str = ""):
-        self.token = get_token(
-            self.installation_id, signing_key=signing_key, app_id=app_id
-        )
-        self._Requester__authorizationHeader = f"token {self.token}"
+        self._set_token(get_token(
+            self.installation_id, signing_key=signing_key, app_id=app_id, stale_token=self.token
+        ))
+
+    def requestJson(self, verb, url, parameters=None, headers=None, input=None, cnx=None):
+        # GETs are sent with the validators of the last response to the same request, and a 304 is answered from it
+        if verb != "GET" or input is not None:
+            return super().requestJson(verb, url, parameters, headers, input, cnx)
+        # an installation's token changes every hour, GitHub decides whether a response is still valid for the new one
+        credentials = self.installation_id or hashlib.sha256(self.token.encode()).hexdigest()
+        key = (credentials, url, json.dumps(parameters or {}, sort_keys=True), json.dumps(headers or {}, sort_keys=True))
+        cached_response = github_response_cache.get(key)
+        headers = dict(headers or {})
+        if cached_response and cached_response.etag:
+            headers["If-None-Match"] = cached_response.etag
+        elif cached_response and cached_response.last_modified:
+            headers["If-Modified-Since"] = cached_response.last_modified
+        status, response_headers, output = super().requestJson(verb, url, parameters, headers, input, cnx)
+        if status == 304 and cached_response:
+            github_response_cache.record(hit=True)
+            return 200, {**cached_response.headers, **response_headers}, cached_response.output
+        github_response_cache.record(hit=False)
+        if status == 200 and ("etag" in response_headers or "last-modified" in response_headers):
+            github_response_cache.set(key, CachedResponse(
+                response_headers.get("etag"),
+                response_headers.get("last-modified"),
+                response_headers,
+                output,
+            ))
+        return status, response_headers, output
 
     def requestJsonAndCheck(
         self, *args, **kwargs
     ):  # more endpoints like these may need to be added
+        if self.installation_id:
+            # picks up tokens refreshed by other clients, long-lived clients would otherwise outlive theirs
+            token = get_token(self.installation_id, signing_key=self.signing_key, app_id=self.app_id)
+            if token != self.token:
+                self._set_token(token)
         try:
             return super().requestJsonAndCheck(*args, **kwargs)
         except (BadCredentialsException, UnknownObjectException):
@@ -432,6 +596,142 @@ def create_branch(
 
 
 REPO_CACHE_BASE_DIR = os.path.join(CACHE_DIRECTORY, "repos")
+STALE_CHECKOUT_AGE = 24 * 60 * 60 # seconds, per-request checkouts older than this were leaked by crashed workers
+CHECKOUT_DIRECTORY_PATTERN = re.compile(r"[0-9a-f]{64}") # see ClonedRepo.repo_dir
+
+
+CLONE_STRATEGIES = ("full", "blobless", "shallow", "sparse")
+LAST_FETCH_FILE = "sweep_last_fetch" # in .git, touched after every clone or pull of a base checkout
+
+repo_locks: defaultdict[str, threading.Lock] = defaultdict(threading.Lock)
+repo_locks_lock = threading.Lock()
+
+
+@contextmanager
+def lock_repo_dir(repo_dir: str):
+    """
+    Serialize clones, pulls and copies of a base checkout, across threads with a lock per directory and
+    across processes with a lock file next to it.
+    """
+    with repo_locks_lock:
+        repo_lock = repo_locks[repo_dir]
+    with repo_lock:
+        os.makedirs(os.path.dirname(repo_dir), exist_ok=True)
+        with FileLock(f"{repo_dir}.lock", timeout=REPO_LOCK_TIMEOUT):
+            yield
+
+
+def mark_fetched(repo_dir: str):
+    with open(os.path.join(repo_dir, ".git", LAST_FETCH_FILE), "w"):
+        pass
+
+
+def is_recently_fetched(repo_dir: str, window: int = REPO_FRESHNESS_WINDOW) -> bool:
+    try:
+        last_fetch_time = os.path.getmtime(os.path.join(repo_dir, ".git", LAST_FETCH_FILE))
+    except OSError:
+        return False
+    return time.time() - last_fetch_time < window
+
+
+def get_sparse_checkout_patterns(exclude_dirs: list[str]) -> list[str]:
+    # non-cone patterns, cone mode can't exclude a directory name at every depth
+    return ["/*"] + [f"!{directory.strip('/')}/" for directory in exclude_dirs if directory != ".git"]
+
+
+def is_sparse_checkout(repo_dir: str) -> bool:
+    return os.path.exists(os.path.join(repo_dir, ".git", "info", "sparse-checkout"))
+
+
+def clone_repo(
+    clone_url: str,
+    repo_dir: str,
+    branch: str | None = None,
+    strategy: str = REPO_CLONE_STRATEGY,
+    depth: int = REPO_CLONE_DEPTH,
+) -> git.Repo:
+    """
+    Clone with one of CLONE_STRATEGIES. Blobless and sparse clones keep the origin as a promisor remote,
+    so git fetches missing file contents on demand (checkout, diff, show, blame), and shallow clones are
+    deepened by deepen_history when a history tool needs more commits.
+    """
+    if strategy not in CLONE_STRATEGIES:
+        raise ValueError(f"Unknown clone strategy {strategy}, expected one of {CLONE_STRATEGIES}")
+    kwargs = {"branch": branch} if branch else {}
+    if strategy in ("blobless", "sparse"):
+        kwargs["filter"] = "blob:none"
+    if strategy == "shallow":
+        kwargs["depth"] = depth
+        kwargs["no_single_branch"] = True
+    if strategy == "sparse":
+        kwargs["no_checkout"] = True
+    with Timer() as timer:
+        repo = git.Repo.clone_from(clone_url, repo_dir, **kwargs)
+        if strategy == "sparse":
+            repo.git.sparse_checkout("set", "--no-cone", *get_sparse_checkout_patterns(SweepConfig().exclude_dirs))
+            repo.git.checkout(branch or repo.active_branch.name)
+    logger.info(f"Cloned with strategy {strategy} in {timer.time_elapsed:.2f} seconds")
+    return repo
+
+
+def deepen_history(repo: git.Repo, since: datetime.datetime | None = None):
+    """Fetch the history a shallow clone is missing, back to since or all of it."""
+    if not os.path.exists(os.path.join(repo.git_dir, "shallow")):
+        return
+    try:
+        if since:
+            repo.git.fetch(f"--shallow-since={since.isoformat()}")
+        else:
+            repo.git.fetch("--unshallow")
+    except git.GitCommandError as e:
+        logger.warning(f"Could not deepen shallow clone: {e}")
+
+
+def copy_clone(source: str, destination: str):
+    """
+    Copy a git clone much faster than shutil.copytree. Git never modifies files in .git/objects in place,
+    so they are hardlinked. Everything else is copied by cp --reflink=auto, which shares blocks copy-on-write
+    where the filesystem supports it and otherwise still copies natively.
+    Working tree files can't be hardlinked since they are edited in place.
+    """
+    try:
+        os.makedirs(destination)
+        entries = [os.path.join(source, entry) for entry in os.listdir(source) if entry != ".git"]
+        if entries:
+            subprocess.run(["cp", "-a", "--reflink=auto", *entries, destination], check=True, capture_output=True)
+        git_dir = os.path.join(source, ".git")
+        if os.path.isdir(git_dir):
+            destination_git_dir = os.path.join(destination, ".git")
+            os.makedirs(destination_git_dir)
+            git_entries = [os.path.join(git_dir, entry) for entry in os.listdir(git_dir) if entry != "objects"]
+            if git_entries:
+                subprocess.run(["cp", "-a", "--reflink=auto", *git_entries, destination_git_dir], check=True, capture_output=True)
+            subprocess.run(["cp", "-al", os.path.join(git_dir, "objects"), destination_git_dir], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        # e.g. no GNU cp, or source and destination on different filesystems
+        logger.warning(f"Fast copy of {source} failed, falling back to shutil.copytree: {e}")
+        shutil.rmtree(destination, ignore_errors=True)
+        shutil.copytree(source, destination, symlinks=True, copy_function=shutil.copy)
+
+
+def remove_stale_checkouts(repo_cache_dir: str):
+    """Remove per-request checkouts of a repo that were never cleaned up, e.g. because the worker crashed."""
+    try:
+        entries = list(os.scandir(repo_cache_dir))
+    except OSError:
+        return
+    now = time.time()
+    for entry in entries:
+        try:
+            if (
+                CHECKOUT_DIRECTORY_PATTERN.fullmatch(entry.name)
+                and entry.is_dir(follow_symlinks=False)
+                and now - entry.stat(follow_symlinks=False).st_mtime > STALE_CHECKOUT_AGE
+            ):
+                logger.info(f"Removing stale checkout {entry.path}")
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            continue
 
 
 @dataclass
@@ -442,6 +742,7 @@ class ClonedRepo:
     token: str | None = None
     repo: Any | None = None
     git_repo: git.Repo | None = None
+    clone_strategy: str = REPO_CLONE_STRATEGY
 
     class Config:
         arbitrary_types_allowed = True
@@ -457,7 +758,8 @@ class ClonedRepo:
         return os.path.join(
             REPO_CACHE_BASE_DIR,
             self.repo_full_name,
-            "base",
+            # partial clones can't be pulled into full ones, so each strategy has its own base
+            "base" if self.clone_strategy == "full" else f"base_{self.clone_strategy}",
             parse_collection_name(self.branch),
         )
 
@@ -489,39 +791,44 @@ class ClonedRepo:
         )
 
     def clone(self):
-        if not os.path.exists(self.cached_dir):
-            logger.info("Cloning repo...")
-            if self.branch:
-                repo = git.Repo.clone_from(
-                    self.clone_url, self.cached_dir, branch=self.branch
+        # concurrent callers wait here for the in-flight clone or pull and then reuse it through the freshness check
+        with lock_repo_dir(self.cached_dir):
+            if not os.path.exists(self.cached_dir):
+                logger.info("Cloning repo...")
+                clone_repo(
+                    self.clone_url, self.cached_dir, branch=self.branch, strategy=self.clone_strategy
                 )
+                mark_fetched(self.cached_dir)
+                logger.info("Done cloning")
+            elif is_recently_fetched(self.cached_dir):
+                git.Repo(self.cached_dir).git.remote("set-url", "origin", self.clone_url) # copies fetch blobs with our token
+                logger.info(f"Repo was fetched in the last {REPO_FRESHNESS_WINDOW} seconds, skipping pull")
             else:
-                repo = git.Repo.clone_from(self.clone_url, self.cached_dir)
-            logger.info("Done cloning")
-        else:
-            # Pulling with pat doesn't work, have to reclone
-            try:
-                # Try to open existing repo
-                repo = git.Repo(self.cached_dir)
-                repo.git.remote("set-url", "origin", self.clone_url)
-                repo.git.clean('-fd')
-                repo.git.pull()
-                logger.info("Pull repo succeeded")
-            except Exception as e:
-                logger.warning(f"Could not pull repo, cloning instead: {str(e)}")
-                logger.info("Consider rm -rf /mnt/caches/repos/ if this continues")
-                shutil.rmtree(self.cached_dir, ignore_errors=True)
-                if self.branch:
-                    repo = git.Repo.clone_from(
-                        self.clone_url, self.cached_dir, branch=self.branch
+                # Pulling with pat doesn't work, have to reclone
+                try:
+                    # Try to open existing repo
+                    repo = git.Repo(self.cached_dir)
+                    repo.git.remote("set-url", "origin", self.clone_url)
+                    repo.git.clean('-fd')
+                    repo.git.pull()
+                    logger.info("Pull repo succeeded")
+                except Exception as e:
+                    logger.warning(f"Could not pull repo, cloning instead: {str(e)}")
+                    logger.info("Consider rm -rf /mnt/caches/repos/ if this continues")
+                    shutil.rmtree(self.cached_dir, ignore_errors=True)
+                    clone_repo(
+                        self.clone_url, self.cached_dir, branch=self.branch, strategy=self.clone_strategy
                     )
-                else:
-                    repo = git.Repo.clone_from(self.clone_url, self.cached_dir)
-        logger.info("Copying repo...")
-        shutil.copytree(
-            self.cached_dir, self.repo_dir, symlinks=True, copy_function=shutil.copy
-        )  # this step is slow, should use system calls
-        logger.info("Done copying")
+                mark_fetched(self.cached_dir)
+            logger.info("Copying repo...")
+            with Timer() as timer:
+                copy_clone(self.cached_dir, self.repo_dir)
+            logger.info(f"Done copying in {timer.time_elapsed:.2f} seconds")
+        threading.Thread(
+            target=remove_stale_checkouts,
+            args=(os.path.join(REPO_CACHE_BASE_DIR, self.repo_full_name),),
+            daemon=True,
+        ).start()
         repo = git.Repo(self.repo_dir)
         return repo
 
@@ -546,6 +853,14 @@ class ClonedRepo:
             os.environ['GIT_LFS_SKIP_SMUDGE'] = '1'
             self.git_repo.git.checkout(self.branch)
 
+    def __cache_key__(self):
+        # used by file_cache instead of hashing the GitHub clients and the per-request directories
+        try:
+            commit_hash = self.git_repo.head.commit.hexsha
+        except Exception:
+            commit_hash = getattr(self, "commit_hash", None)
+        return (self.repo_full_name, self.branch, commit_hash)
+
     def handle_checkout_failures(self):
         untracked_files = self.git_repo.untracked_files
         if untracked_files:
@@ -694,6 +1009,12 @@ class ClonedRepo:
             with open(local_path, "r", encoding="utf-8", errors="replace") as f:
                 contents = f.read()
             return contents
+        elif is_sparse_checkout(self.repo_dir):
+            # outside the sparse checkout, read it from git which fetches the blob if needed
+            try:
+                return self.git_repo.git.show(f"HEAD:{file_path.lstrip('/')}", strip_newline_in_stdout=False)
+            except git.GitCommandError:
+                raise FileNotFoundError(f"{local_path} does not exist.")
         else:
             raise FileNotFoundError(f"{local_path} does not exist.")
 
@@ -708,6 +1029,10 @@ class ClonedRepo:
     ):
         commit_history = []
         try:
+            deepen_history(
+                self.git_repo,
+                since=datetime.datetime.now() - datetime.timedelta(days=7) if time_limited else None,
+            )
             if username != "":
                 commit_list = list(self.git_repo.iter_commits(author=username))
             else:
@@ -1,7 +1,14 @@
+import json
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import Mock, patch
 
-from sweepai.utils.github_utils import ClonedRepo
+import pytest
+
+from sweepai.utils import github_utils
+from sweepai.utils.github_utils import ClonedRepo, CustomRequester, GithubResponseCache, InstallationToken, get_token
 
 
 @unittest.skip("Fails")
@@ -59,3 +66,121 @@ class TestClonedRepo(unittest.TestCase):
         self.cloned_repo.git_repo = mock_repo
         commit_history = self.cloned_repo.get_commit_history()
         self.assertEqual(len(commit_history), 2)
+
+
+@pytest.fixture
+def token_endpoint(monkeypatch):
+    # stands in for POST /app/installations/{id}/access_tokens, issuing tokens valid for an hour
+    requests_made = []
+
+    def post(url, headers):
+        time.sleep(0.05)
+        requests_made.append(url)
+        response = Mock()
+        response.json.return_value = {
+            "token": f"token-{len(requests_made)}",
+            "expires_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 60 * 60)),
+        }
+        return response
+
+    monkeypatch.setattr(github_utils.requests, "post", post)
+    monkeypatch.setattr(github_utils, "get_jwt", lambda **kwargs: "jwt")
+    monkeypatch.setattr(github_utils, "installation_tokens", {})
+    return requests_made
+
+
+def test_get_token_single_flight(token_endpoint):
+    # Given: Many threads asking for the same installation's token at once
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(get_token(1))) for _ in range(8)]
+
+    # When: They all run
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Then: Verify only one token was requested and every thread got it
+    assert len(token_endpoint) == 1
+    assert tokens == ["token-1"] * 8
+    assert get_token(1) == "token-1"
+    assert get_token(2) == "token-2"
+
+
+def test_get_token_replaces_stale_token(token_endpoint):
+    # Given: A cached token
+    token = get_token(1)
+
+    # When: GitHub rejects it, twice with the same token
+    new_token = get_token(1, stale_token=token)
+    newer_token = get_token(1, stale_token=token)
+
+    # Then: Verify it is only replaced once
+    assert new_token == newer_token == "token-2"
+    assert len(token_endpoint) == 2
+
+
+def test_get_token_refreshes_before_expiry(token_endpoint):
+    # Given: A cached token that expires within the refresh margin
+    github_utils.installation_tokens[(1, str(github_utils.GITHUB_APP_ID))] = InstallationToken("old-token", time.time() + 5 * 60)
+
+    # When: We get the token, then wait for the background refresh
+    token = get_token(1)
+    deadline = time.time() + 5
+    while get_token(1) == "old-token" and time.time() < deadline:
+        time.sleep(0.01)
+
+    # Then: Verify the old token was still served and a new one replaced it
+    assert token == "old-token"
+    assert get_token(1) == "token-1"
+    assert len(token_endpoint) == 1
+
+
+@pytest.fixture
+def fake_github(monkeypatch):
+    # serves GET /repos/{owner}/{repo} with an ETag that changes when the repo is updated
+    state = {"description": "first", "requests": []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            etag = f'"{state["description"]}"'
+            state["requests"].append(self.headers.get("If-None-Match"))
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            body = json.dumps({"full_name": self.path.removeprefix("/repos/"), "description": state["description"]}).encode()
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(github_utils, "github_response_cache", GithubResponseCache())
+    yield f"http://127.0.0.1:{server.server_address[1]}", state
+    server.shutdown()
+
+
+def test_conditional_requests_serve_not_modified_from_cache(fake_github):
+    # Given: A requester talking to a fake GitHub
+    base_url, state = fake_github
+    requester = CustomRequester("token", base_url=base_url)
+
+    # When: We fetch the same repo twice, then again after it changed
+    _, first = requester.requestJsonAndCheck("GET", "/repos/sweepai/sweep")
+    _, second = requester.requestJsonAndCheck("GET", "/repos/sweepai/sweep")
+    state["description"] = "second"
+    _, third = requester.requestJsonAndCheck("GET", "/repos/sweepai/sweep")
+
+    # Then: Verify the repeat was revalidated and served from the cache, and the change was picked up
+    assert state["requests"] == [None, '"first"', '"first"']
+    assert first == second == {"full_name": "sweepai/sweep", "description": "first"}
+    assert third["description"] == "second"
+    assert (github_utils.github_response_cache.hits, github_utils.github_response_cache.misses) == (1, 2)
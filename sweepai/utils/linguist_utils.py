@@ -0,0 +1,163 @@
+"""
+In-process port of the github-linguist checks SweepConfig.is_file_bad relies on: the blob type, the language and
+whether a file is generated. Spawning a Ruby process per file made this one of the slowest parts of
+reviewing large PRs. Results are cached per blob SHA and file name.
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import NamedTuple
+
+from pygments.lexers import get_lexer_for_filename
+from pygments.util import ClassNotFound
+
+from sweepai.utils.file_utils import get_blob_sha
+
+# linguist's names for the extensions we see most, pygments covers the long tail
+EXTENSION_LANGUAGES = {
+    ".py": "Python", ".pyi": "Python", ".pyx": "Cython", ".ipynb": "Jupyter Notebook",
+    ".js": "JavaScript", ".cjs": "JavaScript", ".mjs": "JavaScript", ".jsx": "JavaScript",
+    ".ts": "TypeScript", ".cts": "TypeScript", ".mts": "TypeScript", ".tsx": "TSX",
+    ".vue": "Vue", ".svelte": "Svelte", ".astro": "Astro", ".mdx": "MDX",
+    ".go": "Go", ".rs": "Rust", ".java": "Java", ".kt": "Kotlin", ".kts": "Kotlin", ".scala": "Scala",
+    ".swift": "Swift", ".m": "Objective-C", ".mm": "Objective-C++", ".rb": "Ruby", ".erb": "HTML+ERB",
+    ".php": "PHP", ".cs": "C#", ".fs": "F#", ".vb": "Visual Basic .NET",
+    ".c": "C", ".h": "C", ".cc": "C++", ".cpp": "C++", ".cxx": "C++", ".hh": "C++", ".hpp": "C++",
+    ".ex": "Elixir", ".exs": "Elixir", ".erl": "Erlang", ".hs": "Haskell", ".elm": "Elm", ".clj": "Clojure",
+    ".dart": "Dart", ".lua": "Lua", ".r": "R", ".jl": "Julia", ".zig": "Zig", ".sol": "Solidity", ".nim": "Nim",
+    ".sh": "Shell", ".bash": "Shell", ".zsh": "Shell", ".ps1": "PowerShell", ".bat": "Batchfile",
+    ".sql": "SQL", ".prisma": "Prisma", ".graphql": "GraphQL", ".gql": "GraphQL", ".proto": "Protocol Buffer",
+    ".html": "HTML", ".htm": "HTML", ".ejs": "EJS", ".hbs": "Handlebars", ".jinja": "Jinja", ".j2": "Jinja",
+    ".css": "CSS", ".scss": "SCSS", ".sass": "Sass", ".less": "Less", ".styl": "Stylus",
+    ".json": "JSON", ".yaml": "YAML", ".yml": "YAML", ".toml": "TOML", ".xml": "XML", ".plist": "XML Property List",
+    ".md": "Markdown", ".rst": "reStructuredText", ".txt": "Text", ".ini": "INI", ".cfg": "INI",
+    ".tf": "HCL", ".hcl": "HCL", ".nix": "Nix", ".gradle": "Gradle", ".groovy": "Groovy", ".cmake": "CMake",
+}
+FILENAME_LANGUAGES = {
+    "Dockerfile": "Dockerfile", "Makefile": "Makefile", "CMakeLists.txt": "CMake", "Gemfile": "Ruby",
+    "Rakefile": "Ruby", "Procfile": "Procfile", "Jenkinsfile": "Groovy", ".gitattributes": "Git Attributes",
+    ".gitignore": "Ignore List", ".dockerignore": "Ignore List", ".env": "Dotenv",
+}
+# linguist's names for the interpreters in shebang lines, for scripts without an extension
+INTERPRETER_LANGUAGES = {
+    "python": "Python", "node": "JavaScript", "deno": "TypeScript", "ts-node": "TypeScript",
+    "sh": "Shell", "bash": "Shell", "zsh": "Shell", "dash": "Shell", "ksh": "Shell", "fish": "fish",
+    "ruby": "Ruby", "perl": "Perl", "php": "PHP", "lua": "Lua", "Rscript": "R", "julia": "Julia",
+    "pwsh": "PowerShell", "elixir": "Elixir", "escript": "Erlang", "runhaskell": "Haskell", "make": "Makefile",
+}
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".ico", ".tif", ".tiff", ".webp"}
+
+# from linguist's generated.rb
+GENERATED_FILE_NAMES = {
+    "package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml", "Cargo.lock", "composer.lock",
+    "poetry.lock", "Pipfile.lock", "Gemfile.lock", "go.sum", "Gopkg.lock", "glide.lock", "flake.lock", "pubspec.lock",
+}
+GENERATED_PATH_PATTERN = re.compile(
+    r"\.(js|css)\.map$"
+    r"|(\.pb\.(go|cc|h)|_pb2(_grpc)?\.pyi?|\.designer\.(cs|vb)|\.feature\.cs|\.nib|\.xcworkspacedata|\.xcuserstate)$"
+    r"|(^|/)(__generated__|htmlcov|\.idea)/"
+)
+# the header comments code generators leave
+GENERATED_MARKER_PATTERN = re.compile(
+    r"Code generated .* DO NOT EDIT|@generated|<auto-generated|\bauto-?generated (file|code)"
+    r"|\b(this|the) (file|code) (was|is|has been) (automatically |auto-?)?generated"
+    r"|Generated by (the protocol buffer compiler|Cython)",
+    re.IGNORECASE,
+)
+GENERATED_MARKER_LINES = 10 # only the first lines are checked, like linguist
+MINIFIED_LINE_LENGTH = 110 # average line length above which js and css is minified
+
+
+class LinguistResult(NamedTuple):
+    type: str # "Text", "Image" or "Binary"
+    language: str | None
+    generated: bool
+
+
+@lru_cache(maxsize=4096)
+def get_language(file_name: str) -> str | None:
+    base_name = os.path.basename(file_name)
+    if base_name in FILENAME_LANGUAGES:
+        return FILENAME_LANGUAGES[base_name]
+    _, extension = os.path.splitext(base_name)
+    if extension.lower() in EXTENSION_LANGUAGES:
+        return EXTENSION_LANGUAGES[extension.lower()]
+    try:
+        return get_lexer_for_filename(base_name).name
+    except ClassNotFound:
+        return None
+
+
+def get_interpreter_language(contents: str) -> str | None:
+    if not contents.startswith("#!"):
+        return None
+    command = contents[2:].split("\n", 1)[0].split()
+    if command and os.path.basename(command[0]) == "env":
+        command = [arg for arg in command[1:] if not arg.startswith("-")]
+    if not command:
+        return None
+    interpreter = re.sub(r"[\d.]+$", "", os.path.basename(command[0]))
+    return INTERPRETER_LANGUAGES.get(interpreter)
+
+
+def is_generated(file_name: str, contents: str) -> bool:
+    if os.path.basename(file_name) in GENERATED_FILE_NAMES or GENERATED_PATH_PATTERN.search(file_name):
+        return True
+    lines = contents.splitlines()
+    if GENERATED_MARKER_PATTERN.search("\n".join(lines[:GENERATED_MARKER_LINES])):
+        return True
+    if file_name.endswith((".js", ".css")) and lines:
+        return len(contents) / len(lines) > MINIFIED_LINE_LENGTH
+    return False
+
+
+def classify_file(file_name: str, data: bytes) -> LinguistResult:
+    language = get_language(file_name)
+    if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS:
+        return LinguistResult("Image", language, False)
+    # git's heuristic, a null byte in the first 8000 bytes means binary
+    if b"\0" in data[:8000]:
+        return LinguistResult("Binary", language, False)
+    contents = data.decode("utf-8", errors="replace")
+    # like linguist, scripts without a known extension are detected by their shebang
+    language = language or get_interpreter_language(contents)
+    return LinguistResult("Text", language, is_generated(file_name, contents))
+
+
+class LinguistCache:
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[tuple[str, str], LinguistResult] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple[str, str]) -> LinguistResult | None:
+        with self.lock:
+            result = self.entries.get(key)
+            if result:
+                self.entries.move_to_end(key)
+            return result
+
+    def set(self, key: tuple[str, str], result: LinguistResult):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+linguist_cache = LinguistCache()
+
+
+def classify_files(files: dict[str, bytes]) -> dict[str, LinguistResult]:
+    """Classify many files at once, keyed by file name. Files already seen with the same blob SHA aren't reclassified."""
+    results = {}
+    for file_name, data in files.items():
+        key = (get_blob_sha(data), file_name)
+        result = linguist_cache.get(key)
+        if result is None:
+            result = classify_file(file_name, data)
+            linguist_cache.set(key, result)
+        results[file_name] = result
+    return results
@@ -0,0 +1,87 @@
+from sweepai.config.client import SweepConfig
+from sweepai.utils.linguist_utils import classify_file, classify_files, linguist_cache
+
+
+def test_classify_file():
+    # Given: Hand-written, generated, minified and binary files
+    minified = ("var a=1;" * 50 + "\n").encode()
+
+    # When: We classify them
+    results = {
+        file_name: classify_file(file_name, data)
+        for file_name, data in [
+            ("src/app.tsx", b"export const a = 1;\n"),
+            ("api/service.pb.go", b"package api\n"),
+            ("gen/client.go", b"// Code generated by mockgen. DO NOT EDIT.\npackage gen\n"),
+            ("web/package-lock.json", b"{}\n"),
+            ("static/app.js", minified),
+            ("assets/logo.png", b"\x89PNG\r\n"),
+            ("data.bin", b"\x00\x01"),
+        ]
+    }
+
+    # Then: Verify they match what github-linguist reports
+    assert results["src/app.tsx"] == ("Text", "TSX", False)
+    assert results["api/service.pb.go"].generated
+    assert results["gen/client.go"].generated
+    assert results["web/package-lock.json"].generated
+    assert results["static/app.js"].generated
+    assert results["assets/logo.png"].type == "Image"
+    assert results["data.bin"].type == "Binary"
+
+
+def test_classify_files_caches_by_blob_sha():
+    # Given: A file that was already classified
+    classify_files({"src/main.py": b"print('hello')\n"})
+
+    # When: We classify the same contents again
+    cached_entries = len(linguist_cache.entries)
+    results = classify_files({"src/main.py": b"print('hello')\n"})
+
+    # Then: Verify the cached result is reused
+    assert results["src/main.py"] == ("Text", "Python", False)
+    assert len(linguist_cache.entries) == cached_entries
+
+
+# (path, contents, github-linguist's type, language and generated) as reported by `github-linguist <path> -j`
+LINGUIST_CLASSIFICATIONS = [
+    ("sweepai/api.py", b"import os\n", "Text", "Python", False),
+    ("web/components/Button.tsx", b"export const Button = () => null;\n", "Text", "TSX", False),
+    ("vendor/github.com/pkg/errors/errors.go", b"package errors\n", "Text", "Go", False),
+    ("third_party/zlib/zlib.h", b"int inflate(void);\n", "Text", "C", False),
+    ("bin/deploy", b"#!/usr/bin/env bash\nset -e\n", "Text", "Shell", False),
+    ("scripts/migrate", b"#!/usr/bin/python3\nprint(1)\n", "Text", "Python", False),
+    ("Dockerfile", b"FROM python:3.10\n", "Text", "Dockerfile", False),
+    ("pyproject.toml", b"[tool.poetry]\n", "Text", "TOML", False),
+    ("poetry.lock", b"[[package]]\n", "Text", "TOML", True),
+    ("proto/user_pb2.py", b"# Generated by the protocol buffer compiler.  DO NOT EDIT!\n", "Text", "Python", True),
+    ("notes.unknownext", b"some notes\n", "Text", None, False),
+    ("docs/diagram.png", b"\x89PNG\r\n\x1a\n", "Image", None, False),
+]
+
+
+def test_classify_file_matches_linguist():
+    # Given: A sample of files and how github-linguist classifies them
+    # When: We classify them in process
+    results = [classify_file(file_name, data) for file_name, data, *_ in LINGUIST_CLASSIFICATIONS]
+
+    # Then: Verify every type, language and generated flag matches linguist's
+    for (file_name, _, *expected), result in zip(LINGUIST_CLASSIFICATIONS, results):
+        assert tuple(result) == tuple(expected), file_name
+
+
+def test_are_files_bad_keeps_vendored_code(tmp_path):
+    # Given: Vendored source and a script without an extension next to a file with an unknown language
+    files = {
+        "vendor/lib/util.js": "export const a = 1;\n",
+        "bin/deploy": "#!/bin/sh\necho deploy\n",
+        "notes.unknownext": "some notes\n",
+    }
+
+    # When: We check if they're bad
+    results = SweepConfig().are_files_bad(list(files), str(tmp_path), files)
+
+    # Then: Verify only the file linguist has no language for is rejected, like the github-linguist based check
+    assert results["vendor/lib/util.js"] == (False, "")
+    assert results["bin/deploy"] == (False, "")
+    assert results["notes.unknownext"][0]
@@ -1,6 +1,10 @@
 """This should take a list of snippets and rerank them"""
+import random
 import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 
+from sweepai.config.server import LISTWISE_RERANK_CONCURRENCY, LISTWISE_RERANK_MODE
 from sweepai.core.chat import ChatGPT
 from sweepai.core.entities import Message, Snippet
 from sweepai.logn.cache import file_cache
@@ -895,26 +899,26 @@ f'''
         result_removed_trailing_newlines = result_str.rstrip("\n")
         return result_removed_trailing_newlines
 
-@file_cache()
-def listwise_rerank_snippets(
-    user_query,
-    code_snippets,
-    prompt_type="default",
-):
+def sliding_window_rerank(
+    code_snippets: list[Snippet],
+    rerank_window: Callable[[list[Snippet]], list[Snippet]],
+    window_size: int = 10,
+) -> list[Snippet]:
     # iterate from the bottom of the list to the top, sorting each n items then resorting with next n // 2 items
-    number_to_rerank_at_once = 10
-    stride = number_to_rerank_at_once // 2
+    stride = window_size // 2
+    if len(code_snippets) <= window_size:
+        return rerank_window(code_snippets) if code_snippets else []
     final_ordering = []
     prev_chunk = []
     for idx in range(len(code_snippets) - stride, 0, -stride):
         # if there is no prev_chunk, rerank the bottom n items
         if not prev_chunk:
-            reranked_chunk = RerankSnippetsBot().rerank_list_for_query(user_query, code_snippets[idx - stride:idx + stride], prompt_type=prompt_type)
+            reranked_chunk = rerank_window(code_snippets[idx - stride:idx + stride])
         # if there's a prev_chunk, rerank this chunk with the prev_chunk
         else:
             # chunk_to_rerank should be 5 new items and the top 5 items of the prev_chunk
-            chunk_to_rerank = code_snippets[idx - stride:idx] + prev_chunk[:stride]
-            reranked_chunk = RerankSnippetsBot().rerank_list_for_query(user_query, chunk_to_rerank, prompt_type=prompt_type)
+            chunk_to_rerank = code_snippets[max(idx - stride, 0):idx] + prev_chunk[:stride]
+            reranked_chunk = rerank_window(chunk_to_rerank)
         # last iteration, add all items
         if idx - stride <= 0:
             final_ordering = reranked_chunk + final_ordering
@@ -923,6 +927,59 @@ def listwise_rerank_snippets(
             final_ordering = reranked_chunk[-stride:] + final_ordering
         prev_chunk = reranked_chunk
     return final_ordering
+
+def tournament_rerank(
+    code_snippets: list[Snippet],
+    rerank_window: Callable[[list[Snippet]], list[Snippet]],
+    window_size: int = 10,
+    concurrency: int = LISTWISE_RERANK_CONCURRENCY,
+    seed: int | None = None,
+) -> list[Snippet]:
+    """
+    Rerank disjoint windows concurrently and promote the top window_size // 2 of each window to the next round,
+    until the candidates fit in one window. Takes about log2(n / window_size) rounds of LLM calls instead of n / stride.
+    Snippets knocked out in a round follow those of later rounds, ordered by their rank within their window.
+    With a seed the snippets are shuffled before being dealt into windows, otherwise they are dealt in input order.
+    """
+    stride = window_size // 2
+    if len(code_snippets) <= window_size:
+        return rerank_window(code_snippets) if code_snippets else []
+    candidates = list(code_snippets)
+    if seed is not None:
+        random.Random(seed).shuffle(candidates)
+    eliminated_rounds = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while len(candidates) > window_size:
+            # deal the candidates round robin, so the strongest ones aren't knocked out by each other in one window
+            num_windows = -(-len(candidates) // window_size)
+            windows = [candidates[i::num_windows] for i in range(num_windows)]
+            reranked_windows = list(executor.map(rerank_window, windows)) # map keeps the window order
+            candidates = [snippet for window in reranked_windows for snippet in window[:stride]]
+            eliminated = [(rank, window_index, snippet) for window_index, window in enumerate(reranked_windows) for rank, snippet in enumerate(window) if rank >= stride]
+            eliminated_rounds.append([snippet for _, _, snippet in sorted(eliminated, key=lambda item: item[:2])])
+    final_ordering = rerank_window(candidates)
+    for eliminated in reversed(eliminated_rounds):
+        final_ordering += eliminated
+    return final_ordering
+
+@file_cache(redis=True)
+def _listwise_rerank_snippets(user_query, code_snippets, prompt_type, mode, seed):
+    def rerank_window(snippets: list[Snippet]) -> list[Snippet]:
+        return RerankSnippetsBot().rerank_list_for_query(user_query, snippets, prompt_type=prompt_type)
+
+    if mode == "tournament":
+        return tournament_rerank(code_snippets, rerank_window, seed=seed)
+    return sliding_window_rerank(code_snippets, rerank_window)
+
+def listwise_rerank_snippets(
+    user_query,
+    code_snippets,
+    prompt_type="default",
+    mode=LISTWISE_RERANK_MODE,
+    seed=None,
+):
+    # file_cache only hashes the arguments it's passed, so the defaults are passed explicitly to key the cache on them
+    return _listwise_rerank_snippets(user_query, code_snippets, prompt_type, mode, seed)
     
 if __name__ == "__main__":
     # generate some test snippets
@@ -9,7 +9,7 @@ from sweepai.utils.cohere_utils import cohere_rerank_call
 from dataclasses import field, dataclass
 from tqdm import tqdm
 
-from sweepai.utils.github_utils import ClonedRepo, MockClonedRepo
+from sweepai.utils.github_utils import ClonedRepo, MockClonedRepo, deepen_history
 
 NUM_COMMITS = 10000
 
@@ -155,6 +155,7 @@ def query_relevant_commits(query: str, cloned_repo: ClonedRepo, relevant_file_pa
     last_commits = []
     viewed_commits = set()
     all_lines = []
+    deepen_history(cloned_repo.git_repo) # blame of a shallow clone attributes every older line to the boundary commit
     for file_path in relevant_file_paths:
         all_lines.extend(cloned_repo.git_repo.git.blame("HEAD", "--", file_path).splitlines())
 
@@ -1,24 +1,24 @@
+import re
 
 from sweepai.config.client import SweepConfig
 
 # post process rip grep output to be more condensed
 def post_process_rg_output(root_directory: str, sweep_config: SweepConfig, output: str):
     processed_output = ""
-    output_lines = output.split("\n")
-    # empty lines are present at end of output
-    output_lines = [line for line in output_lines if line]
     file_output_dict = {}
     file_to_num_occurrences = {}
-    for line in output_lines:
-        filename, content = line.split(":", 1)
-        filename = filename[len(root_directory) + 1:]
-        if not sweep_config.is_file_excluded_aggressive(root_directory, filename):
-            if filename not in file_output_dict:
-                file_output_dict[filename] = ""
-            file_output_dict[filename] += (content + "\n")
-            if filename not in file_to_num_occurrences:
-                file_to_num_occurrences[filename] = 0
-            file_to_num_occurrences[filename] += 1
+    exclusion_matcher = sweep_config.exclusion_matcher
+    # --heading output, one block per file separated by empty lines, with "--" between non-adjacent context
+    for block in output.split("\n\n"):
+        if not block.strip():
+            continue
+        full_file_path, *lines = block.split("\n")
+        filename = full_file_path[len(root_directory) + 1:]
+        if not exclusion_matcher.is_file_excluded_aggressive(root_directory, filename):
+            content_lines = [line for line in lines if line and line != "--"]
+            file_output_dict[filename] = "".join(line + "\n" for line in content_lines)
+            # context lines are numbered like 12-code, matches like 12:code
+            file_to_num_occurrences[filename] = sum(1 for line in content_lines if re.match(r"\d+:", line))
     
     # determine if we need to truncate the output
     total_output_length = sum([len(line) for content in file_output_dict.values() for line in content])
@@ -51,12 +51,13 @@ def post_process_rg_output(root_directory: str, sweep_config: SweepConfig, outpu
 
 def cleaned_rg_output(root_directory: str, sweep_config: SweepConfig, output: str):
     results = {}
+    exclusion_matcher = sweep_config.exclusion_matcher
     for block in output.split("\n\n"):
         if not block.strip():
             continue
         full_file_path, *contents = block.split("\n")
         file_path = full_file_path[len(root_directory) + 1:]
-        if sweep_config.is_file_excluded_aggressive(root_directory, file_path):
+        if exclusion_matcher.is_file_excluded_aggressive(root_directory, file_path):
             continue
         results[file_path.removeprefix(root_directory).removeprefix("/")] = "\n".join(contents)
     return results
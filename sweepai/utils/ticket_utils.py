@@ -4,21 +4,31 @@ import traceback
 from time import time
 from concurrent.futures import ThreadPoolExecutor
 import concurrent.futures
+from itertools import repeat
+from typing import NamedTuple
 
 from loguru import logger
-from tqdm import tqdm
 import networkx as nx
+import numpy as np
 from sweepai.utils.chat_logger import ChatLogger
 from sweepai.utils.streamable_functions import streamable
 
 from sweepai.utils.timer import Timer
 from sweepai.agents.analyze_snippets import AnalyzeSnippetAgent
 from sweepai.config.client import SweepConfig, get_blocked_dirs
-from sweepai.config.server import COHERE_API_KEY, VOYAGE_API_KEY
+from sweepai.config.server import (
+    CASCADE_MAX_ENTROPY,
+    CASCADE_RANKING_ENABLED,
+    CASCADE_SHRINK_RATIO,
+    CASCADE_SKIP_MARGIN,
+    COHERE_API_KEY,
+    VOYAGE_API_KEY,
+)
 from sweepai.core.context_pruning import RepoContextManager, add_relevant_files_to_top_snippets, build_import_trees, parse_query_for_files
 from sweepai.core.entities import Snippet
 from sweepai.core.lexical_search import (
     compute_vector_search_scores,
+    overlay_lexical_search_index,
     prepare_lexical_search_index,
     search_index,
 )
@@ -112,12 +122,7 @@ def separate_snippets_by_type(snippets: list[Snippet]) -> SeparatedSnippets:
             separated_snippets.add_snippet(snippet, "source")
     return separated_snippets
 
-def apply_adjustment_score(
-    snippet_path: str,
-    old_score: float,
-):
-    snippet_score = old_score
-    file_path, *_ = snippet_path.rsplit(":", 1)
+def get_path_penalty(file_path: str) -> float:
     file_path = file_path.lower()
     # Penalize numbers as they are usually examples of:
     # 1. Test files (e.g. test_utils_3*.py)
@@ -128,12 +133,96 @@ def apply_adjustment_score(
     if not base_file_name:
         return 0
     num_numbers = sum(c.isdigit() for c in base_file_name)
-    snippet_score *= (1 - 1 / len(base_file_name)) ** num_numbers
-    return snippet_score
+    return (1 - 1 / len(base_file_name)) ** num_numbers
+
+def apply_adjustment_score(
+    snippet_path: str,
+    old_score: float,
+):
+    file_path, *_ = snippet_path.rsplit(":", 1)
+    return old_score * get_path_penalty(file_path)
+
+def get_top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores, best first. Ties are broken by position, like a stable sort.
+    """
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    threshold = scores[np.argpartition(-scores, k - 1)[k - 1]]
+    above = np.flatnonzero(scores > threshold)
+    ties = np.flatnonzero(scores == threshold)[: k - len(above)]
+    candidates = np.concatenate((above, ties))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
 
 NUM_SNIPPETS_TO_RERANK = 100
 VECTOR_SEARCH_WEIGHT = 2
 
+class CascadeDecision(NamedTuple):
+    margin: float # gap between the kth and k+1th scores, relative to the top score
+    entropy: float # of the top 2k scores normalized to [0, 1], 1 when they're all equal
+    rerank_depth: int # snippets that score at least CASCADE_SHRINK_RATIO of the kth score
+    skip_reranking: bool
+
+def get_cascade_decision(
+    scores: list[float],
+    k: int,
+    skip_margin: float = CASCADE_SKIP_MARGIN,
+    max_entropy: float = CASCADE_MAX_ENTROPY,
+    shrink_ratio: float = CASCADE_SHRINK_RATIO,
+) -> CascadeDecision:
+    """
+    Decide from the fused search scores whether the rerankers can still change the top k.
+    They're skipped when the kth snippet is clearly ahead of the k+1th and the top scores are concentrated.
+    Otherwise they only need to see the snippets close enough to the kth score to move into the top k.
+    """
+    scores = np.sort(np.asarray(scores, dtype=np.float64))[::-1]
+    if len(scores) <= k:
+        # every snippet is in the top k already
+        return CascadeDecision(1.0, 0.0, len(scores), True)
+    top_score = scores[0] if scores[0] > 0 else 1.0
+    margin = float((scores[k - 1] - scores[k]) / top_score)
+    top_scores = np.clip(scores[: 2 * k], 1e-12, None)
+    probabilities = top_scores / top_scores.sum()
+    entropy = float(-(probabilities * np.log(probabilities)).sum() / np.log(len(probabilities)))
+    rerank_depth = max(k, int(np.count_nonzero(scores >= scores[k - 1] * shrink_ratio)))
+    return CascadeDecision(margin, entropy, rerank_depth, margin >= skip_margin and entropy <= max_entropy)
+
+def fuse_search_scores(
+    snippets: list[Snippet],
+    content_to_lexical_score_list: list[dict[str, float]],
+    files_to_scores_list: list[dict[str, float]],
+    k: int,
+) -> list[list[Snippet]]:
+    """
+    Combine the lexical and vector scores of every snippet for each query, penalize numbered file names
+    and return the top k snippets per query. The fused scores are written back into content_to_lexical_score_list.
+    """
+    denotations = [snippet.denotation for snippet in snippets]
+    path_penalties = {file_path: get_path_penalty(file_path) for file_path in set(snippet.file_path for snippet in snippets)}
+    penalties = np.fromiter((path_penalties[snippet.file_path] for snippet in snippets), dtype=np.float64, count=len(snippets))
+    ranked_snippets_list = []
+    for content_to_lexical_score, files_to_scores in zip(content_to_lexical_score_list, files_to_scores_list):
+        # on the approximate path only the top snippets are scored, the rest score at most the lowest of those
+        default_vector_score = min(files_to_scores.values(), default=0.04)
+        vector_scores = np.fromiter(
+            map(files_to_scores.get, denotations, repeat(default_vector_score)), dtype=np.float64, count=len(snippets)
+        )
+        lexical_scores = np.fromiter(
+            map(content_to_lexical_score.get, denotations, repeat(np.nan)), dtype=np.float64, count=len(snippets)
+        )
+        # roughly fine tuned vector score weight based on average score
+        # from search_eval.py on 50 test cases May 13th, 2024 on an internal benchmark
+        scores = np.where(
+            np.isnan(lexical_scores),
+            0.02 * vector_scores,
+            (lexical_scores + (vector_scores * VECTOR_SEARCH_WEIGHT)) / (VECTOR_SEARCH_WEIGHT + 1),
+        ) * penalties
+        content_to_lexical_score.update(zip(denotations, scores.tolist()))
+        ranked_snippets_list.append([snippets[i] for i in get_top_k_indices(scores, k)])
+    return ranked_snippets_list
+
 @streamable
 def multi_get_top_k_snippets(
     cloned_repo: ClonedRepo,
@@ -142,6 +231,7 @@ def multi_get_top_k_snippets(
     do_not_use_file_cache: bool = False, # added for review_pr
     use_repo_dir: bool = False,
     seed: str = "", # for caches
+    overlay_files: dict[str, str | None] | None = None, # search as if these files had these contents, None if removed
 ):
     """
     Handles multiple queries at once now. Makes the vector search faster.
@@ -162,8 +252,12 @@ def multi_get_top_k_snippets(
         ):
             yield message, [], snippets, []
         logger.info(f"Lexical indexing took {timer.time_elapsed} seconds")
+        if overlay_files:
+            snippets, lexical_index = overlay_lexical_search_index(
+                repository_directory, snippets, lexical_index, overlay_files
+            )
         for snippet in snippets:
-            snippet.file_path = snippet.file_path[len(cloned_repo.cached_dir) + 1 :]
+            snippet.file_path = snippet.file_path[len(repository_directory) + 1 :]
         yield "Searching lexical index...", [], snippets, []
         with Timer() as timer:
             content_to_lexical_score_list = [search_index(query, lexical_index) for query in queries]
@@ -173,32 +267,18 @@ def multi_get_top_k_snippets(
     assert content_to_lexical_score_list[0]
 
     with Timer() as timer:
-        files_to_scores_list = compute_vector_search_scores(queries, snippets)
+        files_to_scores_list = compute_vector_search_scores(
+            queries,
+            snippets,
+            # overlaid or uncached searches don't match the commit, so they can't use its embedding store
+            repo_directory=repository_directory if not (do_not_use_file_cache or overlay_files) else None,
+            seed=seed,
+        )
     logger.info(f"Vector search took {timer.time_elapsed} seconds")
 
-    for i, query in enumerate(queries):
-        for snippet in tqdm(snippets):
-            vector_score = files_to_scores_list[i].get(snippet.denotation, 0.04)
-            snippet_score = 0.02
-            if snippet.denotation in content_to_lexical_score_list[i]:
-                # roughly fine tuned vector score weight based on average score
-                # from search_eval.py on 50 test cases May 13th, 2024 on an internal benchmark
-                snippet_score = (content_to_lexical_score_list[i][snippet.denotation] + (
-                    vector_score * VECTOR_SEARCH_WEIGHT
-                )) / (VECTOR_SEARCH_WEIGHT + 1)
-                content_to_lexical_score_list[i][snippet.denotation] = snippet_score
-            else:
-                content_to_lexical_score_list[i][snippet.denotation] = snippet_score * vector_score
-            content_to_lexical_score_list[i][snippet.denotation] = apply_adjustment_score(
-                snippet_path=snippet.denotation, old_score=content_to_lexical_score_list[i][snippet.denotation]
-            )
-    ranked_snippets_list = [
-        sorted(
-            snippets,
-            key=lambda snippet: content_to_lexical_score[snippet.denotation],
-            reverse=True,
-        )[:k] for content_to_lexical_score in content_to_lexical_score_list
-    ]
+    with Timer() as timer:
+        ranked_snippets_list = fuse_search_scores(snippets, content_to_lexical_score_list, files_to_scores_list, k)
+    logger.info(f"Score fusion took {timer.time_elapsed} seconds")
     yield "Finished hybrid search, currently performing reranking...", ranked_snippets_list, snippets, content_to_lexical_score_list
 
 @streamable
@@ -330,6 +410,33 @@ def multi_prep_snippets(
             cloned_repo, queries[0], k
         ):
             yield message, ranked_snippets
+        content_to_lexical_score_list = [content_to_lexical_score]
+    # cascade: skip or shrink the rerankers when the fused scores of every query already settle the top k
+    cascade_decisions = [get_cascade_decision(list(scores.values()), k) for scores in content_to_lexical_score_list]
+    skip_later_stages = all(decision.skip_reranking for decision in cascade_decisions)
+    rerank_depth = max(decision.rerank_depth for decision in cascade_decisions)
+    logger.info(f"Cascade ranking {'skipping' if skip_later_stages else f'reranking {rerank_depth} snippets'}{'' if CASCADE_RANKING_ENABLED else ' (disabled)'}: {cascade_decisions}")
+    posthog.capture(
+        cloned_repo.repo_full_name,
+        "cascade ranking decision",
+        properties={
+            "query": queries[0],
+            "k": k,
+            "enabled": CASCADE_RANKING_ENABLED,
+            "skip_reranking": skip_later_stages,
+            "rerank_depth": rerank_depth,
+            "margins": [decision.margin for decision in cascade_decisions],
+            "entropies": [decision.entropy for decision in cascade_decisions],
+            "top_k": [snippet.denotation for snippet in ranked_snippets[:k]], # to compare against labels when tuning
+        },
+    )
+    type_to_rerank_count = dict(rerank_count)
+    skip_rerank_calls = False # keeps the type filtering and caps below, with the fused scores in place of the reranker's
+    if CASCADE_RANKING_ENABLED:
+        if skip_later_stages:
+            skip_rerank_calls = skip_reranking = True
+        type_to_rerank_count = {type_name: min(count, rerank_depth) for type_name, count in rerank_count.items()}
+        NUM_SNIPPETS_TO_RERANK = min(NUM_SNIPPETS_TO_RERANK, rerank_depth)
     separated_snippets = separate_snippets_by_type(snippets)
     yield f"Retrieved top {k} snippets, currently reranking:\n", ranked_snippets
     if not skip_pointwise_reranking:
@@ -343,22 +450,28 @@ def multi_prep_snippets(
                 snippets_subset,
                 key=lambda snippet: content_to_lexical_score[snippet.denotation],
                 reverse=True,
-            )[:rerank_count[type_name]])
+            )[:type_to_rerank_count[type_name]])
         new_content_to_lexical_score_by_type = {}
 
-        with Timer() as timer:
-            try:
-                with ThreadPoolExecutor() as executor:
-                    future_to_type = {executor.submit(process_snippets, type_name, queries[0], snippets_subset, content_to_lexical_score, NUM_SNIPPETS_TO_KEEP, rerank_count[type_name], {}): type_name for type_name, snippets_subset in separated_snippets}
-                    for future in concurrent.futures.as_completed(future_to_type):
-                        type_name = future_to_type[future]
-                        new_content_to_lexical_score_by_type[type_name] = future.result()[1]
-            except RuntimeError as e:
-                # Fallback to sequential processing
-                logger.warning(e)
-                for type_name, snippets_subset in separated_snippets:
-                    new_content_to_lexical_score_by_type[type_name] = process_snippets(type_name, queries[0], snippets_subset, content_to_lexical_score, NUM_SNIPPETS_TO_KEEP, rerank_count[type_name], {})[1]
-        logger.info(f"Reranked snippets took {timer.time_elapsed} seconds")
+        if skip_rerank_calls:
+            for type_name, snippets_subset in separated_snippets:
+                new_content_to_lexical_score_by_type[type_name] = {
+                    snippet.denotation: content_to_lexical_score[snippet.denotation] for snippet in snippets_subset
+                }
+        else:
+            with Timer() as timer:
+                try:
+                    with ThreadPoolExecutor() as executor:
+                        future_to_type = {executor.submit(process_snippets, type_name, queries[0], snippets_subset, content_to_lexical_score, NUM_SNIPPETS_TO_KEEP, type_to_rerank_count[type_name], {}): type_name for type_name, snippets_subset in separated_snippets}
+                        for future in concurrent.futures.as_completed(future_to_type):
+                            type_name = future_to_type[future]
+                            new_content_to_lexical_score_by_type[type_name] = future.result()[1]
+                except RuntimeError as e:
+                    # Fallback to sequential processing
+                    logger.warning(e)
+                    for type_name, snippets_subset in separated_snippets:
+                        new_content_to_lexical_score_by_type[type_name] = process_snippets(type_name, queries[0], snippets_subset, content_to_lexical_score, NUM_SNIPPETS_TO_KEEP, type_to_rerank_count[type_name], {})[1]
+            logger.info(f"Reranked snippets took {timer.time_elapsed} seconds")
 
         for type_name, snippets_subset in separated_snippets:
             new_content_to_lexical_scores = new_content_to_lexical_score_by_type[type_name]
@@ -384,7 +497,10 @@ def multi_prep_snippets(
             filtered_subset_snippets = []
             for idx, snippet in enumerate(snippets_subset[:max_results]):
                 percentile = 0 if top_score == 0 else snippet.score / top_score
-                if percentile < type_to_percentile_floor[type_name] or snippet.score < type_to_score_floor[type_name]:
+                # the floors are calibrated for reranker scores, fused search scores are only cut by count
+                if not skip_rerank_calls and (
+                    percentile < type_to_percentile_floor[type_name] or snippet.score < type_to_score_floor[type_name]
+                ):
                     break 
                 logger.info(f"{idx}: {snippet.denotation} {snippet.score} {percentile}")
                 snippet.type_name = type_name
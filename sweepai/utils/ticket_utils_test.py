@@ -0,0 +1,167 @@
+import random
+from types import SimpleNamespace
+
+import numpy as np
+
+from sweepai.core.entities import Snippet
+from sweepai.utils import ticket_utils
+from sweepai.utils.streamable_functions import streamable
+from sweepai.utils.ticket_utils import (
+    VECTOR_SEARCH_WEIGHT,
+    apply_adjustment_score,
+    fuse_search_scores,
+    get_cascade_decision,
+    get_top_k_indices,
+    multi_prep_snippets,
+)
+
+
+def fuse_search_scores_reference(snippets, content_to_lexical_score_list, files_to_scores_list, k):
+    # the per-snippet loop fuse_search_scores replaced
+    for content_to_lexical_score, files_to_scores in zip(content_to_lexical_score_list, files_to_scores_list):
+        for snippet in snippets:
+            vector_score = files_to_scores.get(snippet.denotation, 0.04)
+            snippet_score = 0.02
+            if snippet.denotation in content_to_lexical_score:
+                snippet_score = (content_to_lexical_score[snippet.denotation] + (
+                    vector_score * VECTOR_SEARCH_WEIGHT
+                )) / (VECTOR_SEARCH_WEIGHT + 1)
+                content_to_lexical_score[snippet.denotation] = snippet_score
+            else:
+                content_to_lexical_score[snippet.denotation] = snippet_score * vector_score
+            content_to_lexical_score[snippet.denotation] = apply_adjustment_score(
+                snippet_path=snippet.denotation, old_score=content_to_lexical_score[snippet.denotation]
+            )
+    return [
+        sorted(snippets, key=lambda snippet: content_to_lexical_score[snippet.denotation], reverse=True)[:k]
+        for content_to_lexical_score in content_to_lexical_score_list
+    ]
+
+
+def test_fuse_search_scores_matches_reference():
+    # Given: Snippets with lexical hits for some and vector scores for all, across several queries
+    rng = random.Random(0)
+    file_paths = ["src/main.py", "src/utils_2.py", "migrations/2022_01_01_init.sql", "README.md", "src/a/b/c.ts"]
+    snippets = [
+        Snippet(content="", start=start, end=start + 40, file_path=file_path)
+        for file_path in file_paths
+        for start in range(0, 400, 40)
+    ]
+    lexical_scores = [
+        {snippet.denotation: rng.random() for snippet in rng.sample(snippets, 10)}
+        for _ in range(3)
+    ]
+    vector_scores = [
+        # round so some scores tie
+        {snippet.denotation: round(rng.random(), 1) for snippet in snippets}
+        for _ in range(3)
+    ]
+
+    # When: We fuse them with the vectorized and the reference implementation
+    expected_scores = [dict(scores) for scores in lexical_scores]
+    expected_ranked = fuse_search_scores_reference(snippets, expected_scores, vector_scores, k=15)
+    ranked = fuse_search_scores(snippets, lexical_scores, vector_scores, k=15)
+
+    # Then: Verify the scores and rankings are identical
+    for scores, expected in zip(lexical_scores, expected_scores):
+        assert scores.keys() == expected.keys()
+        for denotation in scores:
+            assert np.isclose(scores[denotation], expected[denotation], rtol=1e-12, atol=0)
+    assert ranked == expected_ranked
+
+
+def test_get_top_k_indices_breaks_ties_by_position():
+    # Given: Scores with ties around the kth value
+    scores = np.array([0.1, 0.5, 0.3, 0.5, 0.3, 0.3, 0.9])
+
+    # When: We take the top k for every k
+    # Then: Verify it matches a stable descending sort
+    for k in range(len(scores) + 2):
+        expected = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
+        assert get_top_k_indices(scores, k).tolist() == expected
+
+
+def test_get_cascade_decision():
+    # Given: Fused scores where the top 3 clearly stand out, and scores that are nearly flat
+    decisive_scores = [0.9, 0.85, 0.8] + [0.1 - 0.001 * i for i in range(50)]
+    flat_scores = [0.5 - 0.001 * i for i in range(50)]
+
+    # When: We decide whether the rerankers can change the top 3
+    decisive = get_cascade_decision(decisive_scores, k=3)
+    flat = get_cascade_decision(flat_scores, k=3)
+
+    # Then: Verify only the decisive ranking skips them, and the flat one reranks everything close to the top 3
+    assert decisive.skip_reranking and decisive.rerank_depth == 3
+    assert not flat.skip_reranking and flat.rerank_depth == 50
+    assert get_cascade_decision([0.3, 0.2], k=3).skip_reranking
+
+
+class StubAnalyzeSnippetAgent:
+    def analyze_snippets(self, snippets, type_name, query):
+        return snippets
+
+
+def patch_cascade_skip(monkeypatch):
+    def process_snippets(*args, **kwargs):
+        raise AssertionError("the rerankers should be skipped")
+
+    monkeypatch.setattr(ticket_utils, "process_snippets", process_snippets)
+    monkeypatch.setattr(ticket_utils, "AnalyzeSnippetAgent", StubAnalyzeSnippetAgent)
+    monkeypatch.setattr(ticket_utils, "CASCADE_RANKING_ENABLED", True)
+    monkeypatch.setattr(ticket_utils.posthog, "capture", lambda *args, **kwargs: None)
+
+
+def test_cascade_skip_keeps_type_filtering(monkeypatch):
+    # Given: Decisive fused scores where a lock file and a build output rank among the top snippets
+    scores = {
+        "src/main.py:0-40": 0.9,
+        "package-lock.json:0-40": 0.88,
+        "src/utils.py:0-40": 0.85,
+        "build/main.py:0-40": 0.8,
+        "tests/test_main.py:0-40": 0.1,
+        **{f"src/other_{i}.py:0-40": 0.09 - 0.001 * i for i in range(20)},
+    }
+    snippets = [Snippet(content="", start=0, end=40, file_path=denotation.split(":")[0]) for denotation in scores]
+
+    @streamable
+    def get_top_k_snippets(cloned_repo, query, k):
+        ranked_snippets = sorted(snippets, key=lambda snippet: scores[snippet.denotation], reverse=True)[:k]
+        yield "Finished hybrid search", ranked_snippets, snippets, dict(scores)
+
+    monkeypatch.setattr(ticket_utils, "get_top_k_snippets", get_top_k_snippets)
+    patch_cascade_skip(monkeypatch)
+    assert get_cascade_decision(list(scores.values()), k=4).skip_reranking
+
+    # When: We prep snippets with the cascade enabled
+    ranked_snippets = multi_prep_snippets(SimpleNamespace(repo_full_name="sweepai/sweep"), ["fix main"], k=4)
+
+    # Then: Verify junk is dropped and the rest are ranked by their fused scores without calling the rerankers
+    assert [snippet.denotation for snippet in ranked_snippets] == [
+        "src/main.py:0-40", "src/utils.py:0-40", "tests/test_main.py:0-40", "src/other_0.py:0-40"
+    ]
+
+
+def test_cascade_skip_keeps_multi_query_context(monkeypatch):
+    # Given: Two queries whose fused scores each settle a different top 8
+    snippets = [Snippet(content="", start=0, end=40, file_path=f"src/module_{i}.py") for i in range(40)]
+    scores_list = [
+        {snippet.denotation: (0.9 if i < 8 else 0.05) - 0.001 * i for i, snippet in enumerate(snippets)},
+        {snippet.denotation: (0.9 if 8 <= i < 16 else 0.05) - 0.001 * i for i, snippet in enumerate(snippets)},
+    ]
+
+    @streamable
+    def multi_get_top_k_snippets(cloned_repo, queries, k):
+        ranked_snippets_list = [
+            sorted(snippets, key=lambda snippet: scores[snippet.denotation], reverse=True)[:k] for scores in scores_list
+        ]
+        yield "Finished hybrid search", ranked_snippets_list, snippets, [dict(scores) for scores in scores_list]
+
+    monkeypatch.setattr(ticket_utils, "multi_get_top_k_snippets", multi_get_top_k_snippets)
+    patch_cascade_skip(monkeypatch)
+    assert all(get_cascade_decision(list(scores.values()), k=8).skip_reranking for scores in scores_list)
+
+    # When: We prep snippets for both queries with the cascade enabled
+    ranked_snippets = multi_prep_snippets(SimpleNamespace(repo_full_name="sweepai/sweep"), ["fix main", "main module"], k=8)
+
+    # Then: Verify the rank fusion weights aren't cut by the reranker floors, so k snippets are returned
+    assert len(ranked_snippets) == 8
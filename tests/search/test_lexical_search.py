@@ -1,4 +1,8 @@
-from sweepai.core.lexical_search import tokenize_call
+import re
+import time
+from pathlib import Path
+
+from sweepai.core.lexical_search import tokenize_code
 
 file_contents = """\
 # TODO: Add file validation
@@ -1156,6 +1160,59 @@ def on_ticket(
     return {"success": True}
 """
 
-tokens = tokenize_call(file_contents)
-symbols = list(set([token.text for token in tokens]))
-print(symbols)
+GOLDEN_TOKENS_PATH = Path(__file__).parent / "tokenize_code_golden.txt"
+REPO_ROOT = Path(__file__).parents[2]
+
+
+def tokenize_code_reference(code: str) -> str:
+    # the original multi-pass tokenizer, tokenize_code must match it exactly
+    variable_pattern = re.compile(r"([A-Z][a-z]+|[a-z]+|[A-Z]+(?=[A-Z]|$))")
+    tokens = []
+    for m in re.finditer(r"\b\w{2,}\b", code):
+        for section in m.group().split("_"):
+            for part in variable_pattern.findall(section):
+                if len(part) < 2:
+                    continue
+                if sum(1 for c in part if 'a' <= c <= 'z' or 'A' <= c <= 'Z' or '0' <= c <= '9') > len(part) // 2 \
+                    and len(part) / len(set(part)) < 4:
+                    tokens.append(part.lower())
+    return " ".join(tokens)
+
+
+def test_tokenize_code_golden_output():
+    assert tokenize_code(file_contents) == GOLDEN_TOKENS_PATH.read_text()
+
+
+def test_tokenize_code_matches_reference_on_edge_cases():
+    edge_cases = [
+        "",
+        "a",
+        "ab",
+        "HTTPServer getHTTPResponse2XX parseURL_v2 ABc aB A_B AB_CD",
+        "__init__ _private MAX_RETRIES snake_case_name CamelCaseName",
+        "ABC1 AB1C x1y2z3 abc123def 0xDEADBEEF",
+        "aaaa aaab AAAA AAAAB Aaaaa zzzzzzzzzzzz",
+        "café naïveValue ÉTATCivil日本語Name straße_Strasse",
+        "URL\nHTTP\tTCP\r\nEND",
+        "trailing newline UPPER\n",
+    ]
+    for code in edge_cases:
+        assert tokenize_code(code) == tokenize_code_reference(code), code
+
+
+def test_tokenize_code_matches_reference_on_repo_sources():
+    for path in sorted((REPO_ROOT / "sweepai").rglob("*.py")):
+        code = path.read_text(errors="ignore")
+        assert tokenize_code(code) == tokenize_code_reference(code), path
+
+
+if __name__ == "__main__":
+    # throughput benchmark over the repo's own sources
+    codes = [path.read_text(errors="ignore") for path in (REPO_ROOT / "sweepai").rglob("*.py")]
+    total_megabytes = sum(len(code) for code in codes) / 1e6
+    for name, tokenizer in (("reference", tokenize_code_reference), ("tokenize_code", tokenize_code)):
+        start = time.time()
+        for code in codes:
+            tokenizer(code)
+        elapsed = time.time() - start
+        print(f"{name}: {total_megabytes / elapsed:.2f} MB/s ({elapsed:.2f}s for {total_megabytes:.2f} MB)")
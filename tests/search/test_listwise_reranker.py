@@ -0,0 +1,125 @@
+"""
+Offline evaluation of the listwise rerank modes against a stub LLM that ranks each window by a hidden relevance plus
+noise, with a fixed latency per call. Run `python -m tests.search.test_listwise_reranker` for the full comparison.
+"""
+import math
+import random
+import threading
+import time
+import zlib
+
+from sweepai.config.server import LISTWISE_RERANK_MODE
+from sweepai.core.entities import Snippet
+from sweepai.utils import openai_listwise_reranker
+from sweepai.utils.openai_listwise_reranker import listwise_rerank_snippets, sliding_window_rerank, tournament_rerank
+
+
+class StubReranker:
+    """Stands in for RerankSnippetsBot.rerank_list_for_query, deterministic for a given window."""
+
+    def __init__(self, relevance: dict[str, float], noise: float = 0.2, latency: float = 0.0):
+        self.relevance = relevance
+        self.noise = noise
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, snippets: list[Snippet]) -> list[Snippet]:
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        rng = random.Random(zlib.crc32("\n".join(snippet.denotation for snippet in snippets).encode()))
+        noisy_scores = {snippet.denotation: self.relevance[snippet.denotation] + rng.gauss(0, self.noise) for snippet in snippets}
+        return sorted(snippets, key=lambda snippet: noisy_scores[snippet.denotation], reverse=True)
+
+
+def make_rerank_problem(num_snippets: int = 100, seed: int = 0) -> tuple[list[Snippet], dict[str, float]]:
+    # the first-stage ranking is a noisy version of the hidden relevance, like lexical and vector search
+    rng = random.Random(seed)
+    snippets = [Snippet(content="", start=0, end=10, file_path=f"src/file_{i}.py") for i in range(num_snippets)]
+    relevance = {snippet.denotation: rng.random() for snippet in snippets}
+    first_stage_scores = {denotation: score + rng.gauss(0, 0.3) for denotation, score in relevance.items()}
+    snippets.sort(key=lambda snippet: first_stage_scores[snippet.denotation], reverse=True)
+    return snippets, relevance
+
+
+def ndcg_at_k(ranking: list[Snippet], relevance: dict[str, float], k: int = 10) -> float:
+    ideal = sorted(relevance.values(), reverse=True)[:k]
+    dcg = sum(relevance[snippet.denotation] / math.log2(i + 2) for i, snippet in enumerate(ranking[:k]))
+    return dcg / sum(score / math.log2(i + 2) for i, score in enumerate(ideal))
+
+
+def evaluate(rerank, num_problems: int = 20, num_snippets: int = 100, latency: float = 0.0):
+    ndcgs, calls, elapsed = [], 0, 0.0
+    for problem_seed in range(num_problems):
+        snippets, relevance = make_rerank_problem(num_snippets, seed=problem_seed)
+        stub_reranker = StubReranker(relevance, latency=latency)
+        start = time.time()
+        ranking = rerank(snippets, stub_reranker)
+        elapsed += time.time() - start
+        assert sorted(snippet.denotation for snippet in ranking) == sorted(snippet.denotation for snippet in snippets)
+        ndcgs.append(ndcg_at_k(ranking, relevance))
+        calls += stub_reranker.calls
+    return sum(ndcgs) / num_problems, calls / num_problems, elapsed / num_problems
+
+
+def test_rerank_modes_keep_every_snippet():
+    # Given: Lists of every length around the window and stride sizes
+    for num_snippets in range(0, 33):
+        snippets, relevance = make_rerank_problem(num_snippets)
+
+        # When: We rerank them with both modes
+        for rerank in (sliding_window_rerank, tournament_rerank):
+            ranking = rerank(snippets, StubReranker(relevance))
+
+            # Then: Verify every snippet comes back exactly once
+            assert sorted(snippet.denotation for snippet in ranking) == sorted(snippet.denotation for snippet in snippets)
+
+
+def test_listwise_rerank_snippets_passes_the_mode_to_the_cache(monkeypatch):
+    # Given: The cached reranker, which file_cache only keys on the arguments it's passed
+    calls = []
+    monkeypatch.setattr(openai_listwise_reranker, "_listwise_rerank_snippets", lambda *args, **kwargs: calls.append((args, kwargs)))
+    snippets, _ = make_rerank_problem(5)
+
+    # When: We rerank with the default mode and then with an explicit one
+    listwise_rerank_snippets("query", snippets)
+    listwise_rerank_snippets("query", snippets, mode="tournament", seed=1)
+
+    # Then: Verify the mode and seed are always passed, so changing LISTWISE_RERANK_MODE changes the cache key
+    assert calls == [
+        (("query", snippets, "default", LISTWISE_RERANK_MODE, None), {}),
+        (("query", snippets, "default", "tournament", 1), {}),
+    ]
+
+
+def test_tournament_rerank_is_deterministic_for_a_seed():
+    # Given: A rerank problem and concurrent window calls with varying latency
+    snippets, relevance = make_rerank_problem(100)
+
+    # When: We rerank it repeatedly with the same seed
+    rankings = [
+        [snippet.denotation for snippet in tournament_rerank(snippets, StubReranker(relevance, latency=0.001 * i), seed=42)]
+        for i in range(3)
+    ]
+
+    # Then: Verify the results are identical
+    assert rankings[0] == rankings[1] == rankings[2]
+
+
+def test_tournament_rerank_matches_sliding_window_quality():
+    # Given: The same rerank problems for both modes
+    # When: We evaluate them with the stub LLM
+    sliding_ndcg, sliding_calls, _ = evaluate(sliding_window_rerank)
+    tournament_ndcg, tournament_calls, _ = evaluate(tournament_rerank)
+
+    # Then: Verify the tournament ranks the top snippets at least about as well
+    assert tournament_ndcg >= sliding_ndcg - 0.02
+    assert tournament_calls <= sliding_calls * 1.5
+
+
+if __name__ == "__main__":
+    # ranking quality and wall time with 0.2s per LLM call
+    for name, rerank in (("sliding", sliding_window_rerank), ("tournament", tournament_rerank)):
+        ndcg, calls, elapsed = evaluate(rerank, num_problems=5, latency=0.2)
+        print(f"{name}: ndcg@10={ndcg:.3f}, {calls:.0f} LLM calls, {elapsed:.2f}s per rerank of 100 snippets")
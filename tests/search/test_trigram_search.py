@@ -0,0 +1,198 @@
+"""
+Checks that the trigram index answers code searches exactly like ripgrep. Run `python -m tests.search.test_trigram_search`
+to benchmark it against rg on REPO_DIRECTORY, this repo by default.
+"""
+import os
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+import git
+import pytest
+
+from sweepai.core import trigram_search
+from sweepai.core.trigram_search import get_required_literals, get_trigram_index, search_code
+
+ripgrep_cases = [
+    ("get_user", ["-i", "-C=3"], dict(ignore_case=True, context=3)),
+    ("user", ["-i", "-w", "-C=1"], dict(ignore_case=True, word=True, context=1)),
+    (r"def \w+\(self", ["-C=2"], dict(ignore_case=False, context=2)),
+    ("^import (os|re)$", ["-i"], dict(ignore_case=True)),
+    ("x", ["-i", "-C=5"], dict(ignore_case=True, context=5)),
+]
+
+
+def run_ripgrep(repo_dir: str, pattern: str, flags: list[str]) -> str:
+    # decoded by hand since text=True would turn \r\n into \n
+    return subprocess.run(
+        ["rg", "-n", "--heading", "--sort-files", *flags, pattern],
+        cwd=repo_dir, capture_output=True, stdin=subprocess.DEVNULL,
+    ).stdout.decode()
+
+
+@pytest.fixture
+def repo_dir(tmp_path):
+    git_repo = git.Repo.init(tmp_path)
+    files = {
+        "app/users.py": "import os\n\nclass Users:\n    def get_user(self, user_id):\n        return self.users[user_id]\n\n"
+        + "".join(f"    # padding {i}\n" for i in range(8))
+        + "    def get_user_name(self, user_id):\n        return self.get_user(user_id).name\n",
+        "app/users/__init__.py": "from app.users import Users\n",
+        "app.json": '{"user": "GET_USER"}\n',
+        "README.md": "Call get_user to fetch a user.\r\nusers are cached.\n",
+        ".github/workflow.yml": "get_user: hidden\n",
+        "build/out.py": "get_user = None\n",
+        ".gitignore": "build/\n",
+    }
+    for file_path, contents in files.items():
+        os.makedirs(tmp_path / os.path.dirname(file_path), exist_ok=True)
+        (tmp_path / file_path).write_text(contents)
+    (tmp_path / "logo.png").write_bytes(b"\x89PNG\0get_user")
+    git_repo.index.add([file_path for file_path in files if not file_path.startswith("build/")] + ["logo.png"])
+    git_repo.index.commit("initial commit")
+    return str(tmp_path)
+
+
+def test_get_required_literals():
+    # Given: Regexes with required, optional and alternative parts
+    # When: We extract the literals every match contains
+    # Then: Verify only the required runs of at least three characters are kept
+    assert get_required_literals("get_user") == ["get_user"]
+    assert get_required_literals(r"def \w+\(self") == ["def ", "(self"]
+    assert get_required_literals(r"(?:class )+User(s)?") == ["class ", "User"]
+    assert get_required_literals("foo|bar") == []
+    assert get_required_literals("ab.cd") == []
+
+
+def test_search_code_formats_like_ripgrep(repo_dir):
+    # Given: An indexed repo with matches in adjacent and distant lines, and hidden, ignored and binary files
+    get_trigram_index(repo_dir)
+
+    # When: We search it with context lines
+    output = search_code(repo_dir, "get_user", ignore_case=True, context=1)
+
+    # Then: Verify the output is ripgrep's --heading format, sorted by path components
+    assert output == (
+        "README.md\n"
+        "1:Call get_user to fetch a user.\r\n"
+        "2-users are cached.\n"
+        "\n"
+        "app/users.py\n"
+        "3-class Users:\n"
+        "4:    def get_user(self, user_id):\n"
+        "5-        return self.users[user_id]\n"
+        "--\n"
+        "14-    # padding 7\n"
+        "15:    def get_user_name(self, user_id):\n"
+        "16:        return self.get_user(user_id).name\n"
+        "\n"
+        "app.json\n"
+        '1:{"user": "GET_USER"}\n'
+    )
+    assert search_code(repo_dir, "get_user", ignore_case=False, word=True) == (
+        "README.md\n1:Call get_user to fetch a user.\r\n\napp/users.py\n4:    def get_user(self, user_id):\n"
+        "16:        return self.get_user(user_id).name\n"
+    )
+    assert search_code(repo_dir, "does_not_exist") == ""
+
+
+@pytest.mark.skipif(shutil.which("rg") is None, reason="ripgrep is not installed")
+def test_search_code_matches_ripgrep(repo_dir):
+    # Given: An indexed repo and literal, word, regex and short queries
+    get_trigram_index(repo_dir)
+    for pattern, flags, kwargs in ripgrep_cases:
+        # When: We search with ripgrep and with the trigram index
+        # Then: Verify the outputs are identical
+        assert search_code(repo_dir, pattern, **kwargs) == run_ripgrep(repo_dir, pattern, flags)
+
+
+@pytest.mark.skipif(shutil.which("rg") is None, reason="ripgrep is not installed")
+def test_search_code_uses_ripgrep_until_the_index_is_built(repo_dir):
+    # Given: A repo without an index
+    pattern, flags, kwargs = ripgrep_cases[0]
+    expected_output = run_ripgrep(repo_dir, pattern, flags)
+
+    # When: We search it, which starts building the index in the background
+    output = search_code(repo_dir, pattern, **kwargs)
+    deadline = time.time() + 30
+    while get_trigram_index(repo_dir, wait=False) is None and time.time() < deadline:
+        time.sleep(0.05)
+
+    # Then: Verify the first search ran rg, and later ones use the index with the same output
+    assert output == expected_output
+    assert get_trigram_index(repo_dir, wait=False) is not None
+    assert search_code(repo_dir, pattern, **kwargs) == expected_output
+
+
+@pytest.mark.skipif(shutil.which("rg") is None, reason="ripgrep is not installed")
+def test_search_code_uses_ripgrep_for_large_repos(repo_dir, monkeypatch):
+    # Given: A repo larger than the index allows
+    monkeypatch.setattr(trigram_search, "MAX_INDEXED_CHARACTERS", 10)
+
+    # When: We get its index and search it
+    index = get_trigram_index(repo_dir)
+
+    # Then: Verify there's no index and every search runs rg, including with absolute paths
+    assert index is None
+    for pattern, flags, kwargs in ripgrep_cases:
+        assert search_code(repo_dir, pattern, **kwargs) == run_ripgrep(repo_dir, pattern, flags)
+    assert search_code(repo_dir, "get_user", absolute_paths=True).startswith(os.path.join(repo_dir, "README.md") + "\n")
+
+
+def test_trigram_index_is_built_from_the_commit(repo_dir):
+    # Given: A repo with an uncommitted edit and an untracked file
+    Path(repo_dir, "app/users.py").write_text("def fetch_account(account_id):\n    pass\n")
+    Path(repo_dir, "app/accounts.py").write_text("fetch_account = None\n")
+
+    # When: We index and search it
+    index = get_trigram_index(repo_dir)
+    output = search_code(repo_dir, "fetch_account")
+
+    # Then: Verify the index only has the committed contents, and searches still see the working tree
+    assert index.get_candidate_files(["fetch_account"]) == []
+    assert "app/users.py" in index.get_candidate_files(["get_user"])
+    assert output == "app/accounts.py\n1:fetch_account = None\n\napp/users.py\n1:def fetch_account(account_id):\n"
+    assert search_code(repo_dir, "get_user_name") == ""
+
+
+def test_trigram_index_updates_from_ancestor_commit(repo_dir):
+    # Given: An index for the first commit and a second commit that changes and removes files
+    first_index = get_trigram_index(repo_dir)
+    git_repo = git.Repo(repo_dir)
+    Path(repo_dir, "app/users.py").write_text("def fetch_account(account_id):\n    pass\n")
+    git_repo.index.add(["app/users.py"])
+    git_repo.index.remove(["app.json"], working_tree=True)
+    git_repo.index.commit("rename users to accounts")
+
+    # When: We get the index for the second commit
+    index = get_trigram_index(repo_dir)
+
+    # Then: Verify it was updated from the first index instead of rebuilt, and answers for the new contents
+    assert index is not first_index
+    assert index.file_paths.count(None) == 2
+    assert search_code(repo_dir, "fetch_account") == "app/users.py\n1:def fetch_account(account_id):\n"
+    assert "app.json" not in search_code(repo_dir, "get_user")
+    assert "app/users.py" not in search_code(repo_dir, "get_user")
+
+
+if __name__ == "__main__":
+    # wall time per query for the trigram index and for spawning rg the way the agents used to
+    benchmark_repo_dir = os.getenv("REPO_DIRECTORY", str(Path(__file__).resolve().parents[2]))
+    start = time.time()
+    get_trigram_index(benchmark_repo_dir)
+    print(f"loading or building the index took {time.time() - start:.2f}s")
+    queries = ["get_blob_sha", "SweepConfig", "logger", r"def \w+_cache\(", "class .*Exception", "TODO"]
+    for query in queries:
+        start = time.time()
+        for _ in range(10):
+            output = search_code(benchmark_repo_dir, query, ignore_case=True, context=3)
+        index_time = (time.time() - start) / 10
+        start = time.time()
+        for _ in range(10):
+            rg_output = subprocess.run(
+                " ".join(["rg", "-n", "-i", "-C=3", "--heading", "--sort-files", f"'{query}'"]),
+                shell=True, cwd=benchmark_repo_dir, capture_output=True, stdin=subprocess.DEVNULL,
+            ).stdout.decode()
+        rg_time = (time.time() - start) / 10
+        print(f"{query}: index {index_time * 1000:.1f}ms, rg {rg_time * 1000:.1f}ms, same output: {output == rg_output}")